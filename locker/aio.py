@@ -0,0 +1,320 @@
+'''
+This module provides an asynchronous API for the commands of Locker.
+
+The blocking calls of liblxc, netfilter, and netlink are executed by a thread
+pool so that one event loop can drive several projects concurrently:
+
+.. code:: python
+
+    project = await AsyncProject.load('/srv/web/locker.yaml', 'web')
+    await project.start(['web', 'db'])
+    async for event in project.events():
+        print(event)
+
+The commands of a project are executed one after another, commands of
+different projects run concurrently. The options of the commands are the
+arguments of the command line interface as keyword arguments, e.g.,
+start(no_ports=True), see locker.cli.default_args().
+'''
+
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import locker.cli
+import locker.config
+import locker.health
+import locker.schema
+from locker.project import Project
+from locker.util import rules_to_str
+
+# executor shared by all projects that do not specify one
+_executor = None
+
+# maximum number of threads of the shared executor
+MAX_WORKERS = 16
+
+
+class Event(namedtuple('Event', ['time', 'project', 'kind', 'name', 'status', 'detail'])):
+    ''' Event of a project
+
+    "kind" is "command" for the begin ("status" = "started") and end ("done"
+    or "failed") of a command with "name", or "container" if a command changed
+    the state of the container "name", e.g., "status" = "RUNNING".
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        return '%s %s %s: %s%s' % (self.project, self.kind, self.name, self.status,
+                                   ' (%s)' % self.detail if self.detail else '')
+
+def get_executor():
+    ''' Get the executor shared by all projects
+
+    :returns: concurrent.futures.ThreadPoolExecutor
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    return _executor
+
+class _EventStream(object):
+    ''' Asynchronous iterator over the events of a project
+
+    Ends when the project is closed.
+    '''
+
+    def __init__(self, project):
+        self.project = project
+        self.queue = asyncio.Queue()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is None:
+            self.project._streams.discard(self)
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        ''' Stop receiving events '''
+        self.project._streams.discard(self)
+        self.queue.put_nowait(None)
+
+class AsyncProject(object):
+    ''' Asynchronous wrapper of a Project
+    '''
+
+    def __init__(self, project, executor=None):
+        ''' Wrap a project
+
+        :param project: Project instance
+        :param executor: concurrent.futures.Executor for the blocking calls,
+                         defaults to a shared thread pool
+        '''
+        self.project = project
+        self.executor = executor or get_executor()
+        self._args = dict(project.args)
+        self._lock = asyncio.Lock()
+        self._streams = set()
+
+    @classmethod
+    async def load(cls, filename, name, executor=None, validate=True, **options):
+        ''' Load a project from its YAML configuration file
+
+        :param filename: Path of the YAML configuration file
+        :param name: Name of the project
+        :param executor: See __init__()
+        :param validate: Validate the configuration against the schema
+        :param options: Arguments of the commands, see locker.cli.default_args()
+        :returns: AsyncProject
+        :raises: OSError, yaml.YAMLError if the file cannot be loaded
+        :raises: locker.schema.ValidationError if the configuration is invalid
+        '''
+        executor = executor or get_executor()
+        cache_dir = locker.cli.default_args(**options)['cache_dir'] or None
+        loop = asyncio.get_event_loop()
+        yml, config = await loop.run_in_executor(executor, locker.config.load, filename, cache_dir)
+        if validate:
+            await loop.run_in_executor(executor, locker.schema.validate, yml)
+        return await cls.from_config(yml, name, executor, config, file=filename, **options)
+
+    @classmethod
+    async def from_config(cls, yml, name, executor=None, config=None, **options):
+        ''' Create a project from a parsed configuration
+
+        :param yml: Parsed YAML configuration, e.g., a dictionary
+        :param name: Name of the project
+        :param executor: See __init__()
+        :param config: Compiled configuration (ProjectConfig), compiled from
+                       yml if None
+        :param options: Arguments of the commands, see locker.cli.default_args()
+        :returns: AsyncProject
+        '''
+        executor = executor or get_executor()
+        args = locker.cli.default_args(project=name, **options)
+        project = await asyncio.get_event_loop().run_in_executor(
+            executor, Project, yml, args, config)
+        return cls(project, executor)
+
+    @property
+    def name(self):
+        ''' Name of the project '''
+        return self.project.name
+
+    @property
+    def containers(self):
+        ''' Names of all containers without the project prefix '''
+        return [con.name.split('_', 1)[1] for con in self.project.all_containers]
+
+    def events(self):
+        ''' Get the events of the commands executed from now on
+
+        :returns: Asynchronous iterator of Event instances
+        '''
+        stream = _EventStream(self)
+        self._streams.add(stream)
+        return stream
+
+    def _emit(self, kind, name, status, detail=None):
+        event = Event(time.time(), self.name, kind, name, status, detail)
+        for stream in list(self._streams):
+            stream.queue.put_nowait(event)
+
+    def close(self):
+        ''' End all event streams '''
+        for stream in list(self._streams):
+            stream.close()
+
+    def _select(self, containers, options):
+        ''' Select the containers and set the arguments of a command
+
+        Runs in the executor.
+
+        :returns: Dictionary of the containers' states before the command
+        '''
+        unknown = set(containers or []) - set(self.containers)
+        if unknown:
+            raise ValueError('Unknown containers: %s' % ', '.join(sorted(unknown)))
+        unknown = set(options) - set(self._args)
+        if unknown:
+            raise KeyError('Unknown options: %s' % ', '.join(sorted(unknown)))
+        args = dict(self._args)
+        args.update(options)
+        args['containers'] = list(containers or [])
+        self.project.select(args)
+        return dict((con.name, con.state) for con in self.project.all_containers)
+
+    async def _run(self, command, containers, options, func=None):
+        ''' Execute a command of the project in the executor
+
+        :param command: Name of the command, i.e., of the Project method
+        :param containers: Names of the containers or None for all
+        :param options: Arguments of the command
+        :param func: Function executed instead of the Project method
+        :returns: Return value of the method
+        '''
+        loop = asyncio.get_event_loop()
+        async with self._lock:
+            self._emit('command', command, 'started')
+            try:
+                states = await loop.run_in_executor(self.executor, self._select, containers, options)
+                result = await loop.run_in_executor(self.executor, func or getattr(self.project, command))
+                changed = await loop.run_in_executor(
+                    self.executor, lambda: [(con.name, con.state) for con in self.project.all_containers
+                                            if states.get(con.name, None) != con.state])
+            except Exception as exception:
+                self._emit('command', command, 'failed', str(exception))
+                raise
+        for name, state in changed:
+            self._emit('container', name, state)
+        self._emit('command', command, 'done')
+        return result
+
+    async def create(self, containers=None, **options):
+        ''' Create the containers, see Project.create() '''
+        await self._run('create', containers, options)
+
+    async def remove(self, containers=None, **options):
+        ''' Remove the containers without confirmation, see Project.remove() '''
+        options['force_delete'] = True
+        await self._run('remove', containers, options)
+
+    async def start(self, containers=None, **options):
+        ''' Start the containers, see Project.start() '''
+        await self._run('start', containers, options)
+
+    async def stop(self, containers=None, **options):
+        ''' Stop the containers, see Project.stop() '''
+        await self._run('stop', containers, options)
+
+    async def reboot(self, containers=None, **options):
+        ''' Reboot the containers, see Project.reboot() '''
+        await self._run('reboot', containers, options)
+
+    async def rollout(self, containers=None, **options):
+        ''' Restart the containers in batches, see Project.rollout()
+
+        :returns: True if all containers were restarted and are ready
+        '''
+        return await self._run('rollout', containers, options)
+
+    async def up(self, containers=None, **options):
+        ''' Reconcile the containers with the configuration, see Project.up()
+
+        :returns: List of the executed (or planned) steps
+        '''
+        return await self._run('up', containers, options)
+
+    async def ports(self, containers=None, **options):
+        ''' Add the port forwarding rules, see Project.ports() '''
+        await self._run('ports', containers, options)
+
+    async def rmports(self, containers=None, **options):
+        ''' Remove the port forwarding rules, see Project.rmports() '''
+        await self._run('rmports', containers, options)
+
+    async def links(self, containers=None, **options):
+        ''' Update the links, see Project.links() '''
+        await self._run('links', containers, options)
+
+    async def rmlinks(self, containers=None, **options):
+        ''' Remove the links, see Project.rmlinks() '''
+        await self._run('rmlinks', containers, options)
+
+    async def cgroup(self, containers=None, **options):
+        ''' Apply the cgroup settings, see Project.cgroup() '''
+        await self._run('cgroup', containers, options)
+
+    async def freeze(self, containers=None, **options):
+        ''' Freeze the containers, see Project.freeze() '''
+        await self._run('freeze', containers, options)
+
+    async def unfreeze(self, containers=None, **options):
+        ''' Unfreeze the containers, see Project.unfreeze() '''
+        await self._run('unfreeze', containers, options)
+
+    async def cleanup(self, **options):
+        ''' Stop all containers and remove the network, see Project.cleanup() '''
+        await self._run('cleanup', None, options)
+
+    async def status(self, containers=None):
+        ''' Get the status of the containers
+
+        :param containers: Names of the containers or None for all
+        :returns: List of dictionaries with the keys "name", "defined",
+                  "state", "health", "ips", "ports", and "links"
+        '''
+        def _status():
+            status = list()
+            health = locker.health.check(self.project.containers)
+            for con in self.project.containers:
+                status.append({
+                    'name': con.name.split('_', 1)[1],
+                    'defined': con.defined,
+                    'state': con.state,
+                    'health': health[con.name],
+                    'ips': con.get_ips(retries=0) or [],
+                    'ports': rules_to_str(con.get_port_rules()) if con.defined else [],
+                    'links': con.linked_to() or [],
+                })
+            return status
+        return await self._run('status', containers, {}, _status)
+
+async def gather(*coroutines):
+    ''' Run commands of several projects concurrently
+
+    :param coroutines: Coroutines, e.g., project.start()
+    :returns: List of the results
+    :raises: The first exception raised by a command after all completed
+    '''
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error('Command failed: %s', result)
+            raise result
+    return results
@@ -0,0 +1,174 @@
+'''
+This module runs a command in several containers in parallel ("locker exec").
+
+The command is run in each container via liblxc's attach. The output of all
+containers is read via pipes and written line by line, prefixed with the
+container's name in its log color. At most "parallel" commands run at the
+same time and at most MAX_LINE bytes are buffered per container, longer lines
+are split. A summary of the exit codes is printed when all commands completed.
+'''
+
+import logging
+import os
+import selectors
+import sys
+import time
+from collections import OrderedDict
+
+import lxc
+import prettytable
+from colorama import Fore
+
+# maximum length of a buffered line in bytes, longer lines are split
+MAX_LINE = 64 * 1024
+
+# bytes read at once from a pipe
+READ_SIZE = 64 * 1024
+
+# exit code if the command could not be run
+ATTACH_FAILED = 255
+
+
+class _Job(object):
+    ''' Command running in a container '''
+
+    def __init__(self, container, prefix, output):
+        self.container = container
+        self.prefix = prefix
+        self.output = output
+        self.buffer = bytearray()
+        self.begin = time.time()
+        self.pid = -1
+        self.fd = None
+
+    def start(self, command):
+        ''' Run the command in the container
+
+        :returns: True if the command was started
+        '''
+        read_fd, write_fd = os.pipe()
+        stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        try:
+            self.pid = self.container.attach(lxc.attach_run_command, command,
+                                             stdin=stdin_fd, stdout=write_fd, stderr=write_fd)
+        finally:
+            os.close(write_fd)
+            os.close(stdin_fd)
+        if self.pid < 0:
+            os.close(read_fd)
+            return False
+        self.fd = read_fd
+        return True
+
+    def _write(self, line):
+        self.output.write('%s%s\n' % (self.prefix, line.decode(errors='replace')))
+
+    def feed(self, data):
+        ''' Write the complete lines of the output, buffer the rest '''
+        self.buffer.extend(data)
+        lines = self.buffer.split(b'\n')
+        self.buffer = bytearray(lines.pop())
+        while len(self.buffer) >= MAX_LINE:
+            lines.append(bytes(self.buffer[:MAX_LINE]))
+            del self.buffer[:MAX_LINE]
+        for line in lines:
+            self._write(line.rstrip(b'\r'))
+        if lines:
+            self.output.flush()
+
+    def finish(self):
+        ''' Write the remaining output and wait for the command
+
+        :returns: Exit code
+        '''
+        if self.buffer:
+            self._write(bytes(self.buffer))
+            self.output.flush()
+        os.close(self.fd)
+        _pid, status = os.waitpid(self.pid, 0)
+        if os.WIFSIGNALED(status):
+            return 128 + os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+def prefix(container, width):
+    ''' Get the colored prefix of the output lines of a container
+
+    :param container: Container instance
+    :param width: Width of the name, i.e., length of the longest name
+    :returns: String
+    '''
+    name = container.name.split('_', 1)[1]
+    reset_color = Fore.RESET if container.color else ''
+    return '%s%-*s |%s ' % (container.color, width, name, reset_color)
+
+def run(containers, command, parallel=8, output=None):
+    ''' Run a command in containers in parallel
+
+    :param containers: List of containers, the command is not run in
+                       containers that are not running
+    :param command: Command as list of arguments
+    :param parallel: Maximum number of commands running at the same time
+    :param output: Stream for the prefixed output, default: sys.stdout
+    :returns: Ordered dictionary of container name -> tuple (exit code,
+              seconds), exit code is None if the container is not running
+    '''
+    output = output or sys.stdout
+    width = max([len(con.name.split('_', 1)[1]) for con in containers] or [0])
+    results = OrderedDict((con.name, (None, 0.0)) for con in containers)
+    pending = list()
+    for container in containers:
+        if container.running:
+            pending.append(container)
+        else:
+            container.logger.warning('Not running, skipping')
+    selector = selectors.DefaultSelector()
+    active = 0
+    try:
+        while pending or active:
+            while pending and active < max(1, parallel):
+                container = pending.pop(0)
+                job = _Job(container, prefix(container, width), output)
+                if not job.start(command):
+                    container.logger.error('Could not run command')
+                    results[container.name] = (ATTACH_FAILED, 0.0)
+                    continue
+                selector.register(job.fd, selectors.EVENT_READ, job)
+                active += 1
+            for key, _events in selector.select():
+                job = key.data
+                data = os.read(job.fd, READ_SIZE)
+                if data:
+                    job.feed(data)
+                    continue
+                selector.unregister(job.fd)
+                active -= 1
+                results[job.container.name] = (job.finish(), time.time() - job.begin)
+    finally:
+        selector.close()
+    return results
+
+def summary(results, containers):
+    ''' Print the exit codes of the commands
+
+    :param results: Result of run()
+    :param containers: List of containers
+    :returns: 0 if the command succeeded in all running containers, else 1
+    '''
+    table = prettytable.PrettyTable(['Name', 'Exit code', 'Seconds'])
+    table.align = 'l'
+    table.align['Exit code'] = 'r'
+    table.align['Seconds'] = 'r'
+    table.hrules = prettytable.HEADER
+    table.vrules = prettytable.NONE
+    failed = 0
+    for container in containers:
+        code, seconds = results[container.name]
+        reset_color = Fore.RESET if container.color else ''
+        values = [container.name.split('_', 1)[1], '-' if code is None else code, '%.2f' % seconds]
+        table.add_row(['%s%s%s' % (container.color, value, reset_color) for value in values])
+        if code:
+            failed += 1
+    sys.stdout.write(table.get_string() + '\n')
+    if failed:
+        logging.error('Command failed in %d of %d containers', failed, len(containers))
+    return 1 if failed else 0
@@ -0,0 +1,661 @@
+'''
+Command line interface of Locker: manage LXC containers like with Docker's fig
+
+Locker enables to specify containers and their configuration in a file similar
+to the YAML configuration used by fig.
+
+Features:
+- Enables to create new containers from templates or by cloning
+- Creates an fstab for bind mounts from the host into the container
+- Enables to start and stop all containers defined in the same configuration
+  file
+- Makes services in containers available to the outside world by port
+  forwarding
+- ...
+
+The commands are executed by the Locker daemon if it is running (see
+locker.daemon), else in-process.
+'''
+
+__author__ = "BB"
+__copyright__ = "Copyright 2014"
+__license__ = "GPLv3 or later"
+__status__ = "Prototype"
+
+import argcomplete
+import argparse
+import logging
+import os
+import pprint
+import shlex
+import sys
+import time
+
+import prettytable
+import yaml
+import locker.config
+import locker.daemon
+import locker.network
+import locker.schema
+from locker import Project
+from locker._version import __version__
+
+# commands that are always executed in-process: "dns", "watch", and "logs"
+# run in the foreground, "validate" does not require root privileges, "batch"
+# reads a local script
+LOCAL_COMMANDS = ['dns', 'watch', 'logs', 'validate', 'batch']
+
+# commands that cannot be used in batch scripts
+NO_BATCH_COMMANDS = ['dns', 'watch', 'logs', 'batch']
+
+
+def build_parser():
+    '''
+    Create the parser of the command line arguments
+
+    :returns: argparse.ArgumentParser
+    '''
+    parser = argparse.ArgumentParser(description='Manage LXC containers')
+
+    ############################################################################
+
+    parser.add_argument(
+        '--verbose', '-v',
+        const=True, default=False, action='store_const',
+        help='Show more output')
+
+    parser.add_argument(
+        '--version',
+        const=True, default=False, action='store_const',
+        help='Print version and exit')
+
+    parser.add_argument(
+        '--file', '-f',
+        default='./locker.yaml',
+        help='Specify an alternate Locker file (default: ./locker.yaml)')
+
+    parser.add_argument(
+        '--project', '-p',
+        default=os.path.basename(os.getcwd()),
+        help='Specify an alternate project name (default: current directory name)')
+
+    parser.add_argument(
+        '--no-color', '-o',
+        const=True, default=False, action='store_const',
+        help='Do not use colored output')
+
+    parser.add_argument(
+        '--no-validate', '-V',
+        const=True, default=False, action='store_const',
+        help='Do not validate the YAML configuration before running the command')
+
+    parser.add_argument(
+        '--lxcpath', '-P',
+        default='/var/lib/lxc', required=False,
+        help='Root path of the containers (default=/var/lib/lxc)')
+
+    parser.add_argument(
+        '--cache-dir', '-C',
+        default='/var/cache/locker', required=False,
+        help='Directory to cache the compiled configuration, empty string disables the cache (default=/var/cache/locker)')
+
+    parser.add_argument(
+        '--socket', '-S',
+        default=locker.daemon.SOCKET, required=False,
+        help='Socket of the Locker daemon (default=%s)' % locker.daemon.SOCKET)
+
+    parser.add_argument(
+        '--no-daemon', '-X',
+        const=True, default=False, action='store_const',
+        help='Always execute the command in-process, even if the Locker daemon is running')
+
+    subparsers = parser.add_subparsers(help='sub-command help', dest='command')
+    subparsers.required = True
+
+    ############################################################################
+
+    subparser_rm = subparsers.add_parser('rm', help='Delete container')
+    subparser_rm.add_argument(
+        '--force-delete', '-x',
+        const=True, default=False, action='store_const',
+        help='Don\'t ask for confirmation when deleting')
+
+    ############################################################################
+
+    subparser_create = subparsers.add_parser('create', help='Create container')
+    subparser_create.add_argument(
+        '--no-move', '-d',
+        const=True, default=False, action='store_const',
+        help='Don\'t move directories/files defined as bind mounts to host after container creation (default: move directories/files)')
+    subparser_create.add_argument(
+        '--copy-workers', '-w',
+        type=int, default=4,
+        help='Number of threads copying files when moving directories across file systems (default: 4)')
+    subparser_create.add_argument(
+        '--template-cache', '-c',
+        const=True, default=False, action='store_const',
+        help='Clone containers with identical template configuration from a cached base container instead of running the template for each container (default: run the template)')
+    subparser_create.add_argument(
+        '--template-ttl', '-T',
+        type=int, default=7*24*3600,
+        help='Rebuild cached base containers older than this many seconds (default: 604800)')
+
+    ############################################################################
+
+    subparser_start = subparsers.add_parser('start', help='Start container')
+    subparser_stop = subparsers.add_parser('stop', help='Stop container')
+    subparser_reboot = subparsers.add_parser('reboot', help='Reboot container')
+    subparser_up = subparsers.add_parser('up', help='Create, start, and update containers as configured')
+    subparser_exec = subparsers.add_parser('exec', help='Run a command in containers in parallel: exec [containers] -- command')
+    subparser_cp = subparsers.add_parser('cp', help='Copy files between the host and containers: cp SOURCE DESTINATION [containers], prefix paths in the containers with \":\"')
+    subparser_logs = subparsers.add_parser('logs', help='Show the console logs or log files of containers')
+    subparser_rollout = subparsers.add_parser('rollout', help='Restart containers in batches, waiting until each batch is ready')
+    subparser_watch = subparsers.add_parser('watch', help='Apply changes of the configuration file to the running containers')
+
+    subparser_up.add_argument(
+        '--plan', '-p',
+        const=True, default=False, action='store_const',
+        help='Only print the steps that are necessary to apply the configuration')
+
+    subparser_exec.add_argument(
+        '--parallel', '-j',
+        type=int, default=8,
+        help='Maximum number of containers running the command at the same time (default: 8)')
+
+    subparser_cp.add_argument(
+        'source',
+        help='File or directory on the host, or in the containers if prefixed with \":\", e.g., \":/var/log/app\"')
+
+    subparser_cp.add_argument(
+        'destination',
+        help='Path in the containers if prefixed with \":\", else directory on the host where a subdirectory per container is created')
+
+    subparser_cp.add_argument(
+        '--parallel', '-j',
+        type=int, default=8,
+        help='Maximum number of containers copied to or from at the same time (default: 8)')
+
+    subparser_logs.add_argument(
+        '--follow', '-f',
+        const=True, default=False, action='store_const',
+        help='Show new lines until interrupted')
+
+    subparser_logs.add_argument(
+        '--lines', '-n',
+        type=int, default=10,
+        help='Number of lines shown from the end of each log (default: 10)')
+
+    subparser_logs.add_argument(
+        '--path', '-p',
+        action='append', default=None,
+        help='Show this file in the containers instead of the console log, e.g., \"/var/log/syslog\" (can be used multiple times)')
+
+    subparser_rollout.add_argument(
+        '--max-unavailable', '-m',
+        type=int, default=1,
+        help='Number of containers restarted at the same time (default: 1)')
+
+    subparser_rollout.add_argument(
+        '--ready-timeout', '-R',
+        type=int, default=60,
+        help='Seconds until a restarted container must be ready, else the rollout is aborted (default: 60)')
+
+    subparser_watch.add_argument(
+        '--delay', '-d',
+        type=float, default=0.5,
+        help='Seconds without further changes of the file before applying them (default: 0.5)')
+
+    subparser_reboot.add_argument(
+        '--full', '-F',
+        const=True, default=False, action='store_const',
+        help='Stop and start the containers instead of rebooting them in place, i.e., re-apply the complete configuration')
+
+    subparser_start.add_argument(
+        '--restart', '-r',
+        const=True, default=False, action='store_const',
+        help='Restart already running containers when using \"start\" command')
+
+    for sub in [subparser_start, subparser_stop, subparser_up, subparser_rollout, subparser_watch]:
+        sub.add_argument(
+            '--no-ports', '-n',
+            const=True, default=False, action='store_const',
+            help='Do not add/remove netfilter rules (used with command start/stop)')
+
+        sub.add_argument(
+            '--add-hosts', '-a',
+            const=True, default=False, action='store_const',
+            help='Add the containers\' hostnames to the /etc/hosts file of this host')
+
+        sub.add_argument(
+            '--hosts-mode', '-H',
+            choices=['etc', 'fragment', 'merge'], default='etc',
+            help='Where \"--add-hosts\" adds the hostnames: directly to /etc/hosts (etc), to the project\'s hosts fragment HOSTS_DIR/PROJECT.hosts (fragment), or to the fragment merged as block into /etc/hosts (merge) (default: etc)')
+
+        sub.add_argument(
+            '--hosts-dir', '-D',
+            default='/run/locker',
+            help='Directory of the projects\' hosts fragments (default: /run/locker)')
+
+        sub.add_argument(
+            '--no-links', '-l',
+            const=True, default=False, action='store_const',
+            help='Do not add/remove links (used with command start/stop)')
+
+    for sub in [subparser_start, subparser_stop, subparser_reboot, subparser_up, subparser_rollout, subparser_watch]:
+        sub.add_argument(
+            '--timeout', '-t',
+            type=int, default=30,
+            help='Seconds until containers that did not shut down are killed (default: 30)')
+
+    ############################################################################
+
+    subparser_status = subparsers.add_parser('status', help='Show container status')
+
+    subparser_status.add_argument(
+        '--extended', '-e',
+        const=True, default=False, action='store_const',
+        help='Show extended status report')
+
+    ############################################################################
+
+    subparser_port = subparsers.add_parser('ports', help='Add port forwarding netfilter rules')
+    subparser_rmports = subparsers.add_parser('rmports', help='Remove port forwarding netfilter rules')
+    subparser_links = subparsers.add_parser('links', help='Add links between containers')
+    subparser_rmlinks = subparsers.add_parser('rmlinks', help='Remove links between containers')
+    subparser_cgroup = subparsers.add_parser('cgroup', help='Set cgroup configuration')
+    subparser_cleanup = subparsers.add_parser('cleanup', help='Stop containers, remove netfilter rules and bridge')
+    subparser_freeze = subparsers.add_parser('freeze', help='Freeze containers')
+    subparser_unfreeze = subparsers.add_parser('unfreeze', help='Unfreeze containers')
+
+    for sub in [subparser_start, subparser_stop, subparser_links, subparser_up, subparser_rollout, subparser_watch]:
+        sub.add_argument(
+            '--dns-links', '-N',
+            const=True, default=False, action='store_const',
+            help='Links are resolved by \"locker dns\", do not write them into the containers\' /etc/hosts')
+
+    ############################################################################
+
+    subparser_dns = subparsers.add_parser('dns', help='Run DNS responder for the containers and their links')
+    subparser_dns.add_argument(
+        '--listen', '-L',
+        default=None,
+        help='Listen address (default: IP address of the project bridge)')
+    subparser_dns.add_argument(
+        '--port', '-n',
+        type=int, default=53,
+        help='Listen port (default: 53)')
+    subparser_dns.add_argument(
+        '--upstream', '-u',
+        nargs='*', default=None,
+        help='Upstream name servers for other names (default: name servers of the host)')
+    subparser_dns.add_argument(
+        '--ttl', '-t',
+        type=int, default=5,
+        help='Time to live of the answers in seconds (default: 5)')
+
+    ############################################################################
+
+    subparser_state = subparsers.add_parser('state', help='Manage the recorded state of the containers')
+    subparser_state.add_argument(
+        'action',
+        choices=['rebuild'],
+        help='Rebuild the recorded state from the live state of the containers')
+
+    ############################################################################
+
+    subparser_batch = subparsers.add_parser('batch', help='Execute the commands of a script in one process')
+    subparser_batch.add_argument(
+        'script',
+        nargs='?', default='-',
+        help='Script with one command per line, e.g., \"-f web.yaml start\" (default: read from stdin)')
+    subparser_batch.add_argument(
+        '--keep-going', '-k',
+        const=True, default=False, action='store_const',
+        help='Execute the remaining commands after a command failed')
+
+    ############################################################################
+
+    subparser_validate = subparsers.add_parser('validate', help='Validate YAML configuration file against schema')
+    subparser_validate.add_argument(
+        '--schema', '-s',
+        nargs=1, required=False,
+        help='Alternate schema file (default: built-in schema)')
+
+    ############################################################################
+
+    for sub in [subparser_start, subparser_stop, subparser_reboot, subparser_up, subparser_exec, subparser_cp,
+                subparser_logs,
+                subparser_rollout, subparser_watch,
+                subparser_create, subparser_rm, subparser_status,
+                subparser_port, subparser_rmports,
+                subparser_links, subparser_rmlinks,
+                subparser_cgroup, subparser_freeze, subparser_unfreeze]:
+        sub.add_argument(
+            'containers',
+            nargs='*', default=[],
+            help='Space separated list of containers (default: all containers)')
+
+    return parser
+
+def parse_args(argv=None):
+    '''
+    Parse the command line arguments
+
+    :param argv: List of arguments, defaults to sys.argv[1:]
+    :returns: Dictionary of the parsed arguments
+    '''
+    parser = build_parser()
+    argcomplete.autocomplete(parser)
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # the command of "exec" follows "--" and may contain any options
+    cmd = None
+    if '--' in argv and 'exec' in argv[:argv.index('--')]:
+        cmd = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args_dict = vars(parser.parse_args(argv))
+    if args_dict['command'] == 'cp':
+        if args_dict['source'].startswith(':') == args_dict['destination'].startswith(':'):
+            parser.error('cp requires exactly one path in the containers, prefixed with ":"')
+    if args_dict['command'] == 'exec':
+        if not cmd:
+            parser.error('exec requires a command after "--"')
+        args_dict['cmd'] = cmd
+    return args_dict
+
+def default_args(**options):
+    '''
+    Get the default values of the arguments of all commands
+
+    Used to call the methods of Project without parsing a command line, e.g.,
+    by the asynchronous API.
+
+    :param options: Values that replace the defaults, e.g., no_ports=True
+    :returns: Dictionary of the arguments
+    :raises: KeyError if an option is unknown
+    '''
+    parser = build_parser()
+    parsers = [parser]
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            parsers.extend(action.choices.values())
+    args = dict()
+    for sub in parsers:
+        for action in sub._actions:
+            if action.dest not in ('help', 'command', argparse.SUPPRESS) and action.default != argparse.SUPPRESS:
+                args.setdefault(action.dest, action.default)
+    for key, value in options.items():
+        if key not in args:
+            raise KeyError('Unknown option: %s' % key)
+        args[key] = value
+    return args
+
+def validate(yml, schema_file=None):
+    ''' Validate YAML configuration file
+
+    Validates the parsed YAML configuration against Locker's built-in schema
+    or the specified schema file.
+
+    :param yml: Parsed YAML configuration
+    :param schema_file: Path to an alternate schema file or None
+    :returns: 0 if the configuration is valid, else 1
+    '''
+    try:
+        logging.debug('Validating YAML configuration')
+        locker.schema.validate(yml, schema_file)
+    except (OSError, locker.schema.SchemaError) as exception:
+        logging.error('Cannot validate YAML configuration: %s', exception)
+        return 1
+    except locker.schema.ValidationError as exception:
+        logging.error('YAML configuration does not comply to schema:')
+        for path, message in exception.errors:
+            logging.error('  %s: %s', path, message)
+        return 1
+    logging.debug('YAML configuration complies to schema')
+    return 0
+
+def load_project(args, projects=None):
+    ''' Load the configuration and create the project
+
+    :param args: Parsed command line arguments
+    :param projects: ProjectCache to reuse projects of previous commands
+    :returns: Project instance or None if the configuration is invalid
+    '''
+    if projects is not None:
+        try:
+            pro = projects.get(args)
+        except (OSError, TypeError, yaml.YAMLError) as exception:
+            logging.critical('Could not load configuration file \"%s\": %s', args['file'], exception)
+            return None
+        if pro is not None:
+            return pro
+    try:
+        yml, config = locker.config.load(args['file'], args['cache_dir'] or None)
+    except (OSError, TypeError, yaml.YAMLError) as exception:
+        logging.critical('Could not load configuration file \"%s\": %s', args['file'], exception)
+        return None
+    logging.debug('Parsed YAML Configuration: \n%s', pprint.pformat(yml, indent=4))
+    if not args['no_validate'] and validate(yml):
+        logging.critical('Invalid configuration, use \"--no-validate\" to skip the validation')
+        return None
+    pro = Project(yml, args, config)
+    if projects is not None:
+        projects.add(args, pro)
+    return pro
+
+def run(args, projects=None):
+    ''' Execute a command
+
+    :param args: Parsed command line arguments
+    :param projects: ProjectCache to reuse projects of previous commands
+    :returns: Exit code
+    '''
+    if not os.path.isfile(args['file']):
+        logging.critical('Configuration file \"%s\" does not exist or cannot be accessed', args['file'])
+        return 1
+    if args['command'] == 'validate':
+        try:
+            yml, _config = locker.config.load(args['file'], args['cache_dir'] or None)
+        except (OSError, TypeError, yaml.YAMLError) as exception:
+            logging.critical('Could not load configuration file \"%s\": %s', args['file'], exception)
+            return 1
+        schema_file = args['schema'][0] if args['schema'] else None
+        if validate(yml, schema_file):
+            return 1
+        logging.info('YAML configuration complies to schema')
+        return 0
+
+    if not os.geteuid() == 0:
+        logging.fatal("Locker must be run as root to modify netfilter rules and as unprivileged containers are not yet supported.")
+        return 1
+    pro = load_project(args, projects)
+    if pro is None:
+        return 1
+
+    if args['command'] == 'status':
+        pro.status()
+    elif args['command'] == 'start':
+        pro.start()
+    elif args['command'] == 'stop':
+        pro.stop()
+    elif args['command'] == 'reboot':
+        pro.reboot()
+    elif args['command'] == 'create':
+        pro.create()
+    elif args['command'] == 'rm':
+        pro.remove()
+    elif args['command'] == 'ports':
+        pro.ports()
+    elif args['command'] == 'rmports':
+        pro.rmports()
+    elif args['command'] == 'links':
+        pro.links()
+    elif args['command'] == 'rmlinks':
+        pro.rmlinks()
+    elif args['command'] == 'cgroup':
+        pro.cgroup()
+    elif args['command'] == 'cleanup':
+        pro.cleanup()
+    elif args['command'] == 'freeze':
+        pro.freeze()
+    elif args['command'] == 'unfreeze':
+        pro.unfreeze()
+    elif args['command'] == 'dns':
+        pro.dns()
+    elif args['command'] == 'up':
+        pro.up()
+    elif args['command'] == 'exec':
+        return pro.execute()
+    elif args['command'] == 'cp':
+        return pro.copy()
+    elif args['command'] == 'logs':
+        pro.logs()
+    elif args['command'] == 'rollout':
+        if not pro.rollout():
+            return 1
+    elif args['command'] == 'watch':
+        pro.watch()
+    elif args['command'] == 'state':
+        pro.rebuild_state()
+    else:
+        raise RuntimeError('Invalid command: %s' % args['command'])
+    return 0
+
+def _batch_prefix(args):
+    ''' Get the general arguments of the batch command for its steps
+
+    Each step may override them, e.g., by its own "--file".
+
+    :param args: Parsed command line arguments of the batch command
+    :returns: List of arguments
+    '''
+    prefix = ['--file', args['file'], '--project', args['project'],
+              '--lxcpath', args['lxcpath'], '--cache-dir', args['cache_dir']]
+    for key, option in [('no_color', '--no-color'), ('no_validate', '--no-validate')]:
+        if args[key]:
+            prefix.append(option)
+    return prefix
+
+def _read_script(script):
+    ''' Get the commands of a batch script
+
+    Empty lines and comments are skipped, a leading "locker" is removed.
+
+    :param script: Path of the script, "-" for stdin
+    :returns: List of tuples (line number, line, arguments)
+    :raises: OSError if the script cannot be read
+    :raises: ValueError if a line cannot be split into arguments
+    '''
+    if script == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(script, 'r') as script_fd:
+            lines = script_fd.readlines()
+    steps = list()
+    for lineno, line in enumerate(lines, 1):
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as exception:
+            raise ValueError('Line %d: %s' % (lineno, exception))
+        if argv and argv[0] == 'locker':
+            argv = argv[1:]
+        if argv:
+            steps.append((lineno, line.strip(), argv))
+    return steps
+
+def batch(args):
+    ''' Execute the commands of a script in one process
+
+    Projects are loaded once for all commands with the same configuration
+    file. A summary with the exit code and duration of each command is
+    printed at the end.
+
+    :param args: Parsed command line arguments of the batch command
+    :returns: Exit code, 0 if all commands succeeded
+    '''
+    try:
+        steps = _read_script(args['script'])
+    except (OSError, ValueError) as exception:
+        logging.critical('Cannot read batch script \"%s\": %s', args['script'], exception)
+        return 1
+    prefix = _batch_prefix(args)
+    projects = locker.daemon.ProjectCache()
+    level = logging.root.level
+    results = list()
+    for lineno, line, argv in steps:
+        start = time.time()
+        try:
+            step_args = parse_args(prefix + argv)
+        except SystemExit as exception:
+            code = exception.code if isinstance(exception.code, int) else 2
+        else:
+            if step_args['command'] in NO_BATCH_COMMANDS:
+                logging.error('Line %d: command cannot be used in batch scripts: %s', lineno, step_args['command'])
+                code = 2
+            elif step_args['command'] == 'rm' and not step_args['force_delete']:
+                logging.error('Line %d: "rm" requires "--force-delete" in batch scripts', lineno)
+                code = 2
+            else:
+                logging.info('Line %d: %s', lineno, line)
+                if step_args['command'] != 'validate':
+                    # reuse the netlink session between the commands
+                    locker.network.keep_ipdb()
+                logging.root.setLevel(logging.DEBUG if step_args['verbose'] or args['verbose'] else level)
+                try:
+                    code = run(step_args, projects)
+                except Exception as exception:
+                    logging.exception('Line %d: command failed: %s', lineno, exception)
+                    # the projects may be inconsistent
+                    projects.clear()
+                    code = 1
+                finally:
+                    logging.root.setLevel(level)
+        results.append((lineno, line, code, time.time() - start))
+        if code and not args['keep_going']:
+            logging.error('Line %d failed, skipping the remaining commands', lineno)
+            break
+
+    table = prettytable.PrettyTable(['Line', 'Command', 'Exit', 'Time [s]'])
+    table.align = 'l'
+    table.align['Exit'] = 'r'
+    table.align['Time [s]'] = 'r'
+    table.hrules = prettytable.HEADER
+    table.vrules = prettytable.NONE
+    for lineno, line, code, seconds in results:
+        table.add_row([lineno, line, code, '%.3f' % seconds])
+    failed = len([result for result in results if result[2]])
+    sys.stdout.write(table.get_string() + '\n')
+    sys.stdout.write('%d of %d commands executed, %d failed, %.3fs\n' %
+                     (len(results), len(steps), failed, sum(result[3] for result in results)))
+    return 1 if failed or len(results) < len(steps) else 0
+
+def main(argv=None):
+    ''' The main function
+
+    :param argv: List of arguments, defaults to sys.argv[1:]
+    '''
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+    args = parse_args(argv)
+    if args['verbose']:
+        logging.root.setLevel(logging.DEBUG)
+        logging.debug('Parsed arguments: \n%s', pprint.pformat(args, indent=4))
+
+    if args['version']:
+        sys.stdout.write('%s\n' % __version__)
+        sys.exit()
+
+    # paths are resolved by the daemon relative to its working directory
+    args['file'] = os.path.abspath(args['file'])
+    if args.get('schema', None):
+        args['schema'] = [os.path.abspath(args['schema'][0])]
+    if args['command'] == 'cp':
+        args['source'], args['destination'] = [path if path.startswith(':') else os.path.abspath(path)
+                                               for path in (args['source'], args['destination'])]
+    if args['command'] == 'batch':
+        sys.exit(batch(args))
+    interactive = args['command'] == 'rm' and not args['force_delete']
+    if not args['no_daemon'] and not interactive and args['command'] not in LOCAL_COMMANDS:
+        try:
+            sys.exit(locker.daemon.request(args, args['socket']))
+        except locker.daemon.DaemonUnavailable as exception:
+            logging.debug('Executing in-process: %s', exception)
+    sys.exit(run(args))
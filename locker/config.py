@@ -0,0 +1,388 @@
+'''
+This module compiles the YAML project configuration into an immutable model.
+
+The raw YAML dictionaries are parsed once, the defaults are merged into each
+container's configuration, and all string directives (ports, volumes, links,
+cgroup items, and DNS servers) are split into their parts. The resulting model
+can be cached on disk so that repeated invocations of Locker on the same
+project file skip the YAML parsing entirely.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import stat
+import tempfile
+from collections import OrderedDict, namedtuple
+
+import netaddr
+import yaml
+from locker.util import regex_cgroup, regex_link, regex_ports, regex_volumes
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+# Increase whenever the model changes to invalidate existing cache files
+MODEL_VERSION = 5
+
+# Maximum size of the console log in bytes for "console_log: true"
+CONSOLE_LOG_SIZE = 1024 * 1024
+
+_regex_ports = re.compile(regex_ports)
+_regex_volumes = re.compile(regex_volumes)
+_regex_link = re.compile(regex_link)
+_regex_cgroup = re.compile(regex_cgroup)
+
+
+class PortRule(namedtuple('PortRule', ['host_ip', 'host_port', 'container_port', 'proto'])):
+    ''' Parsed port forwarding directive, e.g., "192.168.2.1:80:8080/tcp" '''
+    __slots__ = ()
+
+class Volume(namedtuple('Volume', ['outside', 'inside'])):
+    ''' Parsed volume directive
+
+    Variables like "$name" are not yet expanded as they depend on the
+    container instance. "inside" is relative to the root of the container.
+    '''
+    __slots__ = ()
+
+class Link(namedtuple('Link', ['name', 'alias'])):
+    ''' Parsed link directive, e.g., "db:database" '''
+    __slots__ = ()
+
+class CgroupItem(namedtuple('CgroupItem', ['key', 'value'])):
+    ''' Parsed cgroup setting, e.g., "cpu.shares=512" '''
+    __slots__ = ()
+
+class Healthcheck(namedtuple('Healthcheck', ['tcp', 'command', 'file', 'timeout', 'interval'])):
+    ''' Parsed healthcheck block
+
+    The container is healthy if all configured probes succeed: the
+    container's "tcp" port accepts connections, the "command" (the "exec"
+    key) exits with 0 when run in the container, and the "file" exists in
+    the container. "timeout" is the time in seconds until the container is
+    considered unhealthy, "interval" the initial delay between the probes.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, healthcheck):
+        ''' Compile the healthcheck block
+
+        :param healthcheck: Map with the probes and options
+        :returns: Healthcheck instance or None if no probe is defined
+        :raises: ValueError if a value is invalid
+        '''
+        if not isinstance(healthcheck, dict):
+            raise ValueError('healthcheck must be a map')
+        tcp = healthcheck.get('tcp', None)
+        command = healthcheck.get('exec', None) or None
+        filename = healthcheck.get('file', None) or None
+        if tcp is None and command is None and filename is None:
+            return None
+        if tcp is not None and not 0 < int(tcp) < 65536:
+            raise ValueError('Invalid port: %s' % tcp)
+        if filename is not None and not str(filename).startswith('/'):
+            raise ValueError('Invalid file: %s' % filename)
+        return cls(int(tcp) if tcp is not None else None,
+                   str(command) if command is not None else None,
+                   str(filename) if filename is not None else None,
+                   float(healthcheck.get('timeout', None) or 60),
+                   float(healthcheck.get('interval', None) or 0.5))
+
+class CloneSpec(namedtuple('CloneSpec', ['origin', 'snapshot', 'backingstore'])):
+    ''' Parsed clone directive
+
+    The directive is either the name of the container to clone from or a map
+    with the keys "from", "snapshot", and "backingstore".
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, clone):
+        ''' Compile the clone directive
+
+        :param clone: Name of the origin or map with the clone options
+        :returns: CloneSpec instance or None if clone is not defined/invalid
+        '''
+        if isinstance(clone, str):
+            return cls(clone, False, None)
+        if isinstance(clone, dict) and clone.get('from', None):
+            return cls(str(clone['from']), bool(clone.get('snapshot', False)),
+                       clone.get('backingstore', None) or None)
+        return None
+
+class ContainerConfig(namedtuple('ContainerConfig', [
+        'name', 'template', 'clone', 'download', 'fqdn', 'ports', 'volumes',
+        'links', 'cgroup', 'dns', 'healthcheck', 'console_log', 'invalid'])):
+    ''' Compiled configuration of a single container
+
+    The defaults of the project have already been merged into "cgroup" and
+    "dns". "template" and "download" are tuples of (key, value) pairs sorted
+    by the key, "clone" is a CloneSpec. "console_log" is the maximum size of
+    the console log in bytes (0 == unlimited) or None if disabled. "invalid"
+    contains (section, value) tuples of malformed directives that have been
+    skipped.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, name, yml, defaults=None):
+        ''' Compile the YAML configuration of a container
+
+        :param name: Name of the container (without project prefix)
+        :param yml: YAML configuration of the container
+        :param defaults: YAML configuration of the "defaults" subtree
+        :returns: ContainerConfig instance
+        '''
+        defaults = defaults or {}
+        invalid = list()
+
+        ports = list()
+        for fwport in yml.get('ports', None) or []:
+            match = _regex_ports.match(str(fwport))
+            if not match:
+                invalid.append(('ports', fwport))
+                continue
+            mdict = match.groupdict()
+            ports.append(PortRule(mdict['host_ip'], mdict['host_port'],
+                                  mdict['container_port'],
+                                  mdict['proto_udp'] or 'tcp'))
+
+        volumes = list()
+        for volume in yml.get('volumes', None) or []:
+            match = _regex_volumes.match(str(volume))
+            if not match:
+                invalid.append(('volumes', volume))
+                continue
+            volumes.append(Volume(match.group('outside'), match.group('inside')))
+
+        links = list()
+        for link in yml.get('links', None) or []:
+            match = _regex_link.match(str(link))
+            if not match:
+                invalid.append(('links', link))
+                continue
+            links.append(Link(match.group('name'), match.group('alias')))
+
+        # defaults go first and are overwritten by container specific values
+        cgroup_items = OrderedDict()
+        defaults_cgroup = defaults.get('cgroup', None) or []
+        container_cgroup = yml.get('cgroup', None) or []
+        for cgroup in defaults_cgroup + container_cgroup:
+            match = _regex_cgroup.match(str(cgroup))
+            if not match:
+                invalid.append(('cgroup', cgroup))
+                continue
+            cgroup_items[match.group('key')] = match.group('value')
+        cgroup = [CgroupItem(k, v) for k, v in cgroup_items.items()]
+
+        # container specific servers have precedence over the defaults
+        dns_list = list()
+        container_dns = yml.get('dns', None) or []
+        defaults_dns = defaults.get('dns', None) or []
+        for dns in OrderedDict.fromkeys(container_dns + defaults_dns):
+            if dns in ['$bridge', '$copy']:
+                dns_list.append(dns)
+                continue
+            try:
+                dns_list.append(str(netaddr.IPAddress(dns)))
+            except (netaddr.AddrFormatError, TypeError, ValueError):
+                invalid.append(('dns', dns))
+
+        healthcheck = None
+        if yml.get('healthcheck', None) is not None:
+            try:
+                healthcheck = Healthcheck.compile(yml['healthcheck'])
+            except (TypeError, ValueError):
+                invalid.append(('healthcheck', yml['healthcheck']))
+
+        console_log = None
+        log_size = yml.get('console_log', None)
+        if log_size is True:
+            console_log = CONSOLE_LOG_SIZE
+        elif isinstance(log_size, int) and not isinstance(log_size, bool) and log_size >= 0:
+            console_log = log_size
+        elif log_size not in [None, False]:
+            invalid.append(('console_log', log_size))
+
+        def _sorted_items(subtree):
+            if not isinstance(subtree, dict):
+                return None
+            return tuple(sorted((str(k), str(v)) for k, v in subtree.items()))
+
+        return cls(
+            name=name,
+            template=_sorted_items(yml.get('template', None)),
+            clone=CloneSpec.compile(yml.get('clone', None)),
+            download=_sorted_items(yml.get('download', None)),
+            fqdn=yml.get('fqdn', None) or None,
+            ports=tuple(ports),
+            volumes=tuple(volumes),
+            links=tuple(links),
+            cgroup=tuple(cgroup),
+            dns=tuple(OrderedDict.fromkeys(dns_list)),
+            healthcheck=healthcheck,
+            console_log=console_log,
+            invalid=tuple(invalid),
+        )
+
+    def get_invalid(self, section):
+        ''' Get the malformed directives of a section
+
+        :param section: Name of the section, e.g., "ports"
+        :returns: List of malformed values
+        '''
+        return [value for sec, value in self.invalid if sec == section]
+
+    def start_digest(self):
+        ''' Get the hash of the settings that are applied when the container
+        starts, i.e., that require a restart to change
+
+        "console_log" is only included if it is enabled so that the hashes
+        recorded by previous versions stay valid.
+
+        :returns: Hash as hex string
+        '''
+        settings = [self.fqdn, [list(vol) for vol in self.volumes], list(self.dns)]
+        if self.console_log is not None:
+            settings.append(self.console_log)
+        return hashlib.sha256(json.dumps(settings).encode()).hexdigest()[:16]
+
+class ProjectConfig(namedtuple('ProjectConfig', ['containers'])):
+    ''' Compiled configuration of a project
+
+    "containers" is a tuple of ContainerConfig instances sorted by name.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, yml):
+        ''' Compile the YAML configuration of a project
+
+        :param yml: Parsed YAML configuration
+        :returns: ProjectConfig instance
+        '''
+        if not isinstance(yml, dict):
+            raise TypeError('Invalid type for yml: %s' % type(yml))
+        defaults = yml.get('defaults', None) or {}
+        containers = yml.get('containers', None) or {}
+        return cls(containers=tuple(
+            ContainerConfig.compile(name, containers[name] or {}, defaults)
+            for name in sorted(containers.keys())))
+
+    def get_container(self, name):
+        ''' Get the configuration of a container
+
+        :param name: Name of the container (without project prefix)
+        :returns: ContainerConfig if found, else None
+        '''
+        for container in self.containers:
+            if container.name == name:
+                return container
+        return None
+
+def _cache_file(cache_dir, filename):
+    ''' Path of the cache file of a configuration file
+
+    There is one cache file per configuration file, i.e., it is replaced
+    when the configuration file changes.
+    '''
+    key = hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'config-%s.pickle' % key)
+
+def _trusted(path, path_stat):
+    ''' Check if a cache file or directory may be used
+
+    Unpickling can execute arbitrary code, hence the cache must be owned by
+    the effective user and must not be writable by the group or others.
+
+    :param path: Path for the log message
+    :param path_stat: os.stat_result of the path
+    :returns: True if the path is trusted, else False
+    '''
+    if path_stat.st_uid != os.geteuid() or path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        logging.warning('Ignoring cache, not owned by the user or writable by others: %s', path)
+        return False
+    return True
+
+def _read_cache(cache_dir, filename, digest):
+    ''' Read the cached configuration
+
+    :returns: Tuple (yml, ProjectConfig) or None if not cached
+    '''
+    cache_file = _cache_file(cache_dir, filename)
+    try:
+        if not _trusted(cache_dir, os.stat(cache_dir)):
+            return None
+        with open(os.open(cache_file, os.O_RDONLY | os.O_NOFOLLOW), 'rb') as cache_fd:
+            if not _trusted(cache_file, os.fstat(cache_fd.fileno())):
+                return None
+            cached_digest, yml, config = pickle.load(cache_fd)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            TypeError, AttributeError, ImportError):
+        return None
+    if cached_digest != digest or not isinstance(yml, dict) or not isinstance(config, ProjectConfig):
+        return None
+    return yml, config
+
+def _write_cache(cache_dir, filename, digest, yml, config):
+    ''' Write the configuration atomically to the cache
+
+    Replaces the previous cache file of the configuration file. Failures are
+    logged but ignored as the cache is only an optimization.
+    '''
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        if not _trusted(cache_dir, os.stat(cache_dir)):
+            return
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, prefix='.config-')
+        try:
+            with os.fdopen(fd, 'wb') as cache_fd:
+                pickle.dump((digest, yml, config), cache_fd, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_name, _cache_file(cache_dir, filename))
+        except:
+            os.unlink(tmp_name)
+            raise
+    except (OSError, pickle.PicklingError) as exception:
+        logging.debug('Could not cache configuration in %s: %s', cache_dir, exception)
+
+def load(filename, cache_dir=None):
+    ''' Load and compile a project configuration file
+
+    The compiled configuration is cached in "cache_dir" together with the
+    SHA-256 hash of the file's content. Subsequent calls for an unchanged file
+    return the cached configuration without parsing the YAML file. The cache
+    is ignored unless "cache_dir" and the cache file are owned by the
+    effective user and not writable by the group or others.
+
+    :param filename: Path to the YAML configuration file
+    :param cache_dir: Directory for cache files, caching is disabled if None
+    :returns: Tuple (yml, ProjectConfig) where yml is the parsed YAML file
+    :raises: OSError if the file cannot be read, yaml.YAMLError if the file
+             cannot be parsed
+    '''
+    with open(filename, 'rb') as yaml_fd:
+        content = yaml_fd.read()
+    digest = hashlib.sha256(('%d:' % MODEL_VERSION).encode() + content).hexdigest()
+
+    if cache_dir:
+        cached = _read_cache(cache_dir, filename, digest)
+        if cached:
+            logging.debug('Using cached configuration: %s', _cache_file(cache_dir, filename))
+            return cached
+
+    yml = yaml.load(content, Loader=YamlLoader)
+    if yml is None:
+        yml = {}
+    if not isinstance(yml, dict):
+        raise TypeError('Invalid configuration, top-level element must be a map: %s' % filename)
+    config = ProjectConfig.compile(yml)
+    if cache_dir:
+        _write_cache(cache_dir, filename, digest, yml, config)
+    return yml, config
@@ -2,10 +2,10 @@
 This module provides an extended lxc container class.
 '''
 
+import errno
 import logging
 import os
 import re
-import shutil
 import time
 from collections import OrderedDict
 from functools import wraps
@@ -13,18 +13,26 @@ from functools import wraps
 import iptc
 import locker.project
 import lxc
-import netaddr
 from colorama import Fore
+from locker.config import CloneSpec, ContainerConfig
 from locker.etchosts import Hosts
-from locker.network import Network
-from locker.util import (regex_cgroup, regex_container_name, regex_link,
-                         regex_ports, regex_volumes, rule_to_str)
+from locker.fastcopy import copy_file, copy_metadata, copy_tree, move_tree
+from locker.managed import ManagedFiles
+from locker.network import Network, synchronized_netfilter
+from locker.state import ContainerState, StateStore, links_from_hosts
+from locker.util import regex_container_name, rule_to_str
 
 
 class CommandFailed(RuntimeError):
     ''' Generic command failed RuntimeError '''
     pass
 
+# seconds between the checks whether containers stopped, see stop_containers()
+STOP_POLL_INTERVAL = 0.1
+
+# backing stores of snapshot clones, lxc.rootfs = "TYPE:LOWER:UPPER"
+LAYERED_STORES = ['overlayfs', 'overlay', 'aufs']
+
 def return_if_not_defined(func):
     ''' Return if the container has not been defined '''
     @wraps(func)
@@ -58,6 +66,57 @@ def return_if_not_running(func):
             return func(*args, **kwargs)
     return return_if_not_running_wrapper
 
+def stop_containers(containers, timeout, interval=STOP_POLL_INTERVAL):
+    ''' Stop containers in parallel with a common deadline
+
+    The shutdown of all containers is requested at once. The containers that
+    did not shut down when the deadline expires are killed. The time each
+    container needed to stop is logged.
+
+    :param containers: List of containers, not running ones are skipped
+    :param timeout: Seconds until the deadline
+    :param interval: Seconds between the checks whether containers stopped
+    :returns: List of tuples (container, seconds until stopped, True if
+              killed) of the stopped containers, the containers that could
+              not be stopped are missing
+    '''
+    begin = time.time()
+    deadline = begin + timeout
+    pending = list()
+    for container in containers:
+        try:
+            if container.request_stop():
+                pending.append(container)
+        except CommandFailed:
+            pass
+    latencies = dict()
+    while pending:
+        for container in pending:
+            if container.name not in latencies and not container.running:
+                latencies[container.name] = time.time() - begin
+        now = time.time()
+        if len(latencies) == len(pending) or now >= deadline:
+            break
+        time.sleep(min(interval, deadline - now))
+
+    stopped = list()
+    for container in pending:
+        killed = container.name not in latencies
+        try:
+            container.finish_stop()
+        except CommandFailed:
+            continue
+        latency = latencies.get(container.name, time.time() - begin)
+        if killed:
+            container.logger.warning('Killed after %.2fs', latency)
+        else:
+            container.logger.info('Stopped after %.2fs', latency)
+        stopped.append((container, latency, killed))
+    if pending:
+        logging.info('Stopped %d of %d containers in %.2fs, %d killed', len(stopped), len(pending),
+                     time.time() - begin, len([1 for _con, _lat, killed in stopped if killed]))
+    return stopped
+
 class Container(lxc.Container):
     ''' Extended lxc.Container class
 
@@ -68,18 +127,26 @@ class Container(lxc.Container):
       - Handling of project specifc parameters
     '''
 
-    def __init__(self, name, yml, project, color='', config_path=None):
+    def __init__(self, name, yml, project, color='', config_path=None, config=None):
         ''' Init instance with custom property values and init base class
 
         :param name: Name of the container
+        :param yml: YAML configuration of the container
         :param project: Project instance of this container
         :param color: ASCII color escape sequence for log messages
         :param config_path: Path to the container's config file
+        :param config: Compiled configuration (ContainerConfig), will be
+                       compiled from yml if None
         '''
         if not re.match(regex_container_name, name):
             raise ValueError('Invalid value for container name: %s' % name)
         self.yml = yml
         self.project = project
+        self._recorded = None
+        self._managed_files = None
+        self._config_changed = False
+        if config is not None:
+            self.config = config
         self.color = color
         self.logger = logging.getLogger(name)
         if self.logger.propagate:
@@ -119,7 +186,8 @@ class Container(lxc.Container):
                 logging.debug('Container does not exist yet or is not accessible: %s', pname)
             color = colors[num % len(colors)] if not project.args.get('no_color', False) else ''
             lxcpath = project.args.get('lxcpath', '/var/lib/lxc')
-            container = Container(pname, yml['containers'][name], project, color, lxcpath)
+            config = project.config.get_container(name)
+            container = Container(pname, yml['containers'][name], project, color, lxcpath, config)
 
             all_containers.append(container)
             if ('containers' in project.args and # required for cleanup command
@@ -133,7 +201,8 @@ class Container(lxc.Container):
     def _network_conf(self):
         ''' Apply network configuration
 
-        The the container's network configuration in the config file.
+        The the container's network configuration in the config file. The
+        config file is not saved, see _save_config().
         '''
         ip = self.project.network.get_ip(self)
         gateway = self.project.network.gateway
@@ -145,12 +214,10 @@ class Container(lxc.Container):
         #self.network[0].ipv4 = ip
         #self.network[0].ipv4_gateway = gateway
 
-        self.set_config_item('lxc.network.0.link', link)
-        self.set_config_item('lxc.network.0.veth.pair', veth_pair)
-        self.set_config_item('lxc.network.0.ipv4', ip)
-        self.set_config_item('lxc.network.0.ipv4.gateway', gateway)
-
-        self.save_config()
+        self._set_config('lxc.network.0.link', link)
+        self._set_config('lxc.network.0.veth.pair', veth_pair)
+        self._set_config('lxc.network.0.ipv4', ip)
+        self._set_config('lxc.network.0.ipv4.gateway', gateway)
 
     def _get_dns(self):
         ''' Get DNS server configuration as defined in the yml configuration
@@ -169,23 +236,15 @@ class Container(lxc.Container):
         :returns: list of DNS IP addresses (as strings)
         '''
         list_of_dns = list()
-        try:
-            defaults = self.project.yml['defaults']
-        except KeyError:
-            defaults = {}
-        defaults_dns = defaults.get('dns', [])
-        container_dns = self.yml.get('dns', [])
-        dns_list = container_dns + defaults_dns
-        for dns in list(OrderedDict.fromkeys(dns_list)):
+        for dns in self.config.get_invalid('dns'):
+            self.logger.warning('Invalid DNS address specified: %s', dns)
+        for dns in self.config.dns:
             if dns == "$bridge":
                 list_of_dns.append(self.project.network.gateway)
             elif dns == "$copy":
                 list_of_dns.extend(Network.get_dns_from_host())
             else:
-                try:
-                    list_of_dns.append(str(netaddr.IPAddress(dns)))
-                except netaddr.AddrFormatError:
-                    self.logger.warning('Invalid DNS address specified: %s', dns)
+                list_of_dns.append(dns)
         # remove duplicates but keep original order
         return list(OrderedDict.fromkeys(list_of_dns))
 
@@ -195,25 +254,19 @@ class Container(lxc.Container):
 
         Write the specified DNS server IP addresses as name server entries to
         the specified files. Please note that the file will be overwritten but
-        will not be created if missing.
+        will not be created if missing. Files are only written if the entries
+        changed, see locker.managed.
 
         :param dns: List of IPs (as string) to set as name servers
         :param files: List of filenames where to write the name server entries
         '''
         self.logger.debug('Enabling name resolution: %s', dns)
-        assert self.rootfs.startswith(self.project.args.get('lxcpath', '/var/lib/lxc'))
-
-        _files = ['%s/%s' % (self.rootfs, rfile) for rfile in files]
-        for rconf_file in _files:
+        content = ''.join('nameserver %s\n' % server for server in dns) + '\n'
+        for rconf_file in files:
             try:
-                with open(rconf_file, 'w') as rconf:
-                    for server in dns:
-                        self.logger.debug('Adding nameserver: %s (in %s)', server, rconf_file)
-                        rconf.write('nameserver %s\n' % server)
-                    rconf.write('\n')
+                self.managed_files.write(self.rootfs_path(rconf_file, write=True), content)
             except Exception as exception:
                 self.logger.warning('Could not update nameservers in %s: %s', rconf_file, exception)
-            self.logger.debug('Updated: %s', rconf_file)
 
     @return_if_not_defined
     def cgroup(self):
@@ -225,30 +278,80 @@ class Container(lxc.Container):
         running and always write the new values to the container's config file.
         '''
         self.logger.info('Setting cgroup configuration')
-        regex = re.compile(regex_cgroup)
+        for cgroup in self.config.get_invalid('cgroup'):
+            self.logger.warning('Malformed cgroup setting: %s', cgroup)
+
+        if self.running:
+            for key, value in self.config.cgroup:
+                if not self.set_cgroup_item(key, value):
+                    self.logger.warning('Was not able to set while running: %s = %s', key, value)
+        self._cgroup_conf()
+        self._save_config()
+        self.recorded.update(cgroup=[list(item) for item in self.config.cgroup])
+
+    def _cgroup_conf(self):
+        ''' Set the cgroup configuration in the config file
+
+        The config file is not saved, see _save_config().
+        '''
+        for key, value in self.config.cgroup:
+            if not self._set_config('lxc.cgroup.' + key, value):
+                self.logger.warning('Was not able to set in config: %s = %s', key, value)
+
+    def _console_conf(self):
+        ''' Log the console output to a file if enabled, see console_log
+
+        The size of the file is limited via lxc.console.size and it is
+        rotated via lxc.console.rotate if supported by liblxc (>= 3.0).
+        Otherwise the file grows until it is rotated, e.g., by logrotate with
+        "copytruncate". The log file is removed from the config if the
+        console log is disabled.
 
+        The config file is not saved, see _save_config().
+        '''
+        size = self.config.console_log
+        if size is None:
+            if self.get_config_item('lxc.console.logfile') in [self.console_log, [self.console_log]]:
+                self.clear_config_item('lxc.console.logfile')
+                self._config_changed = True
+            return
+        if not self._set_config('lxc.console.logfile', self.console_log):
+            self.logger.warning('Was not able to set in config: lxc.console.logfile = %s', self.console_log)
+            return
         try:
-            defaults = self.project.yml['defaults']
+            limited = (self._set_config('lxc.console.size', str(size)) and
+                       self._set_config('lxc.console.rotate', '1' if size else '0'))
         except KeyError:
-            defaults = {}
-        defaults_cgroup = defaults.get('cgroup', [])
-        container_cgroup = self.yml.get('cgroup', [])
-        cgroup_items = dict()
-        for cgroup in defaults_cgroup + container_cgroup: # defaults go first
-            match = regex.match(cgroup)
-            if not match:
-                self.logger.warning('Malformed cgroup setting: %s', cgroup)
-                continue
-            key = match.group(1)
-            value = match.group(2)
-            cgroup_items[key] = value # will overwrite defaults
-
-        for key, value in cgroup_items.items():
-            if self.running and not self.set_cgroup_item(key, value):
-                self.logger.warning('Was not able to set while running: %s = %s', key, value)
-            elif not self.set_config_item('lxc.cgroup.' + key, value):
-                self.logger.warning('Was not able to set in config: %s = %s', key, value)
+            limited = False
+        if not limited and size:
+            self.logger.info('Console log size cannot be limited by this lxc version, rotate it instead: %s',
+                             self.console_log)
+
+    def _set_config(self, key, value):
+        ''' Set a config item if its value differs
+
+        The change is not saved, see _save_config().
+
+        :param key: Key of the config item
+        :param value: New value as string
+        :returns: True on success, False if the value could not be set
+        '''
+        current = self.get_config_item(key)
+        if current == value or current == [value]:
+            return True
+        if not self.set_config_item(key, value):
+            return False
+        self._config_changed = True
+        return True
+
+    def _save_config(self):
+        ''' Save the config file if items have been changed by _set_config()
+        '''
+        if not self._config_changed:
+            self.logger.debug('Config file is unchanged')
+            return
         self.save_config()
+        self._config_changed = False
 
     @return_if_not_defined
     @return_if_not_running
@@ -300,6 +403,28 @@ class Container(lxc.Container):
         if not isinstance(value, dict):
             raise TypeError('Invalid type for value: %s' % type(value))
         self._yml = value
+        self._config = None
+
+    @property
+    def config(self):
+        ''' Get the compiled configuration
+
+        The configuration is compiled from the YAML configuration and the
+        project's defaults on first access if it has not been provided.
+        '''
+        if self._config is None:
+            try:
+                defaults = self.project.yml['defaults']
+            except KeyError:
+                defaults = {}
+            self._config = ContainerConfig.compile(self.name.split('_')[1], self.yml, defaults)
+        return self._config
+
+    @config.setter
+    def config(self, value):
+        if not isinstance(value, ContainerConfig):
+            raise TypeError('Invalid type for property config: %s, required type = %s' % (type(value), type(ContainerConfig)))
+        self._config = value
 
     @property
     def logger(self):
@@ -311,6 +436,34 @@ class Container(lxc.Container):
             raise TypeError('Invalid type for property logger: %s, required type = %s' % (type(value), type(logging.Logger)))
         self._logger = value
 
+    @property
+    def recorded(self):
+        ''' Recorded state of the container, see locker.state '''
+        if self._recorded is None:
+            self._recorded = ContainerState(StateStore.open(self.get_config_path()),
+                                            self.name, self.logger)
+        return self._recorded
+
+    def refresh(self):
+        ''' Read the recorded state again on next access, see Project.select()
+        '''
+        if self._recorded is not None:
+            self._recorded.invalidate()
+
+    @property
+    def managed_files(self):
+        ''' Files written by Locker, see locker.managed '''
+        if self._managed_files is None:
+            self._managed_files = ManagedFiles(self.recorded, self.logger)
+        return self._managed_files
+
+    @property
+    def console_log(self):
+        ''' Path of the file the console output is logged to if "console_log"
+        is enabled, see locker.logs
+        '''
+        return os.path.join(self.get_config_path(), self.name, 'console.log')
+
     @property
     def rootfs(self):
         rootfs = self.get_config_item('lxc.rootfs')
@@ -318,6 +471,70 @@ class Container(lxc.Container):
             raise ValueError('rootfs is empty, container defined = %s', self.defined)
         return rootfs
 
+    def _rootfs_layers(self):
+        ''' Get the host directories of the root file system
+
+        :returns: List of directories, the upper (delta) directory first and
+                  the shared lower directory second for stopped snapshot
+                  clones, else a single directory
+        :raises: ValueError if the root file system is not accessible
+        '''
+        rootfs = self.rootfs
+        kind, location = rootfs.split(':', 1) if ':' in rootfs else ('dir', rootfs)
+        if kind == 'dir' and os.path.isdir(location):
+            return [location.rstrip('/')]
+        if self.running:
+            return ['/proc/%d/root' % self.init_pid]
+        if kind in LAYERED_STORES and ':' in location:
+            lower, upper = location.rsplit(':', 1)
+            return [upper.rstrip('/'), lower.rstrip('/')]
+        raise ValueError('Root file system is only accessible while the container is running: %s' % rootfs)
+
+    def rootfs_path(self, path, write=False):
+        ''' Get the host path of a path in the container's root file system
+
+        Directories are used as they are. Stopped snapshot clones (overlayfs,
+        aufs) are accessed via their delta directory: paths that only exist
+        in the shared lower directory are read from there or, if "write" is
+        set, are copied up into the delta directory first, so that the origin
+        is never modified. Other backing stores and running snapshot clones
+        are accessed via /proc/<pid>/root.
+
+        :param path: Absolute path in the container, e.g., "/etc/hosts"
+        :param write: The file will be modified, parent directories that only
+                      exist in the lower directory are created in the delta
+                      directory
+        :returns: Path on the host
+        :raises: ValueError if the root file system is not accessible
+        :raises: FileNotFoundError if "write" is set and the parent directory
+                 does not exist in any layer
+        '''
+        path = '/' + path.lstrip('/')
+        layers = self._rootfs_layers()
+        upper = layers[0] + path
+        lower = next((layer + path for layer in layers[1:] if os.path.lexists(layer + path)), None)
+        if not write:
+            return upper if os.path.lexists(upper) or lower is None else lower
+        parent = '/'
+        for part in [part for part in os.path.dirname(path).split('/') if part]:
+            parent = os.path.join(parent, part)
+            if not os.path.isdir(layers[0] + parent):
+                origin = next((layer + parent for layer in layers[1:] if os.path.isdir(layer + parent)), None)
+                if origin is None:
+                    raise FileNotFoundError(errno.ENOENT, 'No such directory in the container', parent)
+                os.mkdir(layers[0] + parent)
+                copy_metadata(origin, layers[0] + parent)
+        if not os.path.lexists(upper) and lower is not None:
+            self.logger.debug('Copying up: %s', path)
+            if os.path.islink(lower):
+                os.symlink(os.readlink(lower), upper)
+            elif os.path.isdir(lower):
+                os.mkdir(upper)
+            else:
+                copy_file(lower, upper)
+            copy_metadata(lower, upper)
+        return upper
+
     @return_if_not_defined
     def start(self):
         ''' Start container
@@ -326,8 +543,12 @@ class Container(lxc.Container):
         - Generation of the fstab file for bind mount support
         - Setting the hostname inside the rootfs
         - Setting the network ocnfiguration in the container's config file
+        - Logging the console output to a file (if enabled)
         - Setting the nameservers in the rootfs
 
+        Files are only written if their content changed and the config file
+        is saved at most once.
+
         :raises: CommandFailed
         '''
         if self.running:
@@ -343,33 +564,121 @@ class Container(lxc.Container):
         self._generate_fstab()
         self._set_hostname()
         self._network_conf()
+        self._cgroup_conf()
+        self._console_conf()
+        self._save_config()
         self._enable_dns(dns=self._get_dns())
+        self.managed_files.commit()
         self.logger.info('Starting container')
         lxc.Container.start(self)
         if not self.running:
             self.logger.critical('Could not start container')
             raise CommandFailed('Could not start container')
+        self.recorded.update(started=self.config.start_digest(), status=self.state)
 
     @return_if_not_defined
     @return_if_not_running
     def stop(self):
         ''' Stop container
 
+        Forces the stop if the container does not shut down within the
+        timeout.
+
         :raises: CommandFailed
         '''
+        self.request_stop()
+        self.wait('STOPPED', self.project.args.get('timeout', 30))
+        self.finish_stop()
+
+    @return_if_not_defined
+    @return_if_not_running
+    def reboot(self, interval=0.2):
+        ''' Reboot the container in place
+
+        liblxc restarts the container's init process with the same
+        configuration, i.e., the static IP address, the bind mounts, and
+        the files in the container stay unchanged. Hence, the netfilter rules
+        and links are kept. Only the port forwarding rules are verified after
+        the container came back and re-added if they do not match.
+
+        :param interval: Seconds between the checks whether the container
+                         came back
+        :raises: CommandFailed
+        '''
+        self.logger.info('Rebooting container')
+        init_pid = self.init_pid
+        begin = time.time()
+        if not lxc.Container.reboot(self):
+            self.logger.error('Could not reboot container')
+            raise CommandFailed('Could not reboot container')
+        deadline = begin + self.project.args.get('timeout', 30)
+        while not self.running or self.init_pid in (-1, init_pid):
+            if time.time() >= deadline:
+                self.logger.critical('Container did not come back after reboot')
+                raise CommandFailed('Container did not come back after reboot')
+            time.sleep(interval)
+        self.logger.info('Rebooted after %.2fs', time.time() - begin)
+        self.recorded.update(status=self.state)
+        self._verify_port_rules()
+
+    def _verify_port_rules(self):
+        ''' Re-add the port forwarding rules if they differ from the recorded
+        ones or do not forward to the container's current IP addresses
+        '''
+        ips = self.get_ips() or []
+        recorded = self.recorded.get('ports', None)
+        if recorded is None:
+            return
+        live = self.get_port_rules(live=True)
+        if (sorted(live) == sorted(self.get_port_rules()) and
+                all(to_ip in ips for _proto, _dst, (to_ip, _port) in live)):
+            self.logger.debug('Port forwarding rules are up to date')
+            return
+        self.logger.warning('Port forwarding rules differ after reboot, re-adding them')
+        self.rmports()
+        self.ports()
+
+    @return_if_not_defined
+    @return_if_not_running
+    def request_stop(self):
+        ''' Request the shutdown of the container without waiting
+
+        Removes the links to the container and signals its init system to
+        shut down, see finish_stop().
+
+        :returns: True if the shutdown was requested, None if the container
+                  is not running
+        '''
         self.logger.info('Stopping container')
         self.rmlinks()
-        if not self.shutdown(self.project.args.get('timeout', 30)):
+        # a timeout of 0 does not wait for the shutdown
+        lxc.Container.shutdown(self, 0)
+        return True
+
+    @return_if_not_defined
+    def finish_stop(self):
+        ''' Complete the stop requested by request_stop()
+
+        Kills the processes of the container if it is still running.
+
+        :raises: CommandFailed
+        '''
+        if self.running:
             self.logger.warning('Could not shutdown, forcing stop')
             lxc.Container.stop(self)
         if self.running:
             self.logger.critical('Could not stop container')
             raise CommandFailed('Could not stop container')
+        self.recorded.update(status=self.state)
 
     @return_if_defined
-    def create(self):
+    def create(self, base=None):
         ''' Create container based on template or as clone
 
+        :param base: Name of a cached base container that has been created
+                     with the same template configuration, the container is
+                     then cloned (as snapshot if possible) from the base
+                     instead of running the template
         :raises: CommandFailed
         '''
 
@@ -390,7 +699,7 @@ class Container(lxc.Container):
                 raise CommandFailed('Creation failed from template: %s' % self.yml['template']['name'])
             self._move_dirs()
 
-        def _clone_from_existing(self):
+        def _clone_from_existing(self, spec):
             ''' Clone container from an existing container
 
             This method is a little "awkward" because this container (self) will
@@ -400,16 +709,25 @@ class Container(lxc.Container):
             multiple lxc.Container instances for the same lxc container.
             As the clone is only of type lxc.Container and not locker.Container,
             we will use this container instance (self) for further actions.
+
+            The clone strategies returned by _clone_strategies() are tried
+            in order until one succeeds, i.e., a failing snapshot clone falls
+            back to a full copy of the root file system.
             '''
-            clone = self.yml['clone']
-            self.logger.debug('Config patch: %s', self.project.args.get('lxcpath', '/var/lib/lxc'))
-            if clone not in lxc.list_containers(config_path=self.project.args.get('lxcpath', '/var/lib/lxc')):
-                self.logger.error('Cannot clone, container does not exist or is not accessible: %s', clone)
-                raise ValueError('Cannot clone, container does not exist or is not accessible: %s' % clone)
-            origin = lxc.Container(clone, self.project.args.get('lxcpath', '/var/lib/lxc'))
+            lxcpath = self.project.args.get('lxcpath', '/var/lib/lxc')
+            self.logger.debug('Config patch: %s', lxcpath)
+            if spec.origin not in lxc.list_containers(config_path=lxcpath):
+                self.logger.error('Cannot clone, container does not exist or is not accessible: %s', spec.origin)
+                raise ValueError('Cannot clone, container does not exist or is not accessible: %s' % spec.origin)
+            origin = lxc.Container(spec.origin, lxcpath)
             assert origin.defined
-            self.logger.info('Cloning from: %s', origin.name)
-            cloned = origin.clone(self.name, config_path=self.project.args.get('lxcpath', '/var/lib/lxc'))
+            cloned = None
+            for strategy, flags, bdevtype in Container._clone_strategies(spec):
+                self.logger.info('Cloning from: %s (%s)', origin.name, strategy)
+                cloned = origin.clone(self.name, config_path=lxcpath, flags=flags, bdevtype=bdevtype)
+                if cloned and cloned.defined:
+                    break
+                self.logger.warning('Cloning failed with strategy: %s', strategy)
             if not cloned or not cloned.defined:
                 self.logger.error('Cloning failed from: %s', origin.name)
                 raise CommandFailed('Cloning failed from: %s' % origin.name)
@@ -451,13 +769,68 @@ class Container(lxc.Container):
             self.logger.error('You must provide either "template", "clone", or "download" in the container configuration')
             raise ValueError('You must provide either "template", "clone", or "download" in the container configuration')
 
-        if 'template' in self.yml:
+        if 'template' in self.yml and base:
+            _clone_from_existing(self, CloneSpec(base, True, None))
+        elif 'template' in self.yml:
             _create_from_template(self)
         elif 'clone' in self.yml:
-            _clone_from_existing(self)
+            _clone_from_existing(self, self.config.clone)
         else:
             _download(self)
 
+    @staticmethod
+    def _clone_strategies(spec):
+        ''' Get the clone strategies in the order they should be tried
+
+        Snapshot clones are tried first if enabled, first with the specified
+        backing store and then with the backing store lxc selects for the
+        origin (e.g. overlayfs for directory based containers). The last
+        resort is always a full copy of the root file system.
+
+        :param spec: Clone configuration (locker.config.CloneSpec)
+        :returns: List of tuples (description, clone flags, bdevtype)
+        '''
+        strategies = list()
+        backingstore = spec.backingstore
+        if spec.snapshot:
+            if backingstore:
+                strategies.append(('snapshot, %s' % backingstore, lxc.LXC_CLONE_SNAPSHOT, backingstore))
+                if backingstore == 'overlayfs':
+                    # renamed in lxc 2.0
+                    strategies.append(('snapshot, overlay', lxc.LXC_CLONE_SNAPSHOT, 'overlay'))
+            strategies.append(('snapshot', lxc.LXC_CLONE_SNAPSHOT, None))
+        elif backingstore:
+            strategies.append(('copy, %s' % backingstore, 0, backingstore))
+        strategies.append(('copy', 0, None))
+        return strategies
+
+    @property
+    def backing_store(self):
+        ''' Get the backing store type of the container's root file system
+
+        Snapshot clones based on overlayfs or aufs are reported as such, e.g.,
+        "overlayfs", while the other types are reported as configured by lxc,
+        e.g., "btrfs", or "dir" for plain directories.
+
+        :returns: Backing store type as string or None if not defined
+        '''
+        if not self.defined:
+            return None
+        try:
+            backend = self.get_config_item('lxc.rootfs.backend')
+        except KeyError:
+            backend = ''
+        if isinstance(backend, list):
+            backend = backend[0] if backend else ''
+        if backend and backend not in ['dir']:
+            return backend
+        rootfs = self.rootfs
+        if ':' in rootfs:
+            return rootfs.split(':', 1)[0]
+        if rootfs.startswith('/dev/'):
+            return 'block'
+        return 'dir'
+
     @return_if_not_defined
     def remove(self):
         ''' Destroy container
@@ -483,9 +856,11 @@ class Container(lxc.Container):
             if not lxc.Container.destroy(self):
                 self.logger.error('Container was not deleted')
                 raise CommandFailed('Container was not deleted')
+            self.recorded.replace()
         except CommandFailed:
             raise
 
+    @synchronized_netfilter
     def rmports(self):
         ''' Remove netfilter rules that enable port forwarding
 
@@ -504,7 +879,10 @@ class Container(lxc.Container):
         filter_table = iptc.Table(iptc.Table.FILTER)
         forward_chain = iptc.Chain(filter_table, 'LOCKER_FORWARD')
         Network._delete_if_comment(self.name, filter_table, forward_chain)
+        if self.defined:
+            self.recorded.update(ports=[])
 
+    @synchronized_netfilter
     def _has_netfilter_rules(self):
         ''' Check if there are any netfilter rules for this container
 
@@ -525,30 +903,30 @@ class Container(lxc.Container):
         chain in the FILTER table
 
         :param container_ip: IP addresss of the container
-        :param port_conf: dictionary with parsed port configuration
+        :param port_conf: parsed port configuration (locker.config.PortRule)
         :param locker_chain: LOCKER chain in the NAT table
         :param forward_chain: FORWARD chain in the FILTER table
         '''
         locker_rule = iptc.Rule()
-        locker_rule.protocol = port_conf['proto']
-        if port_conf['host_ip']:
-            locker_rule.dst = port_conf['host_ip']
+        locker_rule.protocol = port_conf.proto
+        if port_conf.host_ip:
+            locker_rule.dst = port_conf.host_ip
         locker_rule.in_interface = '!%s' % self.project.network.bridge_ifname
-        tcp_match = locker_rule.create_match(port_conf['proto'])
-        tcp_match.dport = port_conf['host_port']
+        tcp_match = locker_rule.create_match(port_conf.proto)
+        tcp_match.dport = port_conf.host_port
         comment_match = locker_rule.create_match('comment')
         comment_match.comment = self.name
         target = locker_rule.create_target('DNAT')
-        target.to_destination = '%s:%s' % (container_ip, port_conf['container_port'])
+        target.to_destination = '%s:%s' % (container_ip, port_conf.container_port)
         locker_chain.insert_rule(locker_rule)
 
         forward_rule = iptc.Rule()
-        forward_rule.protocol = port_conf['proto']
+        forward_rule.protocol = port_conf.proto
         forward_rule.dst = container_ip
         forward_rule.in_interface = '!%s' % self.project.network.bridge_ifname
         forward_rule.out_interface = self.project.network.bridge_ifname
-        tcp_match = forward_rule.create_match(port_conf['proto'])
-        tcp_match.dport = port_conf['container_port']
+        tcp_match = forward_rule.create_match(port_conf.proto)
+        tcp_match.dport = port_conf.container_port
         comment_match = forward_rule.create_match('comment')
         comment_match.comment = self.name
         forward_rule.create_target('ACCEPT')
@@ -556,6 +934,7 @@ class Container(lxc.Container):
 
     @return_if_not_defined
     @return_if_not_running
+    @synchronized_netfilter
     def ports(self, indirect=False):
         ''' Add netfilter rules to enable port forwarding
 
@@ -564,23 +943,12 @@ class Container(lxc.Container):
                           is usualy desired when ports() is indirectly called
                           via the "start" command.
         '''
-        def _parse_port_conf(self, fwport):
-            ''' Split port forward directive in parts
-
-            :param fwport: Port forwarding configuration
-            :raises: ValueError if fwport is invalid
-            '''
-            regex = re.compile(regex_ports)
-            match = regex.match(fwport)
-            if not match:
-                raise ValueError('Invalid port forwarding directive: %s', fwport)
-            mdict = match.groupdict()
-            mdict['proto'] = mdict['proto_udp'] or 'tcp'
-            return mdict
-
         self.logger.info('Adding port forwarding rules')
-        if not 'ports' in self.yml:
+        for fwport in self.config.get_invalid('ports'):
+            self.logger.warning('Invalid port forwarding directive: %s', fwport)
+        if not self.config.ports:
             self.logger.debug('No port forwarding rules found')
+            self.recorded.update(ports=[])
             return
 
         locker_nat_chain = iptc.Chain(iptc.Table(iptc.Table.NAT), 'LOCKER_PREROUTING')
@@ -590,13 +958,13 @@ class Container(lxc.Container):
                 self.logger.warning('Existing netfilter rules found - must be removed first')
             return
 
-        for fwport in self.yml['ports']:
-            try:
-                port_conf = _parse_port_conf(self, fwport)
-            except ValueError:
-                continue
+        applied = list()
+        for port_conf in self.config.ports:
             for container_ip in self.get_ips():
                 self._add_port_rules(container_ip, port_conf, locker_nat_chain, filter_forward)
+                dst = '%s/255.255.255.255' % port_conf.host_ip if port_conf.host_ip else '0.0.0.0/0.0.0.0'
+                applied.append([port_conf.proto, dst, port_conf.host_port, container_ip, port_conf.container_port])
+        self.recorded.update(ports=applied)
 
     def _set_hostname(self):
         ''' Set container hostname
@@ -604,22 +972,20 @@ class Container(lxc.Container):
         Sets the container's hostname and FQDN in /etc/hosts and /etc/hostname if
         fqdn is specified in the YAML configuration.
         '''
-        fqdn = self.yml.get('fqdn', None)
+        fqdn = self.config.fqdn
         if not fqdn:
             self.logger.debug('Empty fqdn')
             return
         hostname = fqdn.split('.')[0]
-        etc_hosts = '%s/etc/hosts' % (self.rootfs)
         try:
-            hosts = Hosts(etc_hosts, self.logger)
+            hosts = Hosts(self.rootfs_path('/etc/hosts', write=True), self.logger)
             names = [fqdn, hostname]
             hosts.update_ip('127.0.1.1', names)
             hosts.save()
         except:
             pass
-        etc_hostname = '%s/etc/hostname' % (self.rootfs)
-        with open(etc_hostname, 'w+') as hostname_fd:
-            hostname_fd.write('%s\d' % hostname)
+        etc_hostname = self.rootfs_path('/etc/hostname', write=True)
+        self.managed_files.write(etc_hostname, '%s\n' % hostname)
 
     @return_if_not_defined
     def _generate_fstab(self):
@@ -634,28 +1000,32 @@ class Container(lxc.Container):
         if not fstab_file:
             fstab_file = os.path.join(*[self.get_config_path(), self.name, 'fstab'])
         self.logger.debug('Generating fstab: %s', fstab_file)
-        with open(fstab_file, 'w+') as fstab:
-            if 'volumes' in self.yml:
-                regex = re.compile(regex_volumes)
-                for volume in self.yml['volumes']:
-                    match = regex.match(volume)
-                    if not match:
-                        logging.warning('Invalid volume specification: %s', volume)
-                        continue
-                    remote = locker.util.expand_vars(match.group(1), self)
-                    mountpt = locker.util.expand_vars(match.group(2), self)
-                    self.logger.debug('Adding to fstab: %s %s none bind 0 0', remote, mountpt)
-                    fstab.write('%s %s none bind 0 0\n' % (remote, mountpt))
-            fstab.write('\n')
-
-    def get_port_rules(self):
+        for volume in self.config.get_invalid('volumes'):
+            self.logger.warning('Invalid volume specification: %s', volume)
+        lines = list()
+        for volume in self.config.volumes:
+            remote = locker.util.expand_vars(volume.outside, self)
+            mountpt = locker.util.expand_vars(volume.inside, self)
+            self.logger.debug('Adding to fstab: %s %s none bind 0 0', remote, mountpt)
+            lines.append('%s %s none bind 0 0\n' % (remote, mountpt))
+        lines.append('\n')
+        self.managed_files.write(fstab_file, ''.join(lines))
+
+    @synchronized_netfilter
+    def get_port_rules(self, live=False):
         ''' Get port forwarding netfilter rules of the container
 
-        This method only searches the LOCKER chain in the NAT table and ignores
-        the FORWARD chain in the FILTER table!
+        Returns the rules recorded when they were last applied unless "live"
+        is set or no rules were recorded. Otherwise, this method only searches
+        the LOCKER chain in the NAT table and ignores the FORWARD chain in the
+        FILTER table!
 
+        :param live: Always search the netfilter rules
         :returns: list of rules as tuple (protocol, (dst, port), (ip, port))
         '''
+        recorded = None if live or not self.defined else self.recorded.get('ports', None)
+        if recorded is not None:
+            return [(proto, (dst, dport), (to_ip, to_port)) for proto, dst, dport, to_ip, to_port in recorded]
         nat_table = iptc.Table(iptc.Table.NAT)
         locker_nat_chain = iptc.Chain(nat_table, 'LOCKER_PREROUTING')
         dnat_rules = list()
@@ -679,8 +1049,11 @@ class Container(lxc.Container):
         does not exist within the container, it will be created.
 
         This method moves the data from the container to the host to
-        preserve the owner, group, and mode configuration.
-        TODO Is there no way to "cp -ar" with shutil or another module?
+        preserve the owner, group, mode, and extended attributes. Directories
+        are renamed if the container and the host directory are on the same
+        file system, else copied in parallel (see locker.fastcopy).
+        Directories of snapshot clones that are only in the shared lower
+        directory of the root file system are copied instead of moved.
         '''
 
         def _remove_slash(string):
@@ -692,21 +1065,26 @@ class Container(lxc.Container):
         if self.project.args.get('no_move', False):
             self.logger.debug('Skipping moving of directories from container to host system')
             return
-        if 'volumes' not in self.yml:
+        if not self.config.volumes:
             self.logger.debug('No volumes defined')
             return
 
-        rootfs = self.rootfs
-        for volume in self.yml['volumes']:
-            # TODO Use regex!
-            outside, inside = [_remove_slash(locker.util.expand_vars(s.strip(), self)) for s in volume.split(':')]
+        try:
+            upper = self._rootfs_layers()[0]
+        except ValueError as exception:
+            self.logger.error('Cannot move directories: %s', exception)
+            return
+        for volume in self.config.volumes:
+            outside = _remove_slash(locker.util.expand_vars(volume.outside.strip(), self))
+            inside = '/' + _remove_slash(locker.util.expand_vars(volume.inside.strip(), self))
             outside_parent = os.path.dirname(outside)
+            source = self.rootfs_path(inside)
 
             if os.path.exists(outside):
                 self.logger.warning('Directory exists on host system, skipping: %s', outside)
                 continue
-            if os.path.isfile(rootfs+inside):
-                self.logger.warning('Files are not supported, skipping: %s', rootfs+inside)
+            if os.path.isfile(source):
+                self.logger.warning('Files are not supported, skipping: %s', source)
                 continue
 
             if not os.path.exists(outside_parent):
@@ -718,20 +1096,28 @@ class Container(lxc.Container):
                 else:
                     self.logger.debug('Created parent directory on host system: %s', outside_parent)
 
-            if os.path.isdir(rootfs+inside):
+            if os.path.isdir(source):
                 # Move should preseve owner and group,
                 # recreate dir afterwards in container again as mount point
-                self.logger.debug('Moving directory: %s -> %s', rootfs+inside, outside)
+                # the origin of a snapshot clone must not be changed
+                transfer = move_tree if source == upper + inside else copy_tree
+                self.logger.debug('%s directory: %s -> %s',
+                                  'Moving' if transfer is move_tree else 'Copying', source, outside)
                 try:
-                    shutil.move(rootfs+inside, outside)
-                except shutil.Error as error:
+                    stats = transfer(source, outside,
+                                     workers=self.project.args.get('copy_workers', 4),
+                                     logger=self.logger)
+                except OSError as error:
                     self.logger.error('Could not move directory: %s', error)
                     continue
+                self.logger.info('Moved directory %s (%s)', outside, stats)
 
                 try:
-                    os.mkdir(rootfs+inside)
+                    mount_point = self.rootfs_path(inside, write=True)
+                    if not os.path.isdir(mount_point):
+                        os.mkdir(mount_point)
                 except OSError:
-                    self.logger.error('Could not create directory in the container: %s', rootfs+inside)
+                    self.logger.error('Could not create directory in the container: %s', inside)
                     continue
                 continue
 
@@ -744,37 +1130,38 @@ class Container(lxc.Container):
                 self.logger.info('Created empty on host system: %s', outside)
 
             try:
-                os.makedirs(rootfs+inside)
+                os.makedirs(upper+inside)
             except OSError:
-                self.logger.error('Could not create directory in the container: %s', rootfs+inside)
+                self.logger.error('Could not create directory in the container: %s', inside)
                 continue
             else:
-                self.logger.info('Created empty directory in the container: %s', rootfs+inside)
+                self.logger.info('Created empty directory in the container: %s', inside)
 
     @return_if_not_defined
-    def links(self, auto_update=False):
+    def links(self, auto_update=False, exclude=()):
         ''' Link container with other containers
 
         Links the container to any other container that is specified in the
-        particular "links" subtree in YAML file.
+        particular "links" subtree in YAML file. The names are added to the
+        container's /etc/hosts unless they are resolved by the project's DNS
+        responder ("dns_links" argument).
 
         :param auto_update: Set to True to suppress some logger output because
                             the container to link to is purposely stopped and
                             unavailable.
+        :param exclude: Names (without project prefix) of containers that must
+                        not be linked to, e.g., because they are not ready
         '''
         self.logger.info('Updating links')
-        if not 'links' in self.yml:
+        for link in self.config.get_invalid('links'):
+            self.logger.error('Invalid link statement: %s', link)
+        if not self.config.links:
             self.logger.debug('No links defined')
+            self.recorded.update(links=[])
             return
-        link_regex = re.compile(regex_link)
         hosts_entries = list()
-        for link in self.yml['links']:
-            match = link_regex.match(link)
-            if not match:
-                self.logger.error('Invalid link statement: %s', link)
-                continue
-            group_dict = match.groupdict()
-            name = group_dict['name']
+        for link in self.config.links:
+            name = link.name
             container = self.project.get_container(name)
             if not container:
                 self.logger.error('Cannot link with unavailable container: %s', name)
@@ -787,11 +1174,17 @@ class Container(lxc.Container):
                 else:
                     self.logger.warning('Cannot link with stopped container: %s', name)
                 continue
-            names = [container.yml.get('fqdn', None), name, group_dict.get('alias', None)]
+            if name in exclude:
+                self.logger.warning('Cannot link with container that is not ready: %s', name)
+                continue
+            names = [container.config.fqdn, name, link.alias]
             names = [x for x in names if x]
             hosts_entries.extend([(ip, name, names) for ip in container.get_ips()])
-        self._update_etc_hosts(hosts_entries)
+        if not self.project.args.get('dns_links', False):
+            self._update_etc_hosts(hosts_entries)
         self._update_link_rules(hosts_entries)
+        linked = OrderedDict.fromkeys(name for _ip, name, _names in hosts_entries)
+        self.recorded.update(links=list(linked))
 
     @return_if_not_defined
     @return_if_not_running
@@ -808,6 +1201,7 @@ class Container(lxc.Container):
             self.logger.warning('Could not unfreeze')
 
     @return_if_not_running
+    @synchronized_netfilter
     def _add_link_rules(self, entries):
         ''' Add netfilter rules to enable communication between containers
 
@@ -848,6 +1242,7 @@ class Container(lxc.Container):
                 rule.create_target('ACCEPT')
                 forward_chain.insert_rule(rule)
 
+    @synchronized_netfilter
     def _remove_link_rules(self):
         ''' Remove netfilter rules required for link support '''
         filter_table = iptc.Table(iptc.Table.FILTER)
@@ -874,10 +1269,9 @@ class Container(lxc.Container):
 
         :params: List of entries to add, format (ipaddr, container name, names)
         '''
-        etc_hosts = '%s/etc/hosts' % (self.rootfs)
         try:
-            hosts = Hosts(etc_hosts, self.logger)
-            hosts.remove_by_comment('^%s_.*$' % self.project.name)
+            hosts = Hosts(self.rootfs_path('/etc/hosts', write=True), self.logger)
+            hosts.remove_by_comment_prefix(self.project.name)
             for ipaddr, name, names in entries:
                 comment = '%s_%s' % (self.project.name, name)
                 hosts.add(ipaddr, names, comment)
@@ -891,32 +1285,54 @@ class Container(lxc.Container):
         self.logger.info('Removing links')
         self._update_etc_hosts([])
         self._remove_link_rules()
+        if self.defined:
+            self.recorded.update(links=[])
 
     @return_if_not_defined
     def linked_to(self):
-        ''' Return list of linked containers based on /etc/hosts
+        ''' Return list of linked containers
 
         Does not evaluate the YAML configuration but the actual state of the
-        container.
+        container, i.e., the links recorded when they were last applied. Falls
+        back to parsing the container's /etc/hosts if no links were recorded.
         TODO Does not yet check netfilter rules
 
         :returns: List of linked containers
         '''
-        linked = list()
-        etc_hosts = '%s/etc/hosts' % (self.rootfs)
+        linked = self.recorded.get('links', None)
+        if linked is not None:
+            return list(linked)
         try:
-            with open(etc_hosts, 'r') as etc_hosts_fd:
-                lines = etc_hosts_fd.readlines()
-        except FileNotFoundError:
-            return linked
-
-        # TODO Use a better regex
-        regex = re.compile('^.* # %s_(.+)$' % self.project.name)
-        for line in lines:
-            match = regex.match(line)
-            if match:
-                linked.append(match.group(1))
-        return linked
+            etc_hosts = self.rootfs_path('/etc/hosts')
+        except ValueError as exception:
+            self.logger.debug('Cannot read links: %s', exception)
+            return []
+        return links_from_hosts(etc_hosts, self.project.name)
+
+    @return_if_not_defined
+    def rebuild_state(self):
+        ''' Replace the recorded state by the live state of the container
+
+        Records the state, IP address, port forwarding rules, and links of
+        the container. Values that cannot be derived from the live state, e.g.,
+        the hashes of generated files, are dropped and recorded again when
+        they are applied the next time.
+        '''
+        self.logger.info('Rebuilding recorded state')
+        values = {'status': self.state}
+        ips = self.get_ips(retries=0) if self.running else None
+        if not ips:
+            configured = self.get_config_item('lxc.network.0.ipv4')
+            if isinstance(configured, str):
+                configured = [configured]
+            ips = [ip.split('/')[0] for ip in configured if ip]
+        if ips:
+            values['ip'] = ips[0]
+        values['ports'] = [[proto, dst, dport, to_ip, to_port]
+                           for proto, (dst, dport), (to_ip, to_port) in self.get_port_rules(live=True)]
+        if self.running:
+            values['links'] = links_from_hosts(self.rootfs_path('/etc/hosts'), self.project.name)
+        self.recorded.replace(**values)
 
     def get_cgroup_item(self, key):
         ''' Get cgroup item
@@ -0,0 +1,319 @@
+'''
+This module provides the Locker daemon and its client.
+
+The daemon keeps the projects, i.e., the parsed configuration, the container
+instances, and the network (including a shared netlink session), between
+commands and executes the commands of the command line interface sent over a
+Unix socket. Only root and the user running the daemon may connect, which is
+checked by the peer credentials of the socket.
+
+The protocol is line based JSON: the client sends one request with the parsed
+command line arguments, e.g., {"args": {"command": "start", ...}}, and the
+daemon answers with any number of messages containing the output of the
+command, e.g., {"stdout": "..."} or {"stderr": "..."}, followed by the exit
+code, e.g., {"exit": 0}.
+'''
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+import locker.network
+
+SOCKET = '/run/locker/lockerd.sock'
+
+# maximum size of a request in bytes
+MAX_REQUEST = 1024 * 1024
+
+
+class DaemonUnavailable(Exception):
+    ''' No Locker daemon is listening on the socket '''
+    pass
+
+class ProjectCache(object):
+    ''' Projects of previous commands
+
+    A project is reused as long as its configuration file is unchanged, i.e.,
+    its modification time, size, and inode. The recorded state of its
+    containers is read again for each command, see Project.select().
+    '''
+
+    def __init__(self):
+        self._projects = dict()
+
+    @staticmethod
+    def _key(args):
+        return (args['file'], args['project'], args.get('lxcpath', None),
+                args.get('cache_dir', None), args.get('no_validate', False))
+
+    @staticmethod
+    def _stat(filename):
+        fstat = os.stat(filename)
+        return (fstat.st_mtime_ns, fstat.st_size, fstat.st_ino)
+
+    def get(self, args):
+        ''' Get the project for a command
+
+        :param args: Parsed command line arguments of the command
+        :returns: Project instance or None if not cached or outdated
+        :raises: OSError if the configuration file cannot be accessed
+        '''
+        key = ProjectCache._key(args)
+        cached = self._projects.get(key, None)
+        if cached is None:
+            return None
+        if cached[0] != ProjectCache._stat(args['file']):
+            logging.debug('Configuration changed: %s', args['file'])
+            del self._projects[key]
+            return None
+        project = cached[1]
+        project.select(args)
+        return project
+
+    def add(self, args, project):
+        ''' Add the project of a command
+
+        :param args: Parsed command line arguments of the command
+        :param project: Project instance
+        '''
+        self._projects[ProjectCache._key(args)] = (ProjectCache._stat(args['file']), project)
+
+    def clear(self):
+        ''' Remove all projects '''
+        self._projects.clear()
+
+class _Relay(object):
+    ''' Replaces sys.stdout or sys.stderr to send the output of the current
+    command to the client
+
+    The output is written to the original stream if no command is executed.
+    '''
+
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream
+        self.connection = None
+
+    def write(self, data):
+        connection = self.connection
+        if connection is None:
+            return self.stream.write(data)
+        try:
+            connection.sendall((json.dumps({self.name: data}) + '\n').encode())
+        except OSError:
+            # the client is gone, the command is still completed
+            self.connection = None
+        return len(data)
+
+    def flush(self):
+        if self.connection is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+def install_relays():
+    ''' Replace sys.stdout and sys.stderr by relays
+
+    Must be called before any logging handler is created.
+
+    :returns: Tuple of the original streams
+    '''
+    streams = (sys.stdout, sys.stderr)
+    sys.stdout = _Relay('stdout', streams[0])
+    sys.stderr = _Relay('stderr', streams[1])
+    return streams
+
+def peer_uid(connection):
+    ''' Get the user ID of the peer of a Unix socket '''
+    creds = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _pid, uid, _gid = struct.unpack('3i', creds)
+    return uid
+
+class _Handler(socketserver.StreamRequestHandler):
+    ''' Handles the request of a client '''
+
+    def send(self, message):
+        self.connection.sendall((json.dumps(message) + '\n').encode())
+
+    def handle(self):
+        uid = peer_uid(self.connection)
+        if uid not in (0, os.geteuid()):
+            logging.warning('Rejected request of user %d', uid)
+            self.send({'stderr': 'Permission denied\n'})
+            self.send({'exit': 1})
+            return
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST).decode())
+            args = request['args']
+            if not isinstance(args, dict) or 'command' not in args:
+                raise ValueError('Invalid arguments')
+        except (ValueError, KeyError, TypeError) as exception:
+            self.send({'stderr': 'Invalid request: %s\n' % exception})
+            self.send({'exit': 2})
+            return
+        try:
+            self.send({'exit': self.server.execute(args, self.connection)})
+        except OSError as exception:
+            logging.debug('Cannot send exit code: %s', exception)
+
+class Daemon(socketserver.UnixStreamServer):
+    ''' Executes the commands sent by clients one after another
+    '''
+
+    def __init__(self, path=SOCKET, runner=None):
+        ''' Create the socket
+
+        :param path: Path of the socket
+        :param runner: Function that executes a command and returns the exit
+                       code, defaults to locker.cli.run
+        :raises: RuntimeError if another daemon is listening on the socket
+        '''
+        self.projects = ProjectCache()
+        self.runner = runner
+        if os.path.exists(path):
+            try:
+                request_socket(path).close()
+            except DaemonUnavailable:
+                os.unlink(path)
+            else:
+                raise RuntimeError('Another daemon is listening on %s' % path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        os.chmod(path, 0o600)
+
+    def execute(self, args, connection):
+        ''' Execute a command and relay its output to the client
+
+        :param args: Parsed command line arguments
+        :param connection: Socket of the client
+        :returns: Exit code
+        '''
+        if self.runner is None:
+            import locker.cli
+            self.runner = locker.cli.run
+        relays = [s for s in (sys.stdout, sys.stderr) if isinstance(s, _Relay)]
+        for relay in relays:
+            relay.connection = connection
+        level = logging.root.level
+        logging.root.setLevel(logging.DEBUG if args.get('verbose', False) else logging.INFO)
+        try:
+            code = self.runner(args, self.projects)
+        except SystemExit as exception:
+            code = exception.code if isinstance(exception.code, int) else 1
+        except Exception as exception:
+            logging.exception('Command failed: %s', exception)
+            # the projects may be inconsistent
+            self.projects.clear()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for relay in relays:
+                relay.connection = None
+            logging.root.setLevel(level)
+        return code
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+def request_socket(path):
+    ''' Connect to the daemon
+
+    :param path: Path of the socket
+    :returns: Connected socket
+    :raises: DaemonUnavailable
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError, PermissionError) as exception:
+        sock.close()
+        raise DaemonUnavailable('Cannot connect to %s: %s' % (path, exception))
+    return sock
+
+def request(args, path=SOCKET, stdout=None, stderr=None):
+    ''' Execute a command by the daemon
+
+    :param args: Parsed command line arguments, paths must be absolute
+    :param path: Path of the socket
+    :param stdout: Stream for the output of the command, default: sys.stdout
+    :param stderr: Stream for the log of the command, default: sys.stderr
+    :returns: Exit code
+    :raises: DaemonUnavailable if no daemon is listening on the socket
+    '''
+    streams = {'stdout': stdout or sys.stdout, 'stderr': stderr or sys.stderr}
+    sock = request_socket(path)
+    with sock:
+        sock.sendall((json.dumps({'args': args}) + '\n').encode())
+        with sock.makefile('rb') as messages:
+            for line in messages:
+                message = json.loads(line.decode())
+                if 'exit' in message:
+                    return message['exit']
+                for name, stream in streams.items():
+                    if name in message:
+                        stream.write(message[name])
+                        stream.flush()
+    logging.error('Lost connection to the Locker daemon')
+    return 1
+
+def serve(path=SOCKET):
+    ''' Run the daemon until SIGTERM or SIGINT is received
+
+    :param path: Path of the socket
+    '''
+    locker.network.keep_ipdb()
+    # signals are handled by the main thread only
+    signals = [signal.SIGTERM, signal.SIGINT]
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+    daemon = Daemon(path)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    logging.info('Locker daemon listening on %s', path)
+    try:
+        signal.sigwait(signals)
+        logging.info('Stopping Locker daemon')
+    finally:
+        # waits until the current command is completed
+        daemon.shutdown()
+        thread.join()
+        daemon.server_close()
+
+def main(argv=None):
+    ''' The main function of the daemon
+
+    :param argv: List of arguments, defaults to sys.argv[1:]
+    '''
+    parser = argparse.ArgumentParser(description='Locker daemon')
+    parser.add_argument(
+        '--socket', '-S',
+        default=SOCKET,
+        help='Path of the socket (default: %s)' % SOCKET)
+    parser.add_argument(
+        '--verbose', '-v',
+        const=True, default=False, action='store_const',
+        help='Show more output')
+    args = parser.parse_args(argv)
+    install_relays()
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    if not os.geteuid() == 0:
+        logging.fatal('The Locker daemon must be run as root')
+        sys.exit(1)
+    try:
+        serve(args.socket)
+    except (OSError, RuntimeError) as exception:
+        logging.critical('Cannot run Locker daemon: %s', exception)
+        sys.exit(1)
@@ -0,0 +1,397 @@
+'''
+This module provides a lightweight DNS responder for the containers of a
+project.
+
+The responder listens on the project bridge, i.e., it is used by containers
+that have "$bridge" as DNS server, and answers A queries for the names of the
+project's containers and for the aliases of their links from an in-memory
+registry. Link aliases are only visible to the container that defines the
+link, the answer depends on the source address of the query. All other
+queries are forwarded to upstream name servers.
+'''
+
+import asyncio
+import errno
+import fcntl
+import logging
+import os
+import signal
+import socket
+import struct
+
+from locker.network import Network
+
+# resource record types and classes
+TYPE_A = 1
+TYPE_ANY = 255
+CLASS_IN = 1
+
+# response codes
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+
+_FLAG_QR = 0x8000
+_FLAG_AA = 0x0400
+_FLAG_RD = 0x0100
+_FLAG_RA = 0x0080
+_MASK_OPCODE = 0x7800
+
+_header = struct.Struct('!HHHHHH')
+_question = struct.Struct('!HH')
+# answer with a pointer to the name in the question section (offset 12)
+_answer_a = struct.Struct('!HHHIH4s')
+
+RUN_DIR = '/run/locker'
+
+
+class Registry(object):
+    ''' Names and IP addresses of the containers of a project
+
+    Names are case-insensitive and stored without the trailing dot.
+    '''
+
+    def __init__(self):
+        self._names = dict()
+        self._aliases = dict()
+
+    def __len__(self):
+        return len(self._names) + sum(len(aliases) for aliases in self._aliases.values())
+
+    @staticmethod
+    def _normalize(name):
+        return name.rstrip('.').lower()
+
+    def add(self, name, ips, source=None):
+        ''' Add a name
+
+        :param name: Host name
+        :param ips: List of IPv4 addresses as strings
+        :param source: IP address of the only container the name is visible
+                       to, e.g., for link aliases, or None for all containers
+        '''
+        if source is None:
+            names = self._names
+        else:
+            names = self._aliases.setdefault(source, dict())
+        entries = names.setdefault(Registry._normalize(name), list())
+        entries.extend(ip for ip in ips if ip not in entries)
+
+    def resolve(self, name, source=None):
+        ''' Resolve a name
+
+        Names that are only visible to the source have precedence.
+
+        :param name: Host name
+        :param source: IP address of the querying container
+        :returns: List of IPv4 addresses or None if the name is unknown
+        '''
+        name = Registry._normalize(name)
+        if source is not None:
+            ips = self._aliases.get(source, {}).get(name, None)
+            if ips is not None:
+                return ips
+        return self._names.get(name, None)
+
+    @classmethod
+    def from_project(cls, project):
+        ''' Create the registry of the running containers of a project
+
+        Each container is available by its name with and without the project
+        prefix, its FQDN, and the host name part of the FQDN. The names and
+        aliases of links are only visible to the linking container.
+
+        :param project: Project instance
+        :returns: Registry
+        '''
+        registry = cls()
+        running = dict()
+        for container in project.all_containers:
+            if not container.running:
+                continue
+            ips = container.get_ips(retries=0) or []
+            running[container.name] = ips
+            fqdn = container.config.fqdn
+            names = [container.name, container.name.split('_', 1)[1]]
+            if fqdn:
+                names.extend([fqdn, fqdn.split('.')[0]])
+            for name in names:
+                registry.add(name, ips)
+        for container in project.all_containers:
+            sources = running.get(container.name, None)
+            if not sources:
+                continue
+            for link in container.config.links:
+                target = project.get_container(link.name)
+                if not target or not running.get(target.name, None):
+                    continue
+                names = [x for x in [link.name, link.alias] if x]
+                for source in sources:
+                    for name in names:
+                        registry.add(name, running[target.name], source)
+        return registry
+
+def parse_query(data):
+    ''' Parse a DNS query
+
+    :param data: The query packet
+    :returns: Tuple (id, flags, name, qtype, qclass, question) where question
+              is the raw question section
+    :raises: ValueError if the packet is not a valid query with one question
+    '''
+    if len(data) < _header.size:
+        raise ValueError('Packet too short')
+    qid, flags, qdcount, _ancount, _nscount, _arcount = _header.unpack_from(data)
+    if flags & _FLAG_QR:
+        raise ValueError('Packet is not a query')
+    if qdcount != 1:
+        raise ValueError('Unsupported number of questions: %d' % qdcount)
+    labels = list()
+    offset = _header.size
+    while True:
+        if offset >= len(data):
+            raise ValueError('Truncated name')
+        length = data[offset]
+        offset += 1
+        if length == 0:
+            break
+        if length & 0xC0:
+            raise ValueError('Compressed name in question')
+        labels.append(data[offset:offset + length])
+        offset += length
+    if offset + _question.size > len(data):
+        raise ValueError('Truncated question')
+    qtype, qclass = _question.unpack_from(data, offset)
+    offset += _question.size
+    try:
+        name = b'.'.join(labels).decode('ascii')
+    except UnicodeDecodeError:
+        raise ValueError('Invalid name')
+    return qid, flags, name, qtype, qclass, data[_header.size:offset]
+
+def build_response(qid, flags, question, rcode, ips=(), ttl=5, recursion=False):
+    ''' Build a DNS response with A records
+
+    :param qid: ID of the query
+    :param flags: Flags of the query
+    :param question: Raw question section of the query
+    :param rcode: Response code
+    :param ips: List of IPv4 addresses as strings
+    :param ttl: Time to live of the records in seconds
+    :param recursion: Signal that recursion is available
+    :returns: The response packet
+    '''
+    rflags = _FLAG_QR | _FLAG_AA | (flags & (_MASK_OPCODE | _FLAG_RD)) | rcode
+    if recursion:
+        rflags |= _FLAG_RA
+    packet = [_header.pack(qid, rflags, 1 if question else 0, len(ips), 0, 0), question]
+    for ip in ips:
+        packet.append(_answer_a.pack(0xC00C, TYPE_A, CLASS_IN, ttl, 4, socket.inet_aton(ip)))
+    return b''.join(packet)
+
+class _Forwarder(asyncio.DatagramProtocol):
+    ''' Receives the response of an upstream name server '''
+
+    def __init__(self, future):
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exception):
+        if not self.future.done():
+            self.future.set_exception(exception)
+
+class Responder(asyncio.DatagramProtocol):
+    ''' DNS responder for the names in a registry
+
+    Unknown names are forwarded to the upstream name servers if available,
+    else answered with NXDOMAIN.
+    '''
+
+    def __init__(self, registry, upstream=None, ttl=5, timeout=2.0, logger=None,
+                 upstream_port=53):
+        ''' Initialize the responder
+
+        :param registry: Registry instance
+        :param upstream: List of upstream name server IP addresses
+        :param ttl: Time to live of the answers in seconds
+        :param timeout: Timeout of upstream queries in seconds
+        :param logger: Logger for debug output
+        :param upstream_port: Port of the upstream name servers
+        '''
+        self.registry = registry
+        self.upstream = list(upstream or [])
+        self.upstream_port = upstream_port
+        self.ttl = ttl
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def answer(self, data, source=None):
+        ''' Answer a query from the registry
+
+        :param data: The query packet
+        :param source: IP address of the querying container
+        :returns: The response packet, None if the query must be forwarded or
+                  ignored
+        '''
+        try:
+            qid, flags, name, qtype, qclass, question = parse_query(data)
+        except ValueError as exception:
+            self.logger.debug('Invalid DNS query from %s: %s', source, exception)
+            if len(data) < 2:
+                return None
+            return build_response(struct.unpack_from('!H', data)[0], 0, b'', RCODE_FORMERR)
+        if flags & _MASK_OPCODE:
+            return build_response(qid, flags, question, RCODE_NOTIMP)
+        ips = self.registry.resolve(name, source)
+        if ips is None:
+            if self.upstream:
+                return None
+            return build_response(qid, flags, question, RCODE_NXDOMAIN)
+        if qclass != CLASS_IN or qtype not in (TYPE_A, TYPE_ANY):
+            # the name exists but there are no records of the requested type
+            ips = ()
+        return build_response(qid, flags, question, RCODE_NOERROR, ips, self.ttl,
+                              bool(self.upstream))
+
+    def datagram_received(self, data, addr):
+        response = self.answer(data, addr[0])
+        if response is not None:
+            self.transport.sendto(response, addr)
+        elif self.upstream and len(data) >= _header.size:
+            asyncio.ensure_future(self._forward(data, addr))
+
+    async def _forward(self, data, addr):
+        ''' Forward a query to the upstream name servers and relay the answer
+        '''
+        loop = asyncio.get_event_loop()
+        for server in self.upstream:
+            future = loop.create_future()
+            transport = None
+            try:
+                transport, _protocol = await loop.create_datagram_endpoint(
+                    lambda: _Forwarder(future), remote_addr=(server, self.upstream_port))
+                transport.sendto(data)
+                response = await asyncio.wait_for(future, self.timeout)
+                self.transport.sendto(response, addr)
+                return
+            except (OSError, asyncio.TimeoutError) as exception:
+                self.logger.debug('Upstream name server %s failed: %s', server, exception)
+            finally:
+                if transport:
+                    transport.close()
+        qid, flags = struct.unpack_from('!HH', data)
+        self.transport.sendto(build_response(qid, flags, b'', RCODE_SERVFAIL), addr)
+
+def pid_file(project_name, run_dir=RUN_DIR):
+    ''' Path of the PID file of a project's DNS responder
+
+    The responder holds an exclusive lock on the file while it is running.
+    '''
+    return os.path.join(run_dir, '%s.dns.pid' % project_name)
+
+def notify(project_name, run_dir=RUN_DIR):
+    ''' Tell a running DNS responder to reload its registry
+
+    The PID is only signaled if the PID file is locked, i.e., a stale PID
+    file of a responder that did not exit cleanly is ignored as the PID may
+    have been reused by another process.
+
+    :param project_name: Name of the project
+    :param run_dir: Directory of the PID file
+    :returns: True if a responder was notified, else False
+    '''
+    try:
+        with open(pid_file(project_name, run_dir), 'r') as pid_fd:
+            try:
+                fcntl.flock(pid_fd.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pid = int(pid_fd.read().strip())
+            else:
+                logging.debug('Ignoring stale PID file of the DNS responder')
+                return False
+        os.kill(pid, signal.SIGHUP)
+    except (OSError, ValueError):
+        return False
+    logging.debug('Notified DNS responder (PID %d)', pid)
+    return True
+
+def _lock_pid_file(path):
+    ''' Lock the PID file and write the PID of this process into it
+
+    :param path: Path of the PID file
+    :returns: File descriptor of the PID file, closing it releases the lock
+    :raises: OSError, BlockingIOError if another responder is running
+    '''
+    pid_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(pid_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.ftruncate(pid_fd, 0)
+        os.write(pid_fd, b'%d\n' % os.getpid())
+    except OSError:
+        os.close(pid_fd)
+        raise
+    return pid_fd
+
+def serve(project, host=None, port=53, upstream=None, ttl=5, run_dir=RUN_DIR):
+    ''' Run the DNS responder of a project until interrupted
+
+    The registry is rebuilt on SIGHUP, see notify().
+
+    :param project: Project instance
+    :param host: Listen address, defaults to the IP address of the bridge
+    :param port: Listen port
+    :param upstream: List of upstream name servers, None to use the name
+                     servers of the host
+    :param ttl: Time to live of the answers in seconds
+    :param run_dir: Directory of the PID file
+    '''
+    if host is None:
+        host = project.network.gateway
+    if upstream is None:
+        upstream = [dns for dns in Network.get_dns_from_host() if dns != host]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    responder = Responder(Registry.from_project(project), upstream, ttl)
+
+    def _reload():
+        responder.registry = Registry.from_project(project)
+        logging.info('Reloaded DNS registry: %d names', len(responder.registry))
+
+    transport, _protocol = loop.run_until_complete(
+        loop.create_datagram_endpoint(lambda: responder, local_addr=(host, port)))
+    loop.add_signal_handler(signal.SIGHUP, _reload)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    pidfile = pid_file(project.name, run_dir)
+    os.makedirs(run_dir, exist_ok=True)
+    try:
+        pid_fd = _lock_pid_file(pidfile)
+    except BlockingIOError:
+        logging.error('Another DNS responder is running for this project')
+        transport.close()
+        loop.close()
+        return
+    logging.info('DNS responder listening on %s:%d (%d names, upstream: %s)', host, port,
+                 len(responder.registry), ', '.join(upstream) or '-')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+        loop.close()
+        try:
+            os.unlink(pidfile)
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+        finally:
+            os.close(pid_fd)
@@ -1,12 +1,50 @@
 '''
 A parser and manager for the /etc/hosts file
+
+Lines are kept as raw text and are only analyzed when they are queried or
+modified. Lines that were not modified are written back unchanged, i.e., a
+hosts file that is loaded and saved without modifications is byte-for-byte
+identical.
 '''
 
+import errno
+import hashlib
 import logging
+import os
 import re
+import tempfile
+from collections import OrderedDict
 
 import netaddr
-import prettytable
+
+# "Host names may contain only alphanumeric characters, minus signs ("-"),
+# and periods (".").  They must begin with an alphabetic character and
+# end with an alphanumeric character" see "man hosts"
+_REGEX_DISABLED  = r'\s*#+'
+_REGEX_IP        = r'[\da-fA-F\:\.]+'
+_REGEX_NAME      = r'[a-zA-Z\d][a-zA-Z\d\-\.]*[a-zA-Z\d]'
+_REGEX_NAME_LAX  = r'[a-zA-Z\d][a-zA-Z\d\-\.\_]*[a-zA-Z\d]'
+_REGEX_NAMES     = r'(?:' + _REGEX_NAME + r')(?:\s+' + _REGEX_NAME + r')*'
+_REGEX_NAMES_LAX = r'(?:' + _REGEX_NAME_LAX + r')(?:\s+' + _REGEX_NAME_LAX + r')*'
+_REGEX_COMMENT   = r'.*'
+
+_OCTET           = r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+_REGEX_IPV4      = r'(?:' + _OCTET + r'\.){3}' + _OCTET
+
+# compiled once, lines are always parsed in lax mode. Canonical IPv4 addresses
+# are matched separately as they do not need to be normalized by netaddr.
+_regex_entry = re.compile(r'^(?P<disabled>' + _REGEX_DISABLED + r')?\s*(?:(?P<ipv4>' + _REGEX_IPV4 +
+                          r')|(?P<ip>' + _REGEX_IP + r'))\s+(?P<names>' + _REGEX_NAMES_LAX +
+                          r')(?:\s+#+\s*(?P<comment>' + _REGEX_COMMENT + r'))?\s*$')
+_regex_name = re.compile(_REGEX_NAME)
+_regex_ipv4 = re.compile(r'^' + _REGEX_IPV4 + r'$')
+
+# kinds of lines
+_ENTRY = 0
+_DISABLED = 1
+_COMMENT = 2
+_EMPTY = 3
+_INVALID = 4
 
 
 class InvalidLine(Exception):
@@ -18,35 +56,206 @@ class DuplicateIP(ValueError):
 class IPNotFound(ValueError):
     pass
 
+def _ip_key(ip):
+    ''' Get the normalized string representation of an IP address
+
+    Canonical IPv4 addresses are used as they are, everything else is
+    normalized by netaddr, e.g., IPv6 addresses in their compact form.
+
+    :param ip: IP address as string or netaddr.IPAddress
+    :returns: IP address as string
+    :raises: netaddr.AddrFormatError if the IP address is invalid
+    '''
+    if isinstance(ip, str) and _regex_ipv4.match(ip):
+        return ip
+    return str(netaddr.IPAddress(ip))
+
+def write_atomically(filename, content):
+    ''' Replace a file by a temporary file with the new content
+
+    Owner, group, and mode of an existing file are kept. If the file cannot be
+    replaced, e.g., because it is a bind mount, it is overwritten in place.
+
+    :param filename: Destination file
+    :param content: Content as bytes
+    '''
+    try:
+        fstat = os.stat(filename)
+    except FileNotFoundError:
+        fstat = None
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpfile = tempfile.mkstemp(prefix='.%s.' % os.path.basename(filename), dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_fd:
+            tmp_fd.write(content)
+            tmp_fd.flush()
+            os.fsync(tmp_fd.fileno())
+        if fstat:
+            os.chown(tmpfile, fstat.st_uid, fstat.st_gid)
+            os.chmod(tmpfile, fstat.st_mode & 0o7777)
+        else:
+            os.chmod(tmpfile, 0o644)
+        try:
+            os.rename(tmpfile, filename)
+            return
+        except OSError as exception:
+            if exception.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+    except:
+        os.unlink(tmpfile)
+        raise
+    os.unlink(tmpfile)
+    with open(filename, 'wb') as out_fd:
+        out_fd.write(content)
+
+def merge_block(filename, name, content):
+    ''' Replace a named block of lines in a hosts file
+
+    The block is delimited by the lines "# BEGIN locker NAME" and
+    "# END locker NAME". The rest of the file is not modified. The block is
+    appended if it does not exist yet, and removed if the content is empty.
+
+    :param filename: The hosts file, e.g., /etc/hosts
+    :param name: Name of the block, e.g., the project name
+    :param content: New content of the block, lines separated by newlines
+    :returns: True if the file was written, False if it was unchanged
+    '''
+    begin = '# BEGIN locker %s' % name
+    end = '# END locker %s' % name
+    with open(filename, 'r', newline='') as hosts_fd:
+        text = hosts_fd.read()
+    block = ''
+    if content:
+        if not content.endswith('\n'):
+            content += '\n'
+        block = '%s\n%s%s\n' % (begin, content, end)
+    regex = re.compile(r'^%s\r?\n.*?^%s(?:\r?\n|\Z)' % (re.escape(begin), re.escape(end)),
+                       re.MULTILINE | re.DOTALL)
+    if regex.search(text):
+        merged = regex.sub(lambda match: block, text, count=1)
+    elif block:
+        merged = text + ('\n' if text and not text.endswith('\n') else '') + block
+    else:
+        merged = text
+    if merged == text:
+        return False
+    write_atomically(filename, merged.encode())
+    return True
+
+def _add(index, key, row_id, row):
+    ''' Add a row to a bucket of an index
+
+    The buckets are dictionaries by row id, the ids increase with the position
+    in the file and are used to return the rows in the order of the file.
+    '''
+    bucket = index.get(key, None)
+    if bucket is None:
+        index[key] = {row_id: row}
+    else:
+        bucket[row_id] = row
+
+def _ordered(bucket):
+    ''' Get the rows of a bucket in the order of the file '''
+    return [bucket[row_id] for row_id in sorted(bucket)]
+
 class HostsRow(object):
     ''' Internal representation of a line in the hosts file
+
+    The line is analyzed when one of its attributes is accessed for the first
+    time. The netaddr.IPAddress instance is only created on request.
     '''
 
-    # "Host names may contain only alphanumeric characters, minus signs ("-"),
-    # and periods (".").  They must begin with an alphabetic character and
-    # end with an alphanumeric character" see "man hosts"
-    regex_disabled  = r'\s*#+'
-    regex_ip        = r'[\da-fA-F\:\.]+'
-    regex_name      = r'[a-zA-Z\d][a-zA-Z\d\-\.]*[a-zA-Z\d]'
-    regex_name_lax  = r'[a-zA-Z\d][a-zA-Z\d\-\.\_]*[a-zA-Z\d]'
-    regex_names     = r'(?:' + regex_name + ')(?:\s+' + regex_name + ')*'
-    regex_names_lax = r'(?:' + regex_name_lax + ')(?:\s+' + regex_name_lax + ')*'
-    regex_comment   = r'.*'
+    regex_disabled  = _REGEX_DISABLED
+    regex_ip        = _REGEX_IP
+    regex_name      = _REGEX_NAME
+    regex_name_lax  = _REGEX_NAME_LAX
+    regex_names     = _REGEX_NAMES
+    regex_names_lax = _REGEX_NAMES_LAX
+    regex_comment   = _REGEX_COMMENT
+
+    __slots__ = ('num', 'row_id', 'raw', 'modified', '_kind', '_ip', '_ip_text',
+                 '_names', '_comment')
 
     def __init__(self, num, raw):
-        ''' Initialize the member variables and start parsing
+        ''' Initialize the member variables, the line is parsed lazily
+
+        :param num: Line number
+        :param raw: Line without the line break
         '''
         self.num = int(num)
-        self.raw = raw.replace('\t', ' ').strip()
+        self.row_id = None
+        self.raw = raw.rstrip('\n')
+        self.modified = False
+        self._kind = None
         self._ip = None
+        self._ip_text = None
         self._names = None
-        self.comment = None
-        self.is_deactivated = False
-        self.is_comment = False
-        self.is_empty = False
+        self._comment = None
+
+    def _scan(self):
+        ''' Analyze the line if not done yet '''
+        if self._kind is not None:
+            return
+        match = _regex_entry.match(self.raw)
+        if match:
+            disabled, ipv4, ip_text, names, comment = match.group('disabled', 'ipv4', 'ip', 'names', 'comment')
+            try:
+                self._ip_text = ipv4 or _ip_key(ip_text)
+                self._kind = _DISABLED if disabled else _ENTRY
+                self._names = names.split()
+                self._comment = comment.rstrip() if comment is not None else None
+                return
+            except netaddr.AddrFormatError:
+                pass
+        line = self.raw.strip()
+        if not line:
+            self._kind = _EMPTY
+        elif line.startswith('#'):
+            # whole line is a comment
+            self._kind = _COMMENT
+        else:
+            self._kind = _INVALID
+
+    def _make_entry(self):
+        ''' Mark the row as modified entry before changing an attribute '''
+        self._scan()
+        if self._kind not in (_ENTRY, _DISABLED):
+            self._kind = _ENTRY
+            self._names = self._names or []
+        self.modified = True
+
+    @property
+    def is_deactivated(self):
+        self._scan()
+        return self._kind == _DISABLED
+
+    @property
+    def is_comment(self):
+        self._scan()
+        return self._kind == _COMMENT
+
+    @property
+    def is_empty(self):
+        self._scan()
+        return self._kind == _EMPTY
+
+    @property
+    def is_invalid(self):
+        ''' Line is neither an entry, nor a comment, nor empty '''
+        self._scan()
+        return self._kind == _INVALID
+
+    @property
+    def ip_key(self):
+        ''' Normalized IP address as string or None '''
+        self._scan()
+        return self._ip_text
 
     @property
     def ip(self):
+        self._scan()
+        if self._ip is None and self._ip_text is not None:
+            self._ip = netaddr.IPAddress(self._ip_text)
         return self._ip
 
     @ip.setter
@@ -57,10 +266,13 @@ class HostsRow(object):
             pass
         else:
             raise TypeError('\"ip\" has an invalid type: %s' % (type(value)))
+        self._make_entry()
         self._ip = value
+        self._ip_text = str(value)
 
     @property
     def names(self):
+        self._scan()
         return self._names
 
     @names.setter
@@ -71,35 +283,47 @@ class HostsRow(object):
             pass
         else:
             raise TypeError('\"names\" has an invalid type: %s' % (type(value)))
-        regex = re.compile(HostsRow.regex_name)
         for name in value:
-            match = regex.match(name)
+            match = _regex_name.match(name)
             if not match:
                 raise ValueError('Invalid name: %s' % name)
+        self._make_entry()
         self._names = value
 
+    @property
+    def comment(self):
+        self._scan()
+        return self._comment
+
+    @comment.setter
+    def comment(self, value):
+        self._make_entry()
+        self._comment = value
+
     @classmethod
     def parse(cls, num, raw, lax=False):
         '''
         :param lax: allow some invalid characters in hostnames
+        :raises: InvalidLine if the line is neither an entry nor a comment
         '''
         hosts = cls(num, raw)
-        hosts._parse(lax)
+        if hosts.is_invalid:
+            raise InvalidLine('Line %d is neither a valid entry nor a comment: %s' % (hosts.num, hosts.raw))
+        if not lax and hosts.names and not all(_regex_name.match(name) for name in hosts.names):
+            raise InvalidLine('Line %d contains invalid names: %s' % (hosts.num, hosts.raw))
         return hosts
 
     @classmethod
     def new(cls, ip, names, comment=None):
         hosts = cls(-1, '')
-        if isinstance(ip, netaddr.IPAddress):
-            hosts.ip = ip
-        else:
-            hosts.ip = netAddr.IPAddress(ip)
+        hosts._kind = _ENTRY
+        hosts.ip = ip
         hosts.names = names
         hosts.comment = comment
         return hosts
 
     def __str__(self):
-        return '%4d: %s %s # %s' % (self.num, self.ip, ' '.join(self.names), self.comment)
+        return '%4d: %s %s # %s' % (self.num, self.ip, ' '.join(self.names or []), self.comment)
 
     def __repr__(self):
         return 'HostsRow: %s %s %s %s' % (self.num, self.ip, self.names, self.comment)
@@ -113,74 +337,89 @@ class HostsRow(object):
             return True
         return self.ip < other.ip
 
-    def _parse(self, lax=False):
-        ''' Parse and analyze the line
-        '''
-        line = self.raw
-
-        regex_names = HostsRow.regex_names
-        if lax:
-            regex_names = HostsRow.regex_names_lax
-        regex = r'^(?P<disabled>' + HostsRow.regex_disabled +')?\s*(?P<ip>' + HostsRow.regex_ip + ')\s+(?P<names>' + regex_names + ')(?:\s+#+\s*(?P<comment>' + HostsRow.regex_comment + ')\s*)?$'
-        match = re.compile(regex).match(self.raw)
-        if match:
-            # normal entry
-            groupdict = match.groupdict()
-            self.is_deactivated = True if groupdict['disabled'] else False
-            try:
-                ip = netaddr.IPAddress(groupdict['ip'])
-            except netaddr.AddrFormatError:
-                raise InvalidLine('Invalid IP address in line %d: %s' % (self.num, groupdict['ip']))
-            self.ip = ip
-            self.comment = groupdict['comment']
-            self.names = groupdict['names'].split(' ')
-        elif line.startswith('#'):
-            # whole line is a comment
-            self.is_comment = True
-        elif len(line) == 0:
-            # blank line
-            self.is_empty = True
-        else:
-            raise InvalidLine('Line %d is neither a valid entry nor a comment: %s' % (self.num, self.raw))
-
     def to_list(self):
         if self.is_empty:
             return (['','',''])
-        elif self.is_comment:
-            return ('', '', self.raw)
+        elif self.is_comment or self.is_invalid:
+            return ('', '', self.raw.strip())
         elif self.comment:
-            return ((self.ip, ' '.join(self.names), ' # %s' % self.comment))
+            return ((self.ip_key, ' '.join(self.names), ' # %s' % self.comment))
         else:
-            return ((self.ip, ' '.join(self.names), ''))
+            return ((self.ip_key, ' '.join(self.names), ''))
+
+    def format(self, ip_width=0, names_width=0):
+        ''' Format the entry as "IP NAMES # COMMENT"
+
+        :param ip_width: Width of the IP address column
+        :param names_width: Width of the names column
+        :returns: Formatted line
+        '''
+        names = ' '.join(self.names)
+        if self.comment:
+            line = '%-*s %-*s # %s' % (ip_width, self.ip_key, names_width, names, self.comment)
+        else:
+            line = '%-*s %s' % (ip_width, self.ip_key, names)
+        if self.is_deactivated:
+            line = '# ' + line
+        return line
+
+    def to_line(self, ip_width=0, names_width=0):
+        ''' Get the line as written to the hosts file
+
+        :param ip_width: Width of the IP address column
+        :param names_width: Width of the names column
+        :returns: The raw line if the row was not modified, else the formatted
+                  entry, see format()
+        '''
+        if not self.modified:
+            return self.raw
+        return self.format(ip_width, names_width)
+
+    @property
+    def comment_prefix(self):
+        ''' Get the prefix of the comment, e.g., the project of Locker entries
+
+        Locker comments have the format "$project_$container".
+
+        :returns: Part of the comment before the first "_" or None
+        '''
+        comment = self.comment
+        if not comment or '_' not in comment:
+            return None
+        return comment.split('_', 1)[0]
 
 
 class Hosts(object):
     ''' Parses and modifies /etc/hosts
+
+    The rows are kept in an ordered store to preserve the order of the lines
+    and comments. Indexes by IP address, by name, and by comment prefix enable
+    lookups and modifications in O(1). The indexes are built on the first
+    lookup, so loading and saving a file without lookups does not analyze any
+    line.
     '''
 
-    def __init__(self, infile='/etc/hosts', logger=None, lax=False):
+    def __init__(self, infile='/etc/hosts', logger=None, lax=False, missing_ok=False):
         ''' Initializes the class and trigger the parsing
 
         :param infile: The hosts file to parse
         :param logger: custom logging instance
         :param lax: Allow additional characters when parsing
+        :param missing_ok: Start with an empty file if the file does not exist
         '''
         if not logger:
             self.logger = logging.getLogger(self.__class__.__name__)
         else:
             self.logger = logger
-        try:
-            with open(infile, 'r') as hfile_fd:
-                self.hosts = infile
-        except FileNotFoundError:
-            self.logger.error('Hosts file was not found: %s', infile)
-            raise
-        except PermissionError:
-            self.logger.error('Do not have permission to read host file: %s', infile)
-            raise
         self.hosts_file = infile
-        self.rows = list()
-        self._parse(lax)
+        self._rows = OrderedDict()
+        self._next_id = 0
+        self._by_ip = None
+        self._by_name = None
+        self._by_comment_prefix = None
+        self._trailing_newline = True
+        self._digest = None
+        self._parse(lax, missing_ok)
 
     def __str__(self):
         return self.pprint()
@@ -188,55 +427,165 @@ class Hosts(object):
     def __repr__(self):
         return '\n'.join([l.__repr__() for l in self.rows])
 
-    def _parse(self, lax=False):
-        ''' Parse the hosts file '''
-        with open(self.hosts, 'r') as hfile_fd:
-            for line_num, line in enumerate(hfile_fd.readlines()):
-                self.rows.append(HostsRow.parse(line_num, line, lax=True))
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def rows(self):
+        ''' Get all rows in the order of the file '''
+        return list(self._rows.values())
+
+    def _build_indexes(self):
+        ''' Analyze all lines and build the indexes if not done yet '''
+        if self._by_ip is not None:
+            return
+        self._by_ip = dict()
+        self._by_name = dict()
+        self._by_comment_prefix = dict()
+        index = self._index
+        for row_id, row in self._rows.items():
+            index(row_id, row)
+
+    def _index(self, row_id, row):
+        ''' Add the row to the indexes '''
+        row._scan()
+        if row._kind == _INVALID:
+            self.logger.warning('Ignoring invalid line %d in %s: %s', row.num,
+                                self.hosts_file, row.raw)
+            return
+        if row._ip_text is None:
+            return
+        _add(self._by_ip, row._ip_text, row_id, row)
+        for name in row._names:
+            _add(self._by_name, name, row_id, row)
+        comment = row._comment
+        if comment and '_' in comment:
+            _add(self._by_comment_prefix, comment.split('_', 1)[0], row_id, row)
+
+    def _unindex(self, row_id, row):
+        ''' Remove the row from the indexes '''
+        def _discard(index, key):
+            rows = index.get(key, None)
+            if rows is None:
+                return
+            rows.pop(row_id, None)
+            if not rows:
+                del index[key]
+        if row.ip_key is not None:
+            _discard(self._by_ip, row.ip_key)
+        for name in row.names or []:
+            _discard(self._by_name, name)
+        prefix = row.comment_prefix
+        if prefix is not None:
+            _discard(self._by_comment_prefix, prefix)
+
+    def _append(self, row):
+        ''' Append the row to the store and the indexes '''
+        row_id = self._next_id
+        self._next_id += 1
+        row.row_id = row_id
+        self._rows[row_id] = row
+        if self._by_ip is not None:
+            self._index(row_id, row)
+
+    def _remove(self, row):
+        ''' Remove the row from the store and the indexes '''
+        del self._rows[row.row_id]
+        if self._by_ip is not None:
+            self._unindex(row.row_id, row)
+
+    def _parse(self, lax=False, missing_ok=False):
+        ''' Read the hosts file, the lines are analyzed lazily '''
+        try:
+            # keep "\r\n" line breaks to write the file back unchanged
+            with open(self.hosts_file, 'r', newline='') as hfile_fd:
+                content = hfile_fd.read()
+        except FileNotFoundError:
+            if missing_ok:
+                self.logger.debug('Hosts file does not exist yet: %s', self.hosts_file)
+                return
+            self.logger.error('Hosts file was not found: %s', self.hosts_file)
+            raise
+        except PermissionError:
+            self.logger.error('Do not have permission to read host file: %s', self.hosts_file)
+            raise
+        self._digest = hashlib.sha256(content.encode()).digest()
+        if not content:
+            return
+        lines = content.split('\n')
+        if lines[-1]:
+            self._trailing_newline = False
+        else:
+            lines.pop()
+        rows = self._rows
+        for line_num, line in enumerate(lines):
+            row = HostsRow(line_num, line)
+            row.row_id = line_num
+            rows[line_num] = row
+        self._next_id = len(lines)
 
     def get_row(self, ip):
         ''' Search IP address
+
+        :returns: First row with the IP address or None
         '''
-        if not isinstance(ip, netaddr.IPAddress):
-            ip = netaddr.IPAddress(ip)
-        for row in self.rows:
-            if row.ip == ip:
-                return row
-        return None
+        self._build_indexes()
+        rows = self._by_ip.get(_ip_key(ip), None)
+        if not rows:
+            return None
+        return rows[min(rows)]
+
+    def get_rows_by_name(self, name):
+        ''' Search rows by host name
+
+        :returns: List of rows that contain the name
+        '''
+        self._build_indexes()
+        return _ordered(self._by_name.get(name, {}))
+
+    def get_rows_by_comment_prefix(self, prefix):
+        ''' Search rows by comment prefix, see HostsRow.comment_prefix
+
+        :returns: List of rows with a matching comment prefix
+        '''
+        self._build_indexes()
+        return _ordered(self._by_comment_prefix.get(prefix, {}))
 
     def add(self, ip, names, comment=None):
         ''' Add the IP with the specified names and comment
         '''
+        self._build_indexes()
         if not isinstance(ip, netaddr.IPAddress):
             ip = netaddr.IPAddress(ip)
-        if self.get_row(ip):
+        if str(ip) in self._by_ip:
             raise DuplicateIP('Hosts file already contains: %s' % ip)
         row = HostsRow.new(ip, names, comment)
-        self.rows.append(row)
+        self._append(row)
         self.logger.debug('Added row: %s' % row)
 
     def remove_ip(self, ip):
         ''' Remove the given IP address
         '''
-        if not isinstance(ip, netaddr.IPAddress):
-            ip = netaddr.IPAddress(ip)
-        if not self.get_row(ip):
+        self._build_indexes()
+        rows = self._by_ip.get(_ip_key(ip), None)
+        if not rows:
             raise IPNotFound('Hosts file does not contain: %s' % ip)
-        removed_rows = [l for l in self.rows if l.ip == ip]
-        self.rows = [l for l in self.rows if l.ip != ip]
-        for row in removed_rows:
+        for row in _ordered(rows):
+            self._remove(row)
             self.logger.debug('Removed rows: %s' % row)
 
     def update_ip(self, ip, names, comment=None):
         ''' Update the names for an IP address
         '''
-        if not isinstance(ip, netaddr.IPAddress):
-            ip = netaddr.IPAddress(ip)
         row = self.get_row(ip)
         if not row:
             raise IPNotFound('Hosts file does not contain: %s' % ip)
-        row.names = names
-        row.comment = comment
+        self._unindex(row.row_id, row)
+        try:
+            row.names = names
+            row.comment = comment
+        finally:
+            self._index(row.row_id, row)
         self.logger.debug('Updated hosts entry: %s' % row)
 
     def remove_by_comment(self, comment):
@@ -252,40 +601,97 @@ class Hosts(object):
         :returns: Number of removed lines
         '''
         regex = re.compile(comment)
-        filtered_rows = list()
         removed = 0
         for row in self.rows:
             if row.comment and regex.match(row.comment):
                 self.logger.debug('Removing row: %s' % row)
+                self._remove(row)
                 removed += 1
-                continue
-            filtered_rows.append(row)
-        self.rows = filtered_rows
         return removed
 
+    def remove_by_comment_prefix(self, prefix):
+        ''' Remove all rows with a matching comment prefix
+
+        In contrast to remove_by_comment(), only the affected rows are visited.
+        Example: prefix "foo" removes rows with the comments "foo_bar" and
+        "foo_baz" but not "foobar" or "foo".
+
+        :param prefix: Comment prefix, see HostsRow.comment_prefix
+        :returns: Number of removed lines
+        '''
+        rows = self.get_rows_by_comment_prefix(prefix)
+        for row in rows:
+            self.logger.debug('Removing row: %s' % row)
+            self._remove(row)
+        return len(rows)
+
+    def _lines(self, rows):
+        ''' Format rows in aligned columns, rows that were not modified are
+        not changed
+
+        The column widths depend on the modified rows only, i.e., the
+        unmodified rows are not analyzed.
+
+        :param rows: Iterable of HostsRow instances
+        :returns: Generator of lines
+        '''
+        modified = [row for row in rows if row.modified]
+        ip_width = max([len(row.ip_key) for row in modified] or [0])
+        names_width = max([len(' '.join(row.names)) for row in modified] or [0])
+        for row in rows:
+            yield row.to_line(ip_width, names_width)
+
     def pprint(self):
-        ''' Align/format rows
+        ''' Align/format rows for display
 
         :returns: Formatted rows as string
         '''
-        header = ['IP', 'Names', 'Comment']
-        table = prettytable.PrettyTable(header)
-        table.align = 'l'
-        table.border = False
-        table.header = False
-        for row in self.rows:
-            table.add_row(row.to_list())
-        output = '\n'.join([row.strip() for row in table.get_string().split('\n')])
-        return output
+        lines = list()
+        rows = self.rows
+        entries = [row for row in rows if row.ip_key is not None]
+        ip_width = max([len(row.ip_key) for row in entries] or [0])
+        names_width = max([len(' '.join(row.names)) for row in entries] or [0])
+        for row in rows:
+            if row.ip_key is None:
+                lines.append(row.raw.strip())
+            else:
+                lines.append(row.format(ip_width, names_width))
+        return '\n'.join(lines)
+
+    def dumps(self):
+        ''' Get the content of the hosts file
+
+        Rows that were not modified are returned unchanged.
+
+        :returns: Content as string
+        '''
+        if not self._rows:
+            return ''
+        content = '\n'.join(self._lines(self.rows))
+        if self._trailing_newline:
+            content += '\n'
+        return content
 
     def save(self, outfile=None):
         ''' Save content to file
 
+        The content is written to a temporary file that replaces the
+        destination, so readers never see a partially written file. Nothing is
+        written if the content did not change since the file was read or last
+        saved.
+
         :param outfile: Destination file to write content, falls back to the
                         filename provided to the init function if None.
+        :returns: True if the file was written, False if it was unchanged
         '''
         if not outfile:
             outfile = self.hosts_file
-        with open(outfile, 'w') as out_fd:
-            out_fd.write(self.pprint())
-            out_fd.write('\n')
+        content = self.dumps().encode()
+        digest = hashlib.sha256(content).digest()
+        if outfile == self.hosts_file and digest == self._digest:
+            self.logger.debug('Hosts file is unchanged: %s', outfile)
+            return False
+        write_atomically(outfile, content)
+        if outfile == self.hosts_file:
+            self._digest = digest
+        return True
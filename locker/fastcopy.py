@@ -0,0 +1,309 @@
+'''
+This module copies and moves directory trees while preserving the metadata.
+
+It provides "cp -a" like semantics, i.e., the owner, group, mode, timestamps,
+extended attributes, symbolic links, hard links, and special files are
+preserved. File contents are copied by the kernel if possible, either as
+reflink (copy-on-write, e.g., on btrfs and xfs) or via copy_file_range() and
+sendfile(), and multiple files are copied in parallel.
+'''
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# ioctl to clone a file (reflink), see "man ioctl_ficlone"
+FICLONE = 0x40049409
+
+# errors indicating that a copy mechanism is not supported
+_unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EBADF, errno.ETXTBSY, errno.EPERM)
+
+_CHUNK = 16 * 2**20
+
+
+class CopyStats(namedtuple('CopyStats', ['method', 'files', 'dirs', 'bytes', 'seconds'])):
+    ''' Statistics of a copy or move operation '''
+    __slots__ = ()
+
+    @property
+    def throughput(self):
+        ''' Throughput in bytes per second '''
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return '%s: %d files, %d directories, %.1f MB in %.2fs (%.1f MB/s)' % (
+            self.method, self.files, self.dirs, self.bytes / 10**6,
+            self.seconds, self.throughput / 10**6)
+
+def _reflink(src_fd, dst_fd):
+    ''' Clone the file content (copy-on-write)
+
+    :returns: True on success, False if not supported
+    '''
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as exception:
+        if exception.errno in _unsupported:
+            return False
+        raise
+
+def _short_copy(offset, size):
+    ''' Get the error for a copy that ended before the end of the file '''
+    return OSError(errno.EIO, 'Copy ended after %d of %d bytes' % (offset, size))
+
+def _copy_file_range(src_fd, dst_fd, size):
+    ''' Copy the file content within the kernel
+
+    Some file systems, e.g., procfs, sysfs, and some FUSE or NFS setups,
+    report end of file immediately instead of failing.
+
+    :returns: True on success, False if not supported
+    :raises: OSError if the copy ended before the end of the file
+    '''
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if not copy_file_range:
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            copied = copy_file_range(src_fd, dst_fd, min(_CHUNK, size - offset))
+        except OSError as exception:
+            if offset == 0 and exception.errno in _unsupported:
+                return False
+            raise
+        if copied == 0:
+            if offset == 0:
+                return False
+            raise _short_copy(offset, size)
+        offset += copied
+    return True
+
+def _sendfile(src_fd, dst_fd, size):
+    ''' Copy the file content with sendfile()
+
+    :returns: True on success, False if not supported
+    :raises: OSError if the copy ended before the end of the file
+    '''
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(dst_fd, src_fd, offset, min(_CHUNK, size - offset))
+        except OSError as exception:
+            if offset == 0 and exception.errno in _unsupported:
+                return False
+            raise
+        if sent == 0:
+            if offset == 0:
+                return False
+            raise _short_copy(offset, size)
+        offset += sent
+    return True
+
+def copy_file(src, dst, src_stat=None):
+    ''' Copy the content of a regular file
+
+    Tries reflink, copy_file_range(), sendfile(), and falls back to copying
+    in user space. The metadata is not copied, see copy_metadata().
+
+    :param src: Source file
+    :param dst: Destination file, will be truncated if it exists
+    :param src_stat: Result of os.lstat(src) if available
+    :returns: Number of bytes copied
+    '''
+    if src_stat is None:
+        src_stat = os.lstat(src)
+    size = src_stat.st_size
+    with open(src, 'rb') as src_fo, open(dst, 'wb') as dst_fo:
+        src_fd = src_fo.fileno()
+        dst_fd = dst_fo.fileno()
+        if size == 0:
+            return 0
+        if _reflink(src_fd, dst_fd):
+            return size
+        if _copy_file_range(src_fd, dst_fd, size):
+            return size
+        if _sendfile(src_fd, dst_fd, size):
+            return size
+        shutil.copyfileobj(src_fo, dst_fo, _CHUNK)
+    return size
+
+def copy_metadata(src, dst, src_stat=None):
+    ''' Copy owner, group, mode, extended attributes, and timestamps
+
+    Symbolic links are not followed.
+
+    :param src: Source path
+    :param dst: Destination path
+    :param src_stat: Result of os.lstat(src) if available
+    '''
+    if src_stat is None:
+        src_stat = os.lstat(src)
+    is_link = stat.S_ISLNK(src_stat.st_mode)
+    try:
+        os.lchown(dst, src_stat.st_uid, src_stat.st_gid)
+    except PermissionError:
+        pass
+    if hasattr(os, 'listxattr'):
+        try:
+            for name in os.listxattr(src, follow_symlinks=False):
+                try:
+                    os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False),
+                                follow_symlinks=False)
+                except OSError as exception:
+                    if exception.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+                        raise
+        except OSError as exception:
+            if exception.errno not in (errno.ENOTSUP, errno.EPERM):
+                raise
+    if not is_link:
+        # chmod after chown as chown may clear the setuid/setgid bits
+        os.chmod(dst, stat.S_IMODE(src_stat.st_mode))
+    if not is_link or os.utime in os.supports_follow_symlinks:
+        os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns),
+                 follow_symlinks=False)
+
+def _raise(exception):
+    raise exception
+
+class _Budget(object):
+    ''' Limits the number of bytes of files being copied concurrently '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            # a single file larger than the limit may always be copied alone
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+def copy_tree(src, dst, workers=4, budget=256*2**20, logger=None):
+    ''' Copy a directory tree like "cp -a"
+
+    The destination must not exist. Regular files are copied in parallel by
+    "workers" threads, the sum of the sizes of the files that are copied at
+    the same time is limited by "budget" (in bytes).
+
+    :param src: Source directory
+    :param dst: Destination directory, must not exist
+    :param workers: Number of threads copying files
+    :param budget: Maximum number of bytes in flight
+    :param logger: Logger for debug output
+    :returns: CopyStats
+    :raises: OSError on failure
+    '''
+    logger = logger or logging.getLogger()
+    start = time.time()
+    limit = _Budget(budget)
+    num_files = 0
+    num_dirs = 0
+    num_bytes = 0
+    dirs = list()
+    hardlinks = dict()
+    deferred_links = list()
+
+    def _copy_regular(src_path, dst_path, src_stat):
+        try:
+            copy_file(src_path, dst_path, src_stat)
+            copy_metadata(src_path, dst_path, src_stat)
+        finally:
+            limit.release(src_stat.st_size)
+
+    futures = list()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        try:
+            for root, dirnames, filenames in os.walk(src, onerror=_raise):
+                rel = os.path.relpath(root, src)
+                dst_root = dst if rel == '.' else os.path.join(dst, rel)
+                os.mkdir(dst_root)
+                dirs.append((root, dst_root, os.lstat(root)))
+                num_dirs += 1
+                # os.walk() lists symbolic links to directories as directories
+                for name in list(dirnames):
+                    if os.path.islink(os.path.join(root, name)):
+                        dirnames.remove(name)
+                        filenames.append(name)
+                for name in filenames:
+                    src_path = os.path.join(root, name)
+                    dst_path = os.path.join(dst_root, name)
+                    src_stat = os.lstat(src_path)
+                    mode = src_stat.st_mode
+                    num_files += 1
+                    if stat.S_ISREG(mode) and src_stat.st_nlink > 1:
+                        inode = (src_stat.st_dev, src_stat.st_ino)
+                        if inode in hardlinks:
+                            deferred_links.append((hardlinks[inode], dst_path))
+                            continue
+                        hardlinks[inode] = dst_path
+                    if stat.S_ISREG(mode):
+                        limit.acquire(src_stat.st_size)
+                        futures.append(executor.submit(_copy_regular, src_path, dst_path, src_stat))
+                        num_bytes += src_stat.st_size
+                        continue
+                    if stat.S_ISLNK(mode):
+                        os.symlink(os.readlink(src_path), dst_path)
+                    elif stat.S_ISSOCK(mode):
+                        logger.debug('Skipping socket: %s', src_path)
+                        continue
+                    else:
+                        os.mknod(dst_path, mode, src_stat.st_rdev)
+                    copy_metadata(src_path, dst_path, src_stat)
+        finally:
+            for future in futures:
+                future.result()
+
+    for target, link in deferred_links:
+        os.link(target, link)
+    # directory timestamps last, deepest first as creating entries changes them
+    for src_dir, dst_dir, src_stat in reversed(dirs):
+        copy_metadata(src_dir, dst_dir, src_stat)
+    return CopyStats('copy', num_files, num_dirs, num_bytes, time.time() - start)
+
+def move_tree(src, dst, workers=4, budget=256*2**20, logger=None):
+    ''' Move a directory tree
+
+    Renames the directory if source and destination are on the same file
+    system. Otherwise the tree is copied with copy_tree() and the source is
+    removed afterwards.
+
+    :param src: Source directory
+    :param dst: Destination directory, must not exist
+    :param workers: Number of threads copying files
+    :param budget: Maximum number of bytes in flight
+    :param logger: Logger for debug output
+    :returns: CopyStats
+    :raises: OSError on failure
+    '''
+    logger = logger or logging.getLogger()
+    start = time.time()
+    try:
+        os.rename(src, dst)
+        return CopyStats('rename', 0, 1, 0, time.time() - start)
+    except OSError as exception:
+        if exception.errno != errno.EXDEV:
+            raise
+    logger.debug('Different file systems, copying: %s -> %s', src, dst)
+    try:
+        stats = copy_tree(src, dst, workers, budget, logger)
+    except:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+    shutil.rmtree(src)
+    return CopyStats('move', stats.files, stats.dirs, stats.bytes, time.time() - start)
@@ -0,0 +1,171 @@
+'''
+This module checks the readiness of containers.
+
+A container is ready if it is running and all probes of its "healthcheck"
+block succeed: a TCP connection to a port of the container, a command run in
+the container via attach, or a file in the container's root file system.
+The probes of several containers are run concurrently with asyncio and
+repeated with exponential backoff until the container is healthy or the
+timeout of its healthcheck expires. Containers without a healthcheck are ready
+as soon as they are running.
+
+The containers of a project are started in dependency waves: a container is
+started after the containers it links to are ready.
+'''
+
+import asyncio
+import logging
+import os
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lxc
+
+# maximum delay between two probes in seconds
+MAX_INTERVAL = 5
+
+# seconds to wait for a TCP connection
+CONNECT_TIMEOUT = 1
+
+
+async def _probe_tcp(ip, port):
+    ''' Check if a TCP port accepts connections '''
+    try:
+        _reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), CONNECT_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+def _probe_exec(container, command):
+    ''' Check if a command run in the container exits with 0 (blocking) '''
+    with open(os.devnull, 'w') as devnull:
+        try:
+            return container.attach_wait(lxc.attach_run_command, shlex.split(command),
+                                         stdout=devnull, stderr=devnull) == 0
+        except (OSError, ValueError) as exception:
+            container.logger.debug('Healthcheck command failed: %s', exception)
+            return False
+
+def _probe_file(container, path):
+    ''' Check if a file exists in the container's mount namespace '''
+    return os.path.exists('/proc/%d/root%s' % (container.init_pid, path))
+
+async def probe(container, executor):
+    ''' Run the probes of a container once
+
+    :param container: Container instance
+    :param executor: Executor for blocking probes
+    :returns: True if the container is running and all probes succeed
+    '''
+    if not container.running:
+        return False
+    check = container.config.healthcheck
+    if check is None:
+        return True
+    if check.tcp is not None:
+        ips = container.get_ips(retries=0)
+        if not ips or not await _probe_tcp(ips[0], check.tcp):
+            return False
+    if check.file is not None and not _probe_file(container, check.file):
+        return False
+    if check.command is not None:
+        loop = asyncio.get_event_loop()
+        if not await loop.run_in_executor(executor, _probe_exec, container, check.command):
+            return False
+    return True
+
+async def wait_healthy(container, executor):
+    ''' Probe a container with exponential backoff until it is healthy
+
+    :param container: Container instance
+    :param executor: Executor for blocking probes
+    :returns: Tuple (True if healthy, seconds until healthy or timed out)
+    '''
+    check = container.config.healthcheck
+    begin = time.time()
+    if check is None:
+        return await probe(container, executor), 0.0
+    deadline = begin + check.timeout
+    delay = check.interval
+    while True:
+        if await probe(container, executor):
+            return True, time.time() - begin
+        now = time.time()
+        if now >= deadline:
+            return False, now - begin
+        await asyncio.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, MAX_INTERVAL)
+
+def _run(coroutine_func, containers):
+    ''' Run a coroutine for each container concurrently in a new event loop
+
+    :returns: List of the results in the order of the containers
+    '''
+    async def _gather(executor):
+        return await asyncio.gather(*[coroutine_func(container, executor) for container in containers])
+
+    loop = asyncio.new_event_loop()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(containers))) as executor:
+            return loop.run_until_complete(_gather(executor))
+    finally:
+        loop.close()
+
+def wait_ready(containers):
+    ''' Wait concurrently until containers are ready
+
+    :param containers: List of containers
+    :returns: Dictionary of container name -> True if ready
+    '''
+    if not containers:
+        return {}
+    ready = dict()
+    for container, (healthy, seconds) in zip(containers, _run(wait_healthy, containers)):
+        if container.config.healthcheck is not None:
+            if healthy:
+                container.logger.info('Healthy after %.2fs', seconds)
+            else:
+                container.logger.error('Not healthy after %.2fs', seconds)
+        ready[container.name] = healthy
+    return ready
+
+def check(containers):
+    ''' Run the probes of containers once concurrently, e.g., for "status"
+
+    :param containers: List of containers
+    :returns: Dictionary of container name -> "healthy", "unhealthy", or
+              None if the container has no healthcheck or is not running
+    '''
+    probed = [con for con in containers if con.config.healthcheck is not None and con.running]
+    health = dict((con.name, None) for con in containers)
+    if probed:
+        for container, healthy in zip(probed, _run(probe, probed)):
+            health[container.name] = 'healthy' if healthy else 'unhealthy'
+    return health
+
+def dependency_waves(containers):
+    ''' Group containers so that they start after the containers they link to
+
+    Links to containers that are not in the list are ignored. Containers
+    with cyclic links are added to the last wave.
+
+    :param containers: List of containers
+    :returns: List of lists of containers
+    '''
+    names = set(con.config.name for con in containers)
+    done = set()
+    remaining = list(containers)
+    waves = list()
+    while remaining:
+        wave = [con for con in remaining
+                if all(link.name in done or link.name not in names or link.name == con.config.name
+                       for link in con.config.links)]
+        if not wave:
+            logging.warning('Cyclic links between containers: %s', ', '.join(con.name for con in remaining))
+            wave = remaining
+        waves.append(wave)
+        done.update(con.config.name for con in wave)
+        remaining = [con for con in remaining if con not in wave]
+    return waves
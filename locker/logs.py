@@ -0,0 +1,352 @@
+'''
+This module shows and follows the logs of containers ("locker logs").
+
+By default the console log of each container is shown. Locker enables it
+when a container with "console_log" in its configuration starts
+(lxc.console.logfile, see Container.console_log). Alternatively, files in
+the containers' root file systems are shown, e.g., /var/log/syslog. The last
+lines of all files are merged in timestamp order and prefixed with the
+container's name in its color. With "follow", new
+lines are read when inotify reports that a file was modified. Rotated files
+are reopened and truncated files, e.g., by logrotate's "copytruncate", are
+read from the beginning.
+
+Lines that start with an ISO 8601 or syslog timestamp are ordered by it,
+other lines are ordered like the preceding line of the same file or, for
+the first line, by the time they were read. Files are not reordered, i.e.,
+the lines of a file are always shown in the order of the file.
+
+The memory use does not grow while following: at most "budget" bytes are
+read at once from all files and at most MAX_LINE bytes of an incomplete line
+are buffered per file, longer lines are split.
+'''
+
+import heapq
+import logging
+import os
+import re
+import sys
+import time
+from operator import itemgetter
+
+from locker.attach import MAX_LINE, prefix
+from locker.transfer import container_root, resolve
+from locker.watch import (IN_CREATE, IN_DELETE_SELF, IN_IGNORED, IN_MODIFY, IN_MOVE_SELF,
+                          IN_MOVED_TO, IN_Q_OVERFLOW, Inotify)
+
+# bytes read at once from all files while following
+BUDGET = 1024 * 1024
+
+# minimum number of bytes read at once from a file
+MIN_READ = 4096
+
+# maximum number of bytes read from the end of a file for its last lines
+MAX_TAIL = 1024 * 1024
+
+_ISO = re.compile(rb'^\[?(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:[.,](\d+))?')
+_SYSLOG = re.compile(rb'^([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2})')
+_MONTHS = [b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun', b'Jul', b'Aug', b'Sep', b'Oct', b'Nov', b'Dec']
+
+
+def timestamp(line):
+    ''' Get the time of a log line
+
+    Supports ISO 8601 like "2015-03-01 12:00:00.123" (optionally in square
+    brackets or with "T") and syslog like "Mar  1 12:00:00" (current year).
+    Time zones are ignored, i.e., the local time is assumed.
+
+    :param line: Line as bytes
+    :returns: Seconds since the epoch or None if the line has no timestamp
+    '''
+    match = _ISO.match(line)
+    if match:
+        values = [int(value) for value in match.groups()[:6]]
+        fraction = float(b'0.' + match.group(7)) if match.group(7) else 0.0
+    else:
+        match = _SYSLOG.match(line)
+        if not match or match.group(1) not in _MONTHS:
+            return None
+        values = [time.localtime().tm_year, _MONTHS.index(match.group(1)) + 1] + \
+                 [int(value) for value in match.groups()[1:]]
+        fraction = 0.0
+    try:
+        return time.mktime(tuple(values) + (0, 0, -1)) + fraction
+    except (OverflowError, ValueError):
+        return None
+
+def _split(buffer):
+    ''' Split the complete lines off a buffer
+
+    :param buffer: bytearray, the incomplete last line remains in it
+    :returns: List of the lines, lines longer than MAX_LINE are split
+    '''
+    lines = buffer.split(b'\n')
+    rest = lines.pop()
+    result = list()
+    for line in lines:
+        while len(line) > MAX_LINE:
+            result.append(bytes(line[:MAX_LINE]))
+            line = line[MAX_LINE:]
+        result.append(bytes(line.rstrip(b'\r')))
+    while len(rest) >= MAX_LINE:
+        result.append(bytes(rest[:MAX_LINE]))
+        rest = rest[MAX_LINE:]
+    buffer[:] = rest
+    return result
+
+class _Source(object):
+    ''' Log file of a container '''
+
+    def __init__(self, container, path, prefix):
+        self.container = container
+        self.path = path
+        self.prefix = prefix
+        self.file = None
+        self.buffer = bytearray()
+        self.stamp = None
+        self.rotated = False
+
+    def _stamped(self, lines, now):
+        entries = list()
+        for line in lines:
+            stamp = timestamp(line)
+            if stamp is None:
+                stamp = now if self.stamp is None else self.stamp
+            self.stamp = stamp
+            entries.append((stamp, self.prefix, line))
+        return entries
+
+    def open(self, lines=None):
+        ''' Open the file
+
+        :param lines: Number of lines to return from the end of the file,
+                      None reads the file from the beginning
+        :returns: List of (time, prefix, line), empty if the file is missing
+        '''
+        self.close()
+        try:
+            self.file = open(self.path, 'rb', buffering=0)
+        except FileNotFoundError:
+            return []
+        self.rotated = False
+        self.buffer = bytearray()
+        if lines is None:
+            return []
+        file_stat = os.fstat(self.file.fileno())
+        offset = file_stat.st_size
+        data = bytearray()
+        while offset > 0 and data.count(b'\n') <= lines and len(data) < MAX_TAIL:
+            step = min(MIN_READ * 16, offset)
+            offset -= step
+            self.file.seek(offset)
+            data[:0] = self.file.read(step)
+        self.file.seek(file_stat.st_size)
+        tail = _split(data)
+        self.buffer = data
+        if offset > 0 and tail:
+            # the first line is incomplete
+            tail.pop(0)
+        return self._stamped(tail[-lines:] if lines else [], file_stat.st_mtime)
+
+    def read(self, limit):
+        ''' Read the new complete lines
+
+        :param limit: Maximum number of bytes to read
+        :returns: Tuple (list of (time, prefix, line), True if more data may
+                  be available)
+        '''
+        if self.file is None:
+            return [], False
+        if os.fstat(self.file.fileno()).st_size < self.file.tell():
+            self.container.logger.info('Log file truncated: %s', self.path)
+            self.file.seek(0)
+            self.buffer = bytearray()
+        data = self.file.read(limit)
+        if not data:
+            return [], False
+        self.buffer.extend(data)
+        return self._stamped(_split(self.buffer), time.time()), len(data) == limit
+
+    def replaced(self):
+        ''' Check if the path refers to another file than the opened one
+
+        :returns: True if the file was replaced or not opened yet and exists
+        '''
+        try:
+            path_stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self.file is None:
+            return True
+        file_stat = os.fstat(self.file.fileno())
+        return (path_stat.st_dev, path_stat.st_ino) != (file_stat.st_dev, file_stat.st_ino)
+
+    def close(self):
+        ''' Close the file, the incomplete last line is discarded '''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Follower(object):
+    ''' Follows the log files of containers via inotify
+    '''
+
+    def __init__(self, sources, output=None, budget=BUDGET):
+        ''' Watch the directories of the log files
+
+        :param sources: List of _Source instances
+        :param output: Stream for the prefixed lines, default: sys.stdout
+        :param budget: Maximum number of bytes read at once from all files
+        :raises: OSError if a directory cannot be watched
+        '''
+        self.sources = sources
+        self.output = output or sys.stdout
+        self.limit = max(MIN_READ, budget // max(1, len(sources)))
+        self.inotify = Inotify()
+        self.files = dict()
+        self.dirs = dict()
+        for source in sources:
+            wd = self.inotify.add_watch(os.path.dirname(source.path), IN_CREATE | IN_MOVED_TO)
+            self.dirs.setdefault(wd, []).append(source)
+
+    def _watch(self, source):
+        if source.file is not None:
+            wd = self.inotify.add_watch(source.path, IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF)
+            self.files.setdefault(wd, [])
+            if source not in self.files[wd]:
+                self.files[wd].append(source)
+
+    def _write(self, entries):
+        for _stamp, line_prefix, line in entries:
+            self.output.write('%s%s\n' % (line_prefix, line.decode(errors='replace')))
+        self.output.flush()
+
+    def tail(self, lines):
+        ''' Open the files and write their last lines in timestamp order
+
+        :param lines: Number of lines per file
+        '''
+        tails = list()
+        for source in self.sources:
+            tails.append(source.open(lines))
+            if source.file is None:
+                source.container.logger.warning('Log file does not exist (yet): %s', source.path)
+            self._watch(source)
+        self._write(heapq.merge(*tails, key=itemgetter(0)))
+
+    def drain(self, sources):
+        ''' Write the new lines of files in timestamp order
+
+        Reads at most "budget" bytes from all files at once until all data
+        was read.
+
+        :param sources: List of _Source instances
+        '''
+        pending = list(sources)
+        while pending:
+            batches = list()
+            more = list()
+            for source in pending:
+                entries, full = source.read(self.limit)
+                batches.append(entries)
+                if full:
+                    more.append(source)
+            self._write(heapq.merge(*batches, key=itemgetter(0)))
+            pending = more
+
+    def poll(self, timeout=None):
+        ''' Wait for changes of the files and write their new lines
+
+        :param timeout: Maximum time to wait in seconds, None waits forever
+        :returns: Number of inotify events
+        '''
+        events = self.inotify.read(timeout)
+        modified = list()
+        created = list()
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                modified.extend(self.sources)
+            elif event.wd in self.dirs:
+                created.extend(source for source in self.dirs[event.wd]
+                               if event.name == os.path.basename(source.path))
+            elif event.wd in self.files:
+                modified.extend(self.files[event.wd])
+                if event.mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                    for source in self.files[event.wd]:
+                        source.rotated = True
+                if event.mask & IN_IGNORED:
+                    del self.files[event.wd]
+        # the remaining lines of rotated files are written before the new files
+        self.drain([source for source in self.sources if source in modified or source in created])
+        reopened = list()
+        for source in self.sources:
+            if (source in created or source.rotated) and source.replaced():
+                source.container.logger.debug('Reopening log file: %s', source.path)
+                source.open()
+                self._watch(source)
+                reopened.append(source)
+            elif source.rotated:
+                source.close()
+        self.drain(reopened)
+        return len(events)
+
+    def close(self):
+        ''' Close the files and the inotify instance '''
+        for source in self.sources:
+            source.close()
+        self.inotify.close()
+
+def sources(containers, paths=None):
+    ''' Get the log files of containers
+
+    :param containers: List of containers
+    :param paths: Paths of log files in the containers, None for the console
+                  logs
+    :returns: List of _Source instances
+    '''
+    width = max([len(con.name.split('_', 1)[1]) for con in containers] or [0])
+    result = list()
+    for container in containers:
+        if not container.defined:
+            container.logger.warning('Container is not defined, skipping')
+            continue
+        if paths:
+            try:
+                root = container_root(container)
+            except ValueError as exception:
+                container.logger.warning('Skipping log files: %s', exception)
+                continue
+            files = [resolve(root, path) for path in paths]
+        elif container.config.console_log is None:
+            container.logger.warning('Console log is not enabled, see "console_log", skipping')
+            continue
+        else:
+            files = [container.console_log]
+        for path in files:
+            if not os.path.isdir(os.path.dirname(path)):
+                container.logger.warning('Directory of the log file does not exist, skipping: %s', path)
+                continue
+            result.append(_Source(container, path, prefix(container, width)))
+    return result
+
+def logs(containers, paths=None, lines=10, follow=False, output=None):
+    ''' Write the last lines of the logs of containers and follow them
+
+    :param containers: List of containers
+    :param paths: Paths of log files in the containers, None for the console
+                  logs
+    :param lines: Number of lines per file written before following
+    :param follow: Follow the files until interrupted
+    :param output: Stream for the prefixed lines, default: sys.stdout
+    '''
+    follower = Follower(sources(containers, paths), output)
+    try:
+        follower.tail(lines)
+        if not follow:
+            return
+        while True:
+            follower.poll()
+    except KeyboardInterrupt:
+        logging.debug('Stopped following the logs')
+    finally:
+        follower.close()
@@ -0,0 +1,87 @@
+'''
+This module writes files that Locker generates, e.g., the fstab, only if their
+content changed.
+
+The content of each file is rendered in memory and its SHA-256 hash is
+compared with the hash recorded when the file was last written. The file is
+only written (atomically) if the hashes differ or if the file was modified by
+someone else in the meantime, i.e., its modification time or size changed.
+'''
+
+import hashlib
+import logging
+import os
+
+from locker.etchosts import write_atomically
+
+
+class ManagedFiles(object):
+    ''' Files written on behalf of a container
+
+    The hashes are recorded in the container's state, see locker.state.
+    Call commit() to save the records after writing the files.
+    '''
+
+    def __init__(self, state, logger=None):
+        ''' Initialize the records
+
+        :param state: ContainerState instance
+        :param logger: Logger for debug output
+        '''
+        self.state = state
+        self.logger = logger or logging.getLogger()
+        self._files = dict(state.get('files', {}))
+
+    def _is_current(self, filename, digest):
+        ''' Check if the file has the content with the specified hash
+
+        :returns: True if the file is up to date
+        '''
+        try:
+            fstat = os.stat(filename)
+        except FileNotFoundError:
+            return False
+        record = self._files.get(filename, None)
+        if record == [digest, fstat.st_mtime_ns, fstat.st_size]:
+            return True
+        if record is not None and record[0] != digest:
+            return False
+        # not recorded yet or modified by someone else: compare the content
+        with open(filename, 'rb') as managed_fd:
+            if hashlib.sha256(managed_fd.read()).hexdigest() != digest:
+                return False
+        self._files[filename] = [digest, fstat.st_mtime_ns, fstat.st_size]
+        return True
+
+    def write(self, filename, content):
+        ''' Write the file if its content changed
+
+        Symbolic links are not replaced but the file they point to is
+        overwritten in place.
+
+        :param filename: Path of the file
+        :param content: Content as string
+        :returns: True if the file was written, False if it was up to date
+        :raises: OSError if the file cannot be written
+        '''
+        content = content.encode()
+        digest = hashlib.sha256(content).hexdigest()
+        if self._is_current(filename, digest):
+            self.logger.debug('Unchanged: %s', filename)
+            return False
+        if os.path.islink(filename):
+            with open(filename, 'wb') as managed_fd:
+                managed_fd.write(content)
+        else:
+            write_atomically(filename, content)
+        fstat = os.stat(filename)
+        self._files[filename] = [digest, fstat.st_mtime_ns, fstat.st_size]
+        self.logger.debug('Updated: %s', filename)
+        return True
+
+    def commit(self):
+        ''' Record the hashes of the written files in the container's state
+
+        :returns: True if the state was written, else False
+        '''
+        return self.state.update(files=self._files)
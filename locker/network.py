@@ -5,14 +5,55 @@ Network related functionality like bridge and netfilter setup
 import itertools
 import logging
 import re
+import sqlite3
+import threading
 import time
+from functools import wraps
 
 import iptc
 import locker
 import netaddr
 import pyroute2
+from locker.state import StateStore
 from locker.util import regex_ip
 
+# IPDB instance shared by all queries, see keep_ipdb()
+_kept_ipdb = None
+
+# serializes the access to the netfilter tables, see synchronized_netfilter()
+_netfilter_lock = threading.RLock()
+
+
+def keep_ipdb():
+    ''' Share one IPDB instance instead of creating one for each query
+
+    Used by long running processes like the Locker daemon. The instance is
+    kept up to date by netlink events.
+    '''
+    global _kept_ipdb
+    if _kept_ipdb is None:
+        _kept_ipdb = pyroute2.IPDB()
+
+def _get_ipdb():
+    ''' Get the shared IPDB instance or a new one, see _release_ipdb() '''
+    return _kept_ipdb if _kept_ipdb is not None else pyroute2.IPDB()
+
+def _release_ipdb(ipdb):
+    ''' Release an IPDB instance unless it is shared '''
+    if ipdb is not _kept_ipdb:
+        ipdb.release()
+
+def synchronized_netfilter(func):
+    ''' Serialize the access to the netfilter tables
+
+    python-iptables is not thread-safe but the asynchronous API runs the
+    commands of several projects in threads, see locker.aio.
+    '''
+    @wraps(func)
+    def synchronized_netfilter_wrapper(*args, **kwargs):
+        with _netfilter_lock:
+            return func(*args, **kwargs)
+    return synchronized_netfilter_wrapper
 
 class BridgeUnavailable(Exception):
     ''' Bridge device does not exist
@@ -46,6 +87,11 @@ class Network(object):
             raise TypeError('Invalid type for property project: %s, required type = %s' % (type(value), type(locker.Project)))
         self._project = value
 
+    @property
+    def store(self):
+        ''' Get the state store of the project's lxcpath '''
+        return StateStore.open(self.project.args.get('lxcpath', '/var/lib/lxc'))
+
     @property
     def bridge(self):
         ''' Get bridge assigned to the project '''
@@ -72,6 +118,7 @@ class Network(object):
         return bridge_ip
 
     @staticmethod
+    @synchronized_netfilter
     def find_comment_in_chain(comment, chain):
         ''' Search rule with a matching comment
 
@@ -87,6 +134,7 @@ class Network(object):
         return False
 
     @staticmethod
+    @synchronized_netfilter
     def _delete_if_comment(comment, table, chain):
         ''' Search rule with a matching comment and delete it
 
@@ -108,6 +156,7 @@ class Network(object):
         table.refresh()
         table.autocommit = True
 
+    @synchronized_netfilter
     def _setup_locker_chains(self):
         ''' Add container unspecific netfilter rules
 
@@ -170,6 +219,7 @@ class Network(object):
         self._create_bridge()
         self._enable_nat()
 
+    @synchronized_netfilter
     def _enable_nat(self):
         ''' Add netfilter rules that enable direct communication from the containers
         '''
@@ -208,6 +258,7 @@ class Network(object):
             comment_match.comment = self.bridge_ifname
             nat_prerouting.insert_rule(masquerade_rule)
 
+    @synchronized_netfilter
     def _disable_nat(self):
         ''' Remove netfilter rules that enable direct communication from the containers
         '''
@@ -230,27 +281,32 @@ class Network(object):
         :returns: pyroute2.ipdb.interface.Interface if found, else None
         '''
         bridge_ifname = 'locker_%s' % self.project.name
-        ipdb = pyroute2.IPDB()
+        ipdb = _get_ipdb()
         try:
             bridge = ipdb.by_name[bridge_ifname]
         except KeyError:
             logging.debug('Bridge was not found: %s', bridge_ifname)
             return None
         finally:
-            ipdb.release()
+            _release_ipdb(ipdb)
         return bridge
 
+    def refresh(self):
+        ''' Look up the bridge again, e.g., when the project is reused
+        '''
+        self._bridge = self._get_existing_bridge()
+
     def _create_bridge(self):
         ''' Create project specific bridge interface
 
         :raises: Any exception that pyroute2 may raise
         '''
         bridge_ifname = 'locker_%s' % self.project.name
-        ipdb = pyroute2.IPDB()
+        ipdb = _get_ipdb()
         try:
             if not bridge_ifname in ipdb.by_name.keys():
                 logging.info('Creating bridge: %s', bridge_ifname)
-                network = Network._get_unused_subnet()
+                network = self._allocate_subnet()
                 with ipdb.create(kind='bridge', ifname=bridge_ifname) as bridge:
                     bridge.add_ip(network)
                     bridge.up()
@@ -262,7 +318,7 @@ class Network(object):
             logging.error('Could not create bridge: %s', exception)
             raise
         finally:
-            ipdb.release()
+            _release_ipdb(ipdb)
 
     def _delete_bridge(self):
         ''' Delete project specific bridge
@@ -275,16 +331,17 @@ class Network(object):
         except BridgeUnavailable:
             return
 
-        ipdb = pyroute2.IPDB()
+        ipdb = _get_ipdb()
         try:
             with ipdb.by_name[bridge_ifname] as brdev:
                 logging.info('Deleting bridge: %s', bridge_ifname)
                 brdev.remove()
+            self._bridge = None
         except Exception as exception:
             logging.error('Could not delete bridge: %s', exception)
             raise
         finally:
-            ipdb.release()
+            _release_ipdb(ipdb)
 
     def _get_used_ips(self):
         ''' Get list of IPs used by all containers
@@ -298,24 +355,28 @@ class Network(object):
         logging.debug('IP addresses in use by containers: %s', ips)
         return ips
 
-    @staticmethod
-    def _get_unused_subnet():
-        ''' Get an unused  /24 subnet
+    def _get_unrecorded_ips(self, container):
+        ''' Get list of IPs used by running containers without recorded IP
 
-        Get the first unused IP subnetwork in the 10.0.0.0 net.
-        The method queries all networks that are reachable by the currently
-        known network interfaces.
-        Search starts at 10.1.1.0.
+        These containers were started by older versions of Locker or their
+        state was lost.
 
-        TODO Enable to select range for subnets, e.g., (10.2.3.0, 10.42.6.0)
-        TODO Method could be refactored to be more pythonic
-
-        :returns: First valid IP address in the subnet/CIDR_Mask as string
-        :raises: RuntimeError if out of available networks
+        :param container: Container to ignore
+        :returns: List of IPs (strings)
         '''
+        ips = list()
+        for con in self.project.all_containers:
+            if con.name != container.name and 'ip' not in con.recorded and con.running:
+                ips.extend(con.get_ips(retries=0) or [])
+        return ips
+
+    @staticmethod
+    def _get_used_subnets():
+        ''' Get the subnets in the 10.0.0.0 net used by the network interfaces
 
-        # Get all used subnets
-        ipdb = pyroute2.IPDB()
+        :returns: netaddr.IPSet
+        '''
+        ipdb = _get_ipdb()
         ipset = netaddr.IPSet()
         try:
             for ifname, vals in ipdb.by_name.items():
@@ -324,38 +385,102 @@ class Network(object):
                     network = netaddr.IPNetwork('%s/%s' % (ipaddr, cidr))
                     ipset.add(network)
         finally:
-            ipdb.release()
+            _release_ipdb(ipdb)
+        return ipset
+
+    @staticmethod
+    def _unused_subnets(ipset):
+        ''' Generate the unused /24 subnets in the 10.0.0.0 net
+
+        Search starts at 10.1.1.0.
 
-        # Find unused subnet
+        :param ipset: Used subnets
+        :returns: Generator of the first valid IP address in the subnet/CIDR_Mask as string
+        '''
         for oct3 in range(1, 256):
             for oct2 in range(1, 256):
                 network = '10.%d.%d.1/24' % (oct2, oct3)
                 if ipset.isdisjoint(netaddr.IPSet([network])):
-                    logging.debug('Found free /24 subnet: %s', network)
-                    return network
+                    yield network
+
+    @staticmethod
+    def _get_unused_subnet():
+        ''' Get an unused  /24 subnet
+
+        Get the first unused IP subnetwork in the 10.0.0.0 net.
+        The method queries all networks that are reachable by the currently
+        known network interfaces.
+        Search starts at 10.1.1.0.
+
+        TODO Enable to select range for subnets, e.g., (10.2.3.0, 10.42.6.0)
+
+        :returns: First valid IP address in the subnet/CIDR_Mask as string
+        :raises: RuntimeError if out of available networks
+        '''
+        for network in Network._unused_subnets(Network._get_used_subnets()):
+            logging.debug('Found free /24 subnet: %s', network)
+            return network
         logging.critical('No unused /24 network availabe in 10.0.0.0')
         raise RuntimeError('No unused /24 network availabe in 10.0.0.0')
 
+    def _allocate_subnet(self):
+        ''' Get an unused /24 subnet for the project's bridge
+
+        The subnet recorded for the project is reused if it is still unused.
+        Otherwise, the first subnet that is neither used by a network
+        interface nor recorded for another project is allocated.
+
+        :returns: First valid IP address in the subnet/CIDR_Mask as string
+        :raises: RuntimeError if out of available networks
+        '''
+        ipset = Network._get_used_subnets()
+        candidates = Network._unused_subnets(ipset)
+        try:
+            current = self.store.load(self.project.name).get('subnet', None)
+            if current and ipset.isdisjoint(netaddr.IPSet([current])):
+                candidates = itertools.chain([current], candidates)
+            network = self.store.allocate(self.project.name, 'subnet', candidates)
+        except sqlite3.Error as exception:
+            logging.warning('Cannot record subnet in the state database: %s', exception)
+            return Network._get_unused_subnet()
+        except RuntimeError:
+            logging.critical('No unused /24 network availabe in 10.0.0.0')
+            raise RuntimeError('No unused /24 network availabe in 10.0.0.0')
+        logging.debug('Allocated /24 subnet: %s', network)
+        return network
+
     def get_ip(self, container):
         ''' Get IP address
 
         Get the first unused IP address in the network associated bridge.
+        The address is recorded in the state database and the container keeps
+        its recorded address as long as it is in the network and not used by
+        another container. Addresses recorded for stopped containers are not
+        reused.
 
         :returns: IP address as string
         :raises: RuntimeError if out of available addresses
         '''
-        used = self._get_used_ips()
         bridge_ip, bridge_cidr = Network._if_to_ip(self.bridge)
         network = netaddr.IPNetwork('%s/%s' % (bridge_ip, bridge_cidr))
-        used.extend([bridge_ip, str(network.broadcast)])
-        used = [netaddr.IPAddress(u) for u in used]
-        logging.debug('IP addresses in use: %s', used)
-        for ipaddr in netaddr.IPRange(network.first+1, network.last-1):
-            if ipaddr not in used:
-                ipaddr = '%s/%s' % (str(ipaddr), bridge_cidr)
-                container.logger.debug('Found unused IP address: %s', ipaddr)
-                return ipaddr
-        raise RuntimeError('Network out of IP addresses')
+        candidates = [str(ipaddr) for ipaddr in netaddr.IPRange(network.first+1, network.last-1)]
+        current = container.recorded.get('ip', None)
+        if current in candidates:
+            candidates.insert(0, current)
+        reserved = [bridge_ip, str(network.broadcast)] + self._get_unrecorded_ips(container)
+        try:
+            ipaddr = container.recorded.allocate('ip', candidates, reserved)
+        except sqlite3.Error as exception:
+            container.logger.warning('Cannot record IP address in the state database: %s', exception)
+            reserved = set(reserved + self._get_used_ips())
+            ipaddr = next((ip for ip in candidates if ip not in reserved), None)
+        except RuntimeError:
+            ipaddr = None
+        if ipaddr is None:
+            raise RuntimeError('Network out of IP addresses')
+        ipaddr = '%s/%s' % (ipaddr, bridge_cidr)
+        container.logger.debug('Found unused IP address: %s', ipaddr)
+        return ipaddr
 
     @staticmethod
     def _if_to_ip(iface, all_ips=False):
@@ -5,16 +5,29 @@ a Locker command and may handle selected containers in the project.
 '''
 
 import logging
+import os
 import re
+import sqlite3
 import sys
 from functools import wraps
 
 import locker
+import locker.attach
+import locker.dns
+import locker.health
+import locker.logs
+import locker.reconcile
+import locker.rollout
+import locker.transfer
+import locker.watch
 import prettytable
 from colorama import Fore
-from locker.container import CommandFailed, Container
-from locker.etchosts import Hosts
+from locker.config import ProjectConfig
+from locker.container import CommandFailed, Container, stop_containers
+from locker.etchosts import Hosts, merge_block
 from locker.network import Network
+from locker.state import StateStore
+from locker.template import TemplateCache
 from locker.util import break_and_add_color, regex_project_name, rules_to_str
 
 
@@ -106,6 +119,18 @@ class Project(object):
             raise TypeError('Invalid type for yml: %s' % type(value))
         self._yml = value
 
+    @property
+    def config(self):
+        ''' Get compiled project configuration '''
+        return self._config
+
+    @config.setter
+    def config(self, value):
+        ''' Set compiled project configuration '''
+        if not isinstance(value, ProjectConfig):
+            raise TypeError('Invalid type for config: %s' % type(value))
+        self._config = value
+
     @property
     def network(self):
         ''' Get the network instance '''
@@ -118,19 +143,39 @@ class Project(object):
             raise TypeError('Invalid type for network: %s' % type(value))
         self._network = value
 
-    def __init__(self, yml, args):
+    def __init__(self, yml, args, config=None):
         ''' Initialize a new project instance
 
         :param yml: YAML configuration file of the project
         :param args: Parsed command line parameters
+        :param config: Compiled configuration (ProjectConfig), will be compiled
+                       from yml if None
         '''
         self.args = args
         self.name = args['project']
+        self.yml = yml
+        self.config = config if config is not None else ProjectConfig.compile(yml)
         self.network = Network(self)
         containers, all_containers = Container.get_containers(self, yml)
         self.containers = containers
         self.all_containers = all_containers
-        self.yml = yml
+
+    def select(self, args):
+        ''' Reuse the project for another command
+
+        Selects the containers of the command, looks up the bridge again, and
+        discards the recorded state read by previous commands. The
+        configuration must not have been changed.
+
+        :param args: Parsed command line parameters of the command
+        '''
+        self.args = args
+        selected = args.get('containers', None) or []
+        self.containers = [con for con in self.all_containers
+                           if not selected or con.name.split('_', 1)[1] in selected]
+        for container in self.all_containers:
+            container.refresh()
+        self.network.refresh()
 
     def get_container(self, name):
         ''' Get container based on name (excluding project prefix)
@@ -155,7 +200,7 @@ class Project(object):
         if not self.args.get('extended', False):
             header = ['Def.', 'Name', 'FQDN', 'State', 'IPs', 'Ports', 'Links']
         else:
-            header = ['Def.', 'Name', 'FQDN', 'State', 'IPs', 'Ports', 'Links', 'CPUs', 'Shares', 'Memory [MB]']
+            header = ['Def.', 'Name', 'FQDN', 'State', 'IPs', 'Ports', 'Links', 'Storage', 'CPUs', 'Shares', 'Memory [MB]']
         table = prettytable.PrettyTable(header)
         table.align = 'l'
         table.hrules = prettytable.HEADER
@@ -164,11 +209,14 @@ class Project(object):
         table.align['Shares'] = 'r'
         table.align['Memory [MB]'] = 'r'
 
+        health = locker.health.check(containers)
         for container in containers:
             defined = container.defined
             name = container.name.split('_')[1]
             state = container.state
-            fqdn = container.yml.get('fqdn', '')
+            if health[container.name]:
+                state = '%s (%s)' % (state, health[container.name])
+            fqdn = container.config.fqdn or ''
             ips = container.get_ips()
             if ips:
                 ips = ','.join(ips)
@@ -198,7 +246,8 @@ class Project(object):
                     mem_used = 0
                 memory = '%s/%s' % (mem_used, mem_limit)
 
-                values = [defined, name, fqdn, state, ips, ports, linked_to, cpus, cpu_shares, memory]
+                storage = container.backing_store or ''
+                values = [defined, name, fqdn, state, ips, ports, linked_to, storage, cpus, cpu_shares, memory]
                 row = ['%s%s%s' % (container.color, x, reset_color) for x in values]
                 table.add_row(row)
         sys.stdout.write(table.get_string()+'\n')
@@ -208,37 +257,80 @@ class Project(object):
         ''' Start all or selected containers
 
         Starts the container, sets cgroup settings and optionally set ports.
-        Subsequently, all links of all containers are updated.
+        The containers are started in dependency waves, see start_waves().
+        Subsequently, all links of all containers are updated, containers
+        that are not ready are not linked.
 
         :param containers: List of containers or None (== all containers)
         '''
         self.network.start()
-        for container in containers:
-            try:
-                container.start()
-                container.cgroup()
-                if not self.args.get('no_ports', False):
-                    container.ports(indirect=True)
-            except CommandFailed:
-                pass
+        unhealthy = self.start_waves(containers)
         if not self.args.get('no_links', False):
-            self.links(containers=self.all_containers, auto_update=True)
+            self.links(containers=self.all_containers, auto_update=True, exclude=unhealthy)
+        else:
+            locker.dns.notify(self.name)
         if self.args.get('add_hosts', False):
             self._update_etc_hosts()
 
+    def start_waves(self, containers):
+        ''' Start containers in dependency waves
+
+        A container is only started after the containers it links to are
+        ready, and its ports are only set when its healthcheck succeeded, see
+        locker.health. Links are not updated.
+
+        :param containers: List of containers
+        :returns: Set of the names (without project prefix) of the containers
+                  that failed to start or are not ready
+        '''
+        unhealthy = set()
+        for wave in locker.health.dependency_waves(containers):
+            started = list()
+            for container in wave:
+                failed = [link.name for link in container.config.links if link.name in unhealthy]
+                if failed:
+                    container.logger.error('Not starting, linked containers are not ready: %s', ', '.join(failed))
+                    unhealthy.add(container.config.name)
+                    continue
+                try:
+                    container.start()
+                    container.cgroup()
+                    started.append(container)
+                except CommandFailed:
+                    unhealthy.add(container.config.name)
+            ready = locker.health.wait_ready(started)
+            for container in started:
+                if not ready[container.name]:
+                    unhealthy.add(container.config.name)
+                    continue
+                try:
+                    if not self.args.get('no_ports', False):
+                        container.ports(indirect=True)
+                except CommandFailed:
+                    pass
+        return unhealthy
+
     @container_list
     def reboot(self, *, containers=None):
         ''' Reboot all or selected containers
 
-        This method runs the stop command and then the start command to ensure
-        that all netfilter rules and links are removed and re-added.
+        Running containers are rebooted in place, i.e., their netfilter rules
+        and links are kept, see Container.reboot(). The stop command and then
+        the start command are run to remove and re-add all netfilter rules and
+        links if the "full" argument is set, if the container is stopped, or
+        if its FQDN, volumes, DNS servers, or console log changed since it was
+        started.
 
         :param containers: List of containers or None (== all containers)
         '''
         for container in containers:
             try:
-                self.stop(containers=[container])
-                self.start(containers=[container])
+                if (self.args.get('full', False) or not container.running or
+                        container.recorded.get('started', None) != container.config.start_digest()):
+                    self.stop(containers=[container])
+                    self.start(containers=[container])
+                else:
+                    container.reboot()
             except CommandFailed:
                 pass
 
@@ -246,29 +338,71 @@ class Project(object):
     def stop(self, containers=None):
         ''' Stop all or selected containers
 
+        The containers are stopped in parallel, containers that did not shut
+        down within the timeout are killed, see stop_containers().
+
         :param containers: List of containers or None (== all containers)
         '''
-        for container in containers:
-            try:
-                container.stop()
-                if not self.args.get('no_ports', False):
-                    self.rmports(containers=[container])
-            except CommandFailed:
-                pass
+        stop_containers(containers, self.args.get('timeout', 30))
+        stopped = [con for con in containers if not con.running]
+        if stopped and not self.args.get('no_ports', False):
+            self.rmports(containers=stopped)
         if not self.args.get('no_links', False):
             self.links(containers=self.all_containers, auto_update=True)
+        else:
+            locker.dns.notify(self.name)
         if self.args.get('add_hosts', False):
             self._update_etc_hosts()
 
+    def _get_template_bases(self, containers):
+        ''' Get cached base containers for containers created from templates
+
+        Containers are grouped by their normalized template configuration.
+        A base container is used (and created if necessary) for every group
+        with more than one container or if a fresh base container exists
+        already.
+
+        :param containers: List of containers
+        :returns: dict of container name -> name of the base container
+        '''
+        if not self.args.get('template_cache', False):
+            return {}
+        groups = dict()
+        for container in containers:
+            if container.defined or not container.config.template:
+                continue
+            groups.setdefault(container.config.template, []).append(container)
+
+        cache = TemplateCache(self.args.get('lxcpath', '/var/lib/lxc'),
+                              self.args.get('template_ttl', 7*24*3600),
+                              self.args.get('verbose', False))
+        bases = dict()
+        for template, members in groups.items():
+            if len(members) < 2 and not cache.has_fresh(template):
+                continue
+            base = cache.get(template)
+            if not base:
+                logging.warning('Falling back to running the template for: %s',
+                                ', '.join(con.name for con in members))
+                continue
+            for container in members:
+                bases[container.name] = base
+        return bases
+
     @container_list
     def create(self, *, containers=None):
         ''' Create all or selected containers
 
+        With "template_cache", containers with identical template
+        configuration are cloned from a cached base container so that each
+        template runs only once.
+
         :param containers: List of containers or None (== all containers)
         '''
+        bases = self._get_template_bases(containers)
         for container in containers:
             try:
-                container.create()
+                container.create(base=bases.get(container.name, None))
             except CommandFailed:
                 pass
             except ValueError:
@@ -315,16 +449,19 @@ class Project(object):
                 pass
 
     @container_list
-    def links(self, *, containers=None, auto_update=False):
+    def links(self, *, containers=None, auto_update=False, exclude=()):
         ''' Add links in all or selected containers
 
         :param containers: List of containers or None (== all containers)
+        :param exclude: Names (without project prefix) of containers that must
+                        not be linked to, e.g., because they are not ready
         '''
         for container in containers:
             try:
-                container.links(auto_update)
+                container.links(auto_update, exclude)
             except CommandFailed:
                 pass
+        locker.dns.notify(self.name)
 
     @container_list
     def rmlinks(self, *, containers=None):
@@ -337,6 +474,7 @@ class Project(object):
                 container.rmlinks()
             except CommandFailed:
                 pass
+        locker.dns.notify(self.name)
 
     @container_list
     def cgroup(self, *, containers=None):
@@ -388,27 +526,185 @@ class Project(object):
             return
         self.network.stop()
 
-    def _update_etc_hosts(self):
-        ''' Add containers hostnames to /etc/hosts for name resolution
+    def dns(self):
+        ''' Run the project's DNS responder until interrupted
+
+        The responder resolves the names of the containers and their links,
+        see locker.dns.
         '''
-        logging.debug('Updating /etc/hosts')
-        etc_hosts = '/etc/hosts'
-        try:
-            hosts = Hosts(etc_hosts, logger=logging.getLogger(), lax=True)
-            num_removed = hosts.remove_by_comment('^%s_.*$' % (self.name))
-            logging.debug('Removed %d entries from %s', num_removed, etc_hosts)
-            hosts.save()
-        except Exception as exception:
-            logging.warn('Some exception occured: ', exception)
-            return
+        self.network.start()
+        locker.dns.serve(self, host=self.args.get('listen', None),
+                         port=self.args.get('port', 53),
+                         upstream=self.args.get('upstream', None),
+                         ttl=self.args.get('ttl', 5))
+
+    def up(self):
+        ''' Create, start, and update the selected containers as configured
 
+        Compares the configuration with the actual state of the containers
+        and executes only the steps that are necessary, see locker.reconcile.
+        The steps are only printed if the "plan" argument is set.
+
+        :returns: List of executed (or planned) steps
+        '''
+        return locker.reconcile.up(self)
+
+    @container_list
+    def execute(self, *, containers=None):
+        ''' Run a command in all or selected containers in parallel
+
+        The command is the "cmd" argument, at most "parallel" commands run
+        at the same time, see locker.attach.
+
+        :param containers: List of containers or None (== all containers)
+        :returns: 0 if the command succeeded in all running containers, else 1
+        '''
+        results = locker.attach.run(containers, self.args['cmd'], self.args.get('parallel', 8))
+        return locker.attach.summary(results, containers)
+
+    @container_list
+    def copy(self, *, containers=None):
+        ''' Copy files between the host and all or selected containers
+
+        The path in the containers ("source" or "destination" argument) is
+        prefixed with ":", e.g., ":/etc/hosts". Files are pushed into or
+        pulled from at most "parallel" containers at the same time, see
+        locker.transfer.
+
+        :param containers: List of containers or None (== all containers)
+        :returns: 0 if the files were copied for all containers, else 1
+        :raises: ValueError if neither or both paths refer to the containers
+        '''
+        source, destination = self.args['source'], self.args['destination']
+        if source.startswith(':') == destination.startswith(':'):
+            raise ValueError('Either the source or the destination must be a path in the containers, e.g., ":/etc/hosts"')
+        parallel = self.args.get('parallel', 8)
+        if destination.startswith(':'):
+            results = locker.transfer.push(containers, source, destination[1:], parallel)
+        else:
+            results = locker.transfer.pull(containers, source[1:], destination, parallel)
+        return locker.transfer.summary(results, containers)
+
+    @container_list
+    def logs(self, *, containers=None):
+        ''' Show the logs of all or selected containers
+
+        Shows the last "lines" lines of the console logs or of the files in
+        the containers given by the "path" argument, merged in timestamp
+        order, and follows them until interrupted if "follow" is set, see
+        locker.logs.
+
+        :param containers: List of containers or None (== all containers)
+        '''
+        locker.logs.logs(containers,
+                         paths=self.args.get('path', None),
+                         lines=self.args.get('lines', 10),
+                         follow=self.args.get('follow', False))
+
+    def rollout(self):
+        ''' Restart the selected, running containers in batches
+
+        Waits until each batch is ready before the next one is restarted,
+        see locker.rollout.
+
+        :returns: True if all containers were restarted and are ready
+        '''
+        return locker.rollout.rollout(self)
+
+    def watch(self):
+        ''' Apply changes of the configuration file until interrupted
+
+        Only the changed settings of the selected, running containers are
+        applied, see locker.watch.
+        '''
+        locker.watch.watch(self)
+
+    def rebuild_state(self):
+        ''' Rebuild the recorded state from the live state of the containers
+
+        Replaces the recorded state of all defined containers of the project,
+        drops the records of containers that do not exist anymore, and
+        records the subnet of the project's bridge, see locker.state.
+        '''
+        store = StateStore.open(self.args.get('lxcpath', '/var/lib/lxc'))
+        prefix = '%s_' % self.name
+        defined = set()
+        for container in self.all_containers:
+            if container.defined:
+                container.rebuild_state()
+                defined.add(container.name)
+        try:
+            for name in store.names():
+                if name.startswith(prefix) and name not in defined:
+                    logging.info('Dropping recorded state of removed container: %s', name)
+                    store.forget(name)
+            if self.network._bridge is not None:
+                bridge_ip, bridge_cidr = Network._if_to_ip(self.network.bridge)
+                store.update(self.name, {'subnet': '%s/%s' % (bridge_ip, bridge_cidr)})
+        except sqlite3.Error as exception:
+            logging.error('Could not rebuild the recorded state: %s', exception)
+
+    def _get_hosts_entries(self):
+        ''' Get the hosts entries of the running containers
+
+        :returns: List of tuples (IP address, names, comment)
+        '''
+        entries = list()
         for container in [con for con in self.all_containers if con.running]:
             for ipaddr in container.get_ips():
-                fqdn = container.yml.get('fqdn', None)
+                fqdn = container.config.fqdn
                 hostname = None
                 if fqdn:
                     hostname = fqdn.split('.')[0]
                 names = [n for n in [fqdn, hostname, container.name] if n]
-                comment = container.name
+                entries.append((ipaddr, names, container.name))
+        return entries
+
+    def _update_etc_hosts(self):
+        ''' Add containers hostnames to /etc/hosts for name resolution
+
+        Depending on the "hosts_mode" argument, the entries are added directly
+        to /etc/hosts ("etc"), to the project's hosts fragment
+        "HOSTS_DIR/PROJECT.hosts" that may be used, e.g., as "addn-hosts" file
+        of dnsmasq ("fragment"), or to the fragment which is then merged as a
+        delimited block into /etc/hosts ("merge").
+        '''
+        mode = self.args.get('hosts_mode', None) or 'etc'
+        if mode == 'etc':
+            self._update_hosts_file('/etc/hosts')
+            return
+        hosts_dir = self.args.get('hosts_dir', None) or '/run/locker'
+        fragment = os.path.join(hosts_dir, '%s.hosts' % self.name)
+        try:
+            os.makedirs(hosts_dir, exist_ok=True)
+        except OSError as exception:
+            logging.warning('Cannot create hosts directory %s: %s', hosts_dir, exception)
+            return
+        hosts = self._update_hosts_file(fragment, missing_ok=True)
+        if mode == 'merge' and hosts is not None:
+            try:
+                if merge_block('/etc/hosts', self.name, hosts.dumps()):
+                    logging.debug('Merged %s into /etc/hosts', fragment)
+            except OSError as exception:
+                logging.warning('Cannot merge %s into /etc/hosts: %s', fragment, exception)
+
+    def _update_hosts_file(self, hosts_file, missing_ok=False):
+        ''' Replace the project's entries in a hosts file
+
+        :param hosts_file: Path to the hosts file
+        :param missing_ok: Create the file if it does not exist
+        :returns: Hosts instance or None on failure
+        '''
+        logging.debug('Updating %s', hosts_file)
+        try:
+            hosts = Hosts(hosts_file, logger=logging.getLogger(), lax=True,
+                          missing_ok=missing_ok)
+            num_removed = hosts.remove_by_comment_prefix(self.name)
+            logging.debug('Removed %d entries from %s', num_removed, hosts_file)
+            for ipaddr, names, comment in self._get_hosts_entries():
                 hosts.add(ipaddr, names, comment)
-        hosts.save()
+            hosts.save()
+        except Exception as exception:
+            logging.warning('Could not update %s: %s', hosts_file, exception)
+            return None
+        return hosts
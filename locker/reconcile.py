@@ -0,0 +1,284 @@
+'''
+This module reconciles the actual state of a project with its configuration.
+
+A snapshot of the actual state is taken once: the defined and running
+containers and their IP addresses from lxc, the port forwarding rules from
+netfilter, and the links and settings Locker recorded when it applied them
+(see locker.state). The snapshot is compared with the YAML configuration to
+compute a minimal plan of steps, e.g., create a container, restart a container
+because its volumes changed, or update the links of a container. Only these
+steps are executed.
+'''
+
+import logging
+import sys
+from collections import OrderedDict, namedtuple
+
+import iptc
+import locker.dns
+import lxc
+from locker.container import CommandFailed
+from locker.etchosts import Hosts
+from locker.network import synchronized_netfilter
+
+# actions in the order of their execution
+ACTIONS = ['network', 'create', 'start', 'restart', 'cgroup', 'ports', 'links', 'hosts']
+
+
+class Step(namedtuple('Step', ['action', 'container', 'reason'])):
+    ''' A step of a plan, "container" is None for project-wide steps '''
+    __slots__ = ()
+
+    def __str__(self):
+        return '%-8s %-20s %s' % (self.action, self.container or '-', self.reason)
+
+class Snapshot(namedtuple('Snapshot', ['bridge', 'defined', 'running', 'ips', 'ports'])):
+    ''' Actual state of a project
+
+    "defined" and "running" are sets of container names, "ips" maps the names
+    of running containers to their IP addresses, and "ports" maps container
+    names to sets of port forwarding rules (proto, host IP, host port,
+    container IP, container port).
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def capture(cls, project):
+        ''' Take a snapshot of the actual state of a project
+
+        :param project: Project instance
+        :returns: Snapshot
+        '''
+        lxcpath = project.args.get('lxcpath', '/var/lib/lxc')
+        names = set(con.name for con in project.all_containers)
+        defined = names & set(lxc.list_containers(active=False, defined=True, config_path=lxcpath))
+        running = names & set(lxc.list_containers(active=True, defined=False, config_path=lxcpath))
+        ips = dict()
+        for container in project.all_containers:
+            if container.name in running:
+                ips[container.name] = tuple(container.get_ips(retries=0) or [])
+        return cls(project.network._bridge is not None, defined, running, ips, _port_rules(names))
+
+@synchronized_netfilter
+def _port_rules(names):
+    ''' Get the port forwarding rules of containers with a single chain scan
+
+    :param names: Names of the containers
+    :returns: Dictionary of container name to set of rules
+    '''
+    rules = dict()
+    try:
+        chain = iptc.Chain(iptc.Table(iptc.Table.NAT), 'LOCKER_PREROUTING')
+        for rule in chain.rules:
+            if rule.protocol not in ['tcp', 'udp']:
+                continue
+            comments = [m.comment for m in rule.matches if m.name == 'comment']
+            if not comments or comments[0] not in names:
+                continue
+            dport = [m.dport for m in rule.matches if m.name in ['tcp', 'udp']][0]
+            to_ip, to_port = rule.target.to_destination.split(':')
+            rules.setdefault(comments[0], set()).add(
+                (rule.protocol, _host_ip(rule.dst), str(dport), to_ip, str(to_port)))
+    except iptc.IPTCError as exception:
+        logging.warning('Could not read the netfilter rules: %s', exception)
+    return rules
+
+def _host_ip(dst):
+    ''' Normalize the destination of a rule, e.g., "0.0.0.0/0.0.0.0" -> None '''
+    if not dst:
+        return None
+    dst = dst.split('/')[0]
+    return None if dst == '0.0.0.0' else dst
+
+def desired_ports(container, ips):
+    ''' Get the port forwarding rules of a container as configured
+
+    :param container: Container instance
+    :param ips: IP addresses of the container
+    :returns: Set of rules, see Snapshot
+    '''
+    return set((port.proto, port.host_ip or None, str(port.host_port), ip, str(port.container_port))
+               for port in container.config.ports for ip in ips)
+
+def desired_links(container, project, running):
+    ''' Get the names of the containers a container is linked to as configured
+
+    :param container: Container instance
+    :param project: Project instance
+    :param running: Names of the containers that are running after the plan
+    :returns: List of the names (without the project prefix)
+    '''
+    linked = list()
+    for link in container.config.links:
+        target = project.get_container(link.name)
+        if target and target.name in running:
+            linked.append(link.name)
+    return list(OrderedDict.fromkeys(linked))
+
+def plan(project, snapshot):
+    ''' Compute the steps to reconcile the selected containers
+
+    The selected containers shall be defined, running, and have their current
+    configuration applied. Other containers are not changed except for their
+    links if a linked container is (re)started.
+
+    :param project: Project instance
+    :param snapshot: Snapshot of the actual state
+    :returns: List of steps
+    '''
+    steps = list()
+    started = set()
+    running = set(snapshot.running)
+    no_ports = project.args.get('no_ports', False)
+    for container in project.containers:
+        name = container.name
+        if name not in snapshot.defined:
+            steps.append(Step('create', name, 'not defined'))
+        if name not in snapshot.running:
+            steps.append(Step('start', name, 'not running'))
+            started.add(name)
+            running.add(name)
+            continue
+        recorded = container.recorded.get('started', None)
+        if recorded is not None and recorded != container.config.start_digest():
+            steps.append(Step('restart', name, 'fqdn, volumes, dns, or console log changed'))
+            started.add(name)
+            continue
+        cgroup = [list(item) for item in container.config.cgroup]
+        if container.recorded.get('cgroup', None) != cgroup:
+            steps.append(Step('cgroup', name, 'cgroup settings changed'))
+        if not no_ports and desired_ports(container, snapshot.ips.get(name, ())) != snapshot.ports.get(name, set()):
+            steps.append(Step('ports', name, 'port forwarding rules differ'))
+
+    if started and not snapshot.bridge:
+        steps.insert(0, Step('network', None, 'bridge does not exist'))
+
+    if not project.args.get('no_links', False):
+        for container in project.all_containers:
+            name = container.name
+            if name not in running:
+                continue
+            if name in started:
+                # links are always updated after (re)starting
+                steps.append(Step('links', name, 'container (re)started'))
+                continue
+            targets = desired_links(container, project, running)
+            restarted = [t for t in targets if project.get_container(t).name in started]
+            if restarted:
+                steps.append(Step('links', name, 'linked container (re)started: %s' % ', '.join(restarted)))
+            elif container.recorded.get('links', None) != targets:
+                steps.append(Step('links', name, 'links differ'))
+
+    if project.args.get('add_hosts', False) and (started or _hosts_differ(project, snapshot)):
+        steps.append(Step('hosts', None, 'hosts entries differ'))
+    return sorted(steps, key=lambda step: ACTIONS.index(step.action))
+
+def _hosts_differ(project, snapshot):
+    ''' Check if the project's entries in the hosts file are outdated '''
+    mode = project.args.get('hosts_mode', None) or 'etc'
+    if mode == 'etc':
+        hosts_file = '/etc/hosts'
+    else:
+        hosts_file = '%s/%s.hosts' % (project.args.get('hosts_dir', None) or '/run/locker', project.name)
+    try:
+        hosts = Hosts(hosts_file, logger=logging.getLogger(), lax=True, missing_ok=True)
+    except OSError:
+        return True
+    actual = set((row.ip_key, tuple(row.names)) for row in hosts.get_rows_by_comment_prefix(project.name))
+    desired = set()
+    for container in project.all_containers:
+        fqdn = container.config.fqdn
+        hostname = fqdn.split('.')[0] if fqdn else None
+        names = tuple(n for n in [fqdn, hostname, container.name] if n)
+        for ip in snapshot.ips.get(container.name, ()):
+            desired.add((ip, names))
+    return actual != desired
+
+def _start(project, steps):
+    ''' Execute the start and restart steps of a plan
+
+    The containers of restart steps are stopped, then all containers are
+    started in dependency waves like by "locker start", see
+    Project.start_waves().
+
+    :param project: Project instance
+    :param steps: List of the start and restart steps
+    :returns: Set of the names (without project prefix) of the containers
+              that failed to start or are not ready
+    '''
+    containers = list()
+    for step in steps:
+        logging.info('%s', step)
+        container = project.get_container(step.container.split('_', 1)[1])
+        if step.action == 'restart':
+            try:
+                container.stop()
+                if not project.args.get('no_ports', False):
+                    container.rmports()
+            except CommandFailed as exception:
+                logging.error('Step failed: %s: %s', step, exception)
+                continue
+        containers.append(container)
+    return project.start_waves(containers)
+
+def execute(project, steps):
+    ''' Execute the steps of a plan
+
+    The start and restart steps are executed together, see _start(), and
+    containers that are not ready are not linked to.
+
+    :param project: Project instance
+    :param steps: List of steps, see plan()
+    '''
+    def _get(name):
+        return project.get_container(name.split('_', 1)[1])
+
+    no_ports = project.args.get('no_ports', False)
+    starts = [step for step in steps if step.action in ('start', 'restart')]
+    unhealthy = set()
+    for step in steps:
+        if step.action in ('start', 'restart'):
+            if step is starts[0]:
+                unhealthy = _start(project, starts)
+            continue
+        logging.info('%s', step)
+        container = _get(step.container) if step.container else None
+        try:
+            if step.action == 'network':
+                project.network.start()
+            elif step.action == 'create':
+                project.create(containers=[container])
+            elif step.action == 'cgroup':
+                container.cgroup()
+            elif step.action == 'ports' and not no_ports:
+                container.rmports()
+                container.ports()
+            elif step.action == 'links':
+                container.links(auto_update=True, exclude=unhealthy)
+            elif step.action == 'hosts':
+                project._update_etc_hosts()
+        except CommandFailed as exception:
+            logging.error('Step failed: %s: %s', step, exception)
+    if any(step.action in ('start', 'restart', 'links') for step in steps):
+        locker.dns.notify(project.name)
+
+def up(project):
+    ''' Reconcile the selected containers of a project with the configuration
+
+    Prints the plan and returns if the "plan" argument is set.
+
+    :param project: Project instance
+    :returns: List of steps
+    '''
+    steps = plan(project, Snapshot.capture(project))
+    if project.args.get('plan', False):
+        for step in steps:
+            sys.stdout.write('%s\n' % step)
+        if not steps:
+            sys.stdout.write('Nothing to do\n')
+        return steps
+    if not steps:
+        logging.info('Project is up to date')
+        return steps
+    execute(project, steps)
+    return steps
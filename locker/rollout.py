@@ -0,0 +1,120 @@
+'''
+This module restarts the containers of a project in batches ("locker
+rollout") so that the other containers keep serving while a batch restarts.
+
+At most "max_unavailable" containers are restarted at the same time. The
+next batch is only restarted when all containers of the current batch are
+ready, i.e., their healthcheck succeeds (see locker.health) or, without
+healthcheck, they are running, have an IP address, and accept connections on
+the container ports of their TCP port forwarding rules. The rollout is
+aborted if a batch does not become ready within "ready_timeout" seconds. The
+containers of the remaining batches are not restarted and keep running with
+the configuration they were started with.
+'''
+
+import logging
+import socket
+import time
+
+import locker.health
+
+# seconds between the readiness checks
+READY_INTERVAL = 0.5
+
+# seconds to wait for a TCP connection
+CONNECT_TIMEOUT = 1
+
+
+def batches(containers, max_unavailable):
+    ''' Split the containers into batches
+
+    :param containers: List of containers
+    :param max_unavailable: Maximum number of containers per batch
+    :returns: List of lists of containers
+    '''
+    size = max(1, max_unavailable)
+    return [containers[num:num + size] for num in range(0, len(containers), size)]
+
+def _port_open(ip, port):
+    ''' Check if a TCP port accepts connections '''
+    try:
+        with socket.create_connection((ip, port), timeout=CONNECT_TIMEOUT):
+            return True
+    except OSError:
+        return False
+
+def is_ready(container):
+    ''' Check if a container is ready to serve
+
+    :param container: Container instance
+    :returns: True if the container is running and its healthcheck succeeds,
+              or, without healthcheck, if it has an IP address and accepts
+              connections on the container ports of its TCP port forwarding
+              rules
+    '''
+    if container.config.healthcheck is not None:
+        return locker.health.check([container])[container.name] == 'healthy'
+    if not container.running:
+        return False
+    ips = container.get_ips(retries=0)
+    if not ips:
+        return False
+    ports = sorted(set(int(port.container_port) for port in container.config.ports if port.proto == 'tcp'))
+    return all(_port_open(ips[0], port) for port in ports)
+
+def wait_ready(containers, timeout, interval=READY_INTERVAL, check=is_ready):
+    ''' Wait until containers are ready
+
+    :param containers: List of containers
+    :param timeout: Maximum time to wait in seconds
+    :param interval: Seconds between the checks
+    :param check: Function that checks if a container is ready
+    :returns: List of the containers that are not ready after the timeout
+    '''
+    deadline = time.time() + timeout
+    pending = list(containers)
+    while True:
+        pending = [con for con in pending if not check(con)]
+        now = time.time()
+        if not pending or now >= deadline:
+            return pending
+        time.sleep(min(interval, deadline - now))
+
+def rollout(project, restart=None, check=is_ready):
+    ''' Restart the selected, running containers of a project in batches
+
+    :param project: Project instance
+    :param restart: Function that restarts a list of containers, defaults to
+                    stopping and starting them with the project
+    :param check: Function that checks if a container is ready
+    :returns: True if all containers were restarted and are ready
+    '''
+    if restart is None:
+        def restart(containers):
+            project.stop(containers=containers)
+            project.start(containers=containers)
+
+    containers = list()
+    for container in project.containers:
+        if container.running:
+            containers.append(container)
+        else:
+            container.logger.info('Not running, skipping')
+    max_unavailable = project.args.get('max_unavailable', 1)
+    timeout = project.args.get('ready_timeout', 60)
+    todo = batches(containers, max_unavailable)
+    for num, batch in enumerate(todo, 1):
+        names = ', '.join(con.name for con in batch)
+        logging.info('Restarting batch %d of %d: %s', num, len(todo), names)
+        begin = time.time()
+        restart(batch)
+        failed = wait_ready(batch, timeout, check=check)
+        if failed:
+            for container in failed:
+                container.logger.error('Not ready after %ds', timeout)
+            remaining = [con.name for rest in todo[num:] for con in rest]
+            logging.error('Aborting rollout, not restarted: %s', ', '.join(remaining) or '-')
+            return False
+        logging.info('Batch %d of %d ready after %.2fs', num, len(todo), time.time() - begin)
+    logging.info('Rollout completed: %d containers restarted', len(containers))
+    return True
@@ -0,0 +1,302 @@
+'''
+This module provides a built-in validator for the YAML project configuration.
+
+The validator supports the subset of the `pykwalify` schema language that is
+used by Locker's schema file, extended by "any-of" to allow alternative rules.
+Each schema is compiled into a tree of checker closures, so validating a
+configuration only walks the document once. Rule keys outside of the subset
+are rejected instead of being ignored. The compiled validators are cached by
+the schema's hash in the process, i.e., the Locker daemon compiles a schema
+only once while each invocation of the command line interface without the
+daemon compiles it again (in a few milliseconds for Locker's schema).
+'''
+
+import hashlib
+import os
+import re
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+default_schema = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.yaml')
+
+# compiled validators by SHA-256 hash of the schema file (in this process)
+_validators = dict()
+
+# supported keys of all rules, see _type_keys for the type specific keys
+_rule_keys = set(['type', 'required', 'pattern', 'enum', 'desc'])
+_type_keys = {
+    'map':  set(['mapping', 'matching-rule']),
+    'seq':  set(['sequence']),
+}
+
+
+class SchemaError(ValueError):
+    ''' The schema itself is invalid or uses unsupported features '''
+    pass
+
+class ValidationError(ValueError):
+    ''' The configuration does not comply to the schema
+
+    The "errors" attribute contains a list of (path, message) tuples where the
+    path points to the invalid element, e.g., "/containers/web/ports/1".
+    '''
+
+    def __init__(self, errors):
+        self.errors = errors
+        ValueError.__init__(self, '\n'.join('%s: %s' % (path, msg) for path, msg in errors))
+
+def _is_str(value):
+    return isinstance(value, str)
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_float(value):
+    return isinstance(value, float)
+
+def _is_number(value):
+    return _is_int(value) or _is_float(value)
+
+def _is_bool(value):
+    return isinstance(value, bool)
+
+def _is_map(value):
+    return isinstance(value, dict)
+
+def _is_seq(value):
+    return isinstance(value, list)
+
+def _is_scalar(value):
+    return not isinstance(value, (dict, list))
+
+def _is_text(value):
+    return _is_str(value) or _is_number(value)
+
+def _is_any(value):
+    return True
+
+_type_checks = {
+    'str':      _is_str,
+    'int':      _is_int,
+    'float':    _is_float,
+    'number':   _is_number,
+    'bool':     _is_bool,
+    'map':      _is_map,
+    'seq':      _is_seq,
+    'scalar':   _is_scalar,
+    'text':     _is_text,
+    'any':      _is_any,
+}
+
+def _compile_mapping(rule, schema_path):
+    ''' Compile the "mapping" of a map rule
+
+    :returns: checker function for dictionaries
+    '''
+    mapping = rule.get('mapping', None) or {}
+    if not isinstance(mapping, dict):
+        raise SchemaError('%s: "mapping" must be a map' % schema_path)
+    matching_rule = rule.get('matching-rule', 'any')
+    if matching_rule != 'any':
+        raise SchemaError('%s: Unsupported matching-rule: %s' % (schema_path, matching_rule))
+
+    fixed = dict()
+    patterns = list()
+    required = list()
+    for key, subrule in mapping.items():
+        key = str(key)
+        if key.startswith('re;'):
+            try:
+                regex = re.compile(key[3:])
+            except re.error as exception:
+                raise SchemaError('%s: Invalid regex key %s: %s' % (schema_path, key, exception))
+            patterns.append((regex, _compile_rule(subrule, '%s/%s' % (schema_path, key))))
+            continue
+        fixed[key] = _compile_rule(subrule, '%s/%s' % (schema_path, key))
+        if isinstance(subrule, dict) and subrule.get('required', False):
+            required.append(key)
+
+    def check_mapping(value, path, errors):
+        for key in required:
+            if value.get(key, None) is None:
+                errors.append((path, 'Missing required key: %s' % key))
+        for key, subvalue in value.items():
+            subpath = '%s/%s' % (path, key)
+            checker = fixed.get(str(key), None)
+            if checker is None:
+                for regex, pattern_checker in patterns:
+                    if regex.match(str(key)):
+                        checker = pattern_checker
+                        break
+            if checker is None:
+                errors.append((subpath, 'Key is not allowed: %s' % key))
+                continue
+            checker(subvalue, subpath, errors)
+    return check_mapping
+
+def _compile_sequence(rule, schema_path):
+    ''' Compile the "sequence" of a seq rule
+
+    :returns: checker function for lists
+    '''
+    sequence = rule.get('sequence', None)
+    if not isinstance(sequence, list) or len(sequence) != 1:
+        raise SchemaError('%s: "sequence" must contain exactly one rule' % schema_path)
+    item_checker = _compile_rule(sequence[0], '%s/0' % schema_path)
+
+    def check_sequence(value, path, errors):
+        for num, item in enumerate(value):
+            item_checker(item, '%s/%d' % (path, num), errors)
+    return check_sequence
+
+def _compile_rule(rule, schema_path=''):
+    ''' Compile a schema rule into a checker function
+
+    The checker function has the signature "checker(value, path, errors)" and
+    appends (path, message) tuples to "errors" for each violation.
+
+    :param rule: The rule as parsed from the schema
+    :param schema_path: Path of the rule in the schema (for error messages)
+    :returns: checker function
+    :raises: SchemaError if the rule is invalid or unsupported
+    '''
+    if not isinstance(rule, dict):
+        raise SchemaError('%s: Rule must be a map' % (schema_path or '/'))
+    if 'any-of' in rule:
+        unsupported = set(rule) - set(['any-of', 'required', 'desc'])
+        if unsupported:
+            raise SchemaError('%s: Unsupported keys in rule: %s' % (schema_path or '/', ', '.join(sorted(unsupported))))
+        return _compile_any_of(rule, schema_path)
+    rtype = rule.get('type', 'str')
+    try:
+        type_check = _type_checks[rtype]
+    except KeyError:
+        raise SchemaError('%s: Unsupported type: %s' % (schema_path or '/', rtype))
+    unsupported = set(rule) - _rule_keys - _type_keys.get(rtype, set())
+    if unsupported:
+        raise SchemaError('%s: Unsupported keys in rule: %s' % (schema_path or '/', ', '.join(sorted(unsupported))))
+
+    checks = list()
+    if rtype == 'map':
+        checks.append(_compile_mapping(rule, schema_path))
+    elif rtype == 'seq':
+        checks.append(_compile_sequence(rule, schema_path))
+
+    desc = rule.get('desc', None)
+    if 'pattern' in rule:
+        try:
+            regex = re.compile(rule['pattern'])
+        except re.error as exception:
+            raise SchemaError('%s: Invalid pattern: %s' % (schema_path or '/', exception))
+        expected = desc or 'pattern %s' % rule['pattern']
+
+        def check_pattern(value, path, errors):
+            if not regex.match(str(value)):
+                errors.append((path, 'Invalid value "%s", expected: %s' % (value, expected)))
+        checks.append(check_pattern)
+
+    if 'enum' in rule:
+        enum = rule['enum']
+        if not isinstance(enum, list):
+            raise SchemaError('%s: "enum" must be a sequence' % (schema_path or '/'))
+
+        def check_enum(value, path, errors):
+            if value not in enum:
+                errors.append((path, 'Invalid value "%s", expected one of: %s' % (value, ', '.join(str(x) for x in enum))))
+        checks.append(check_enum)
+
+    def check_rule(value, path, errors):
+        if value is None:
+            # like pykwalify: missing values are only checked via "required"
+            return
+        if not type_check(value):
+            errors.append((path or '/', 'Invalid type %s, expected: %s' % (type(value).__name__, rtype)))
+            return
+        for check in checks:
+            check(value, path, errors)
+    return check_rule
+
+def _compile_any_of(rule, schema_path):
+    ''' Compile a rule with alternative sub-rules
+
+    The value is valid if any of the sub-rules matches. Otherwise, the errors
+    of the first sub-rule that matches the value's type are reported.
+
+    :returns: checker function
+    '''
+    rules = rule['any-of']
+    if not isinstance(rules, list) or not rules:
+        raise SchemaError('%s: "any-of" must be a non-empty sequence' % (schema_path or '/'))
+    alternatives = list()
+    for num, subrule in enumerate(rules):
+        checker = _compile_rule(subrule, '%s/any-of/%d' % (schema_path, num))
+        alternatives.append((_type_checks[subrule.get('type', 'str')], checker))
+    expected = ', '.join(subrule.get('type', 'str') for subrule in rules)
+
+    def check_any_of(value, path, errors):
+        if value is None:
+            return
+        first_errors = None
+        for type_check, checker in alternatives:
+            if not type_check(value):
+                continue
+            alt_errors = list()
+            checker(value, path, alt_errors)
+            if not alt_errors:
+                return
+            if first_errors is None:
+                first_errors = alt_errors
+        if first_errors is None:
+            errors.append((path or '/', 'Invalid type %s, expected one of: %s' % (type(value).__name__, expected)))
+        else:
+            errors.extend(first_errors)
+    return check_any_of
+
+def get_validator(schema_file=None):
+    ''' Get the compiled validator for a schema file
+
+    The schema is only parsed and compiled if no validator for a schema with
+    the same hash has been compiled before in this process.
+
+    :param schema_file: Path to the schema, defaults to Locker's schema
+    :returns: Function that takes the parsed YAML configuration and returns a
+              list of (path, message) tuples
+    :raises: OSError if the schema cannot be read, SchemaError if the schema
+             is invalid
+    '''
+    with open(schema_file or default_schema, 'rb') as schema_fd:
+        content = schema_fd.read()
+    digest = hashlib.sha256(content).hexdigest()
+    try:
+        return _validators[digest]
+    except KeyError:
+        pass
+
+    try:
+        schema = yaml.load(content, Loader=YamlLoader)
+    except yaml.YAMLError as exception:
+        raise SchemaError('Could not parse schema: %s' % exception)
+    checker = _compile_rule(schema)
+
+    def validator(yml):
+        errors = list()
+        checker(yml, '', errors)
+        return errors
+    _validators[digest] = validator
+    return validator
+
+def validate(yml, schema_file=None):
+    ''' Validate the YAML configuration
+
+    :param yml: Parsed YAML configuration
+    :param schema_file: Path to the schema, defaults to Locker's schema
+    :raises: ValidationError if the configuration does not comply to the schema
+    '''
+    errors = get_validator(schema_file)(yml)
+    if errors:
+        raise ValidationError(errors)
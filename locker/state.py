@@ -0,0 +1,388 @@
+'''
+This module records state that Locker applied to the containers, e.g., their
+IP addresses, port forwarding rules, and links.
+
+The state of all containers in a lxcpath is stored in a SQLite database next
+to the containers' directories. Commands like "status" and the IP address
+allocation read the recorded state instead of inspecting the containers, the
+netfilter rules, or the containers' root file systems. All changes are
+written in transactions. A corrupt database is moved aside and the state can
+be rebuilt from the live state of the containers ("locker state rebuild").
+'''
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+STATE_DB = 'locker_state.sqlite'
+
+# state file of older versions in the container's directory, imported once
+LEGACY_STATE_FILE = 'locker_state.json'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+'''
+
+# link entries in a container's /etc/hosts have the comment "PROJECT_NAME"
+_regex_link = re.compile(r'^.* # (?P<project>[a-zA-Z][a-zA-Z\d]*)_(?P<name>.+)$')
+
+# open stores by lxcpath
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+def _synchronized(func):
+    ''' Serialize the access to the database of a StateStore '''
+    @wraps(func)
+    def _synchronized_wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return _synchronized_wrapper
+
+class StateStore(object):
+    ''' Recorded state of the containers and projects in a lxcpath
+
+    Values are recorded by name (of a container or project) and key, and
+    stored as JSON. The database is opened on first access. The store may be
+    used by multiple threads.
+    '''
+
+    def __init__(self, lxcpath, logger=None):
+        ''' Initialize the store
+
+        :param lxcpath: Root path of the containers
+        :param logger: Logger for warnings
+        '''
+        self.lxcpath = lxcpath
+        self.filename = os.path.join(lxcpath, STATE_DB)
+        self.logger = logger or logging.getLogger()
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def open(cls, lxcpath):
+        ''' Get the store of a lxcpath, the instances are shared
+
+        :param lxcpath: Root path of the containers
+        :returns: StateStore
+        '''
+        with _stores_lock:
+            store = _stores.get(lxcpath, None)
+            if store is None:
+                store = cls(lxcpath)
+                _stores[lxcpath] = store
+        return store
+
+    def _open_db(self):
+        ''' Open and check the database, create the tables if necessary
+
+        :raises: sqlite3.DatabaseError if the database is corrupt
+        :raises: sqlite3.OperationalError if the database cannot be opened
+        '''
+        conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None,
+                               check_same_thread=False)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            result = conn.execute('PRAGMA quick_check').fetchone()[0]
+            if result != 'ok':
+                raise sqlite3.DatabaseError(result)
+            conn.executescript(_SCHEMA)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _connect(self):
+        ''' Get the connection to the database
+
+        A corrupt database is renamed to "*.corrupt" and replaced by an empty
+        one, see rebuild of the state.
+
+        :returns: sqlite3.Connection
+        :raises: sqlite3.Error if the database cannot be opened
+        '''
+        if self._conn is not None:
+            return self._conn
+        try:
+            self._conn = self._open_db()
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.DatabaseError as exception:
+            self.logger.warning('Moving corrupt state database %s aside, run \"locker state rebuild\": %s',
+                                self.filename, exception)
+            for suffix in ['', '-wal', '-shm']:
+                try:
+                    os.replace(self.filename + suffix, self.filename + '.corrupt' + suffix)
+                except FileNotFoundError:
+                    pass
+            self._conn = self._open_db()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        ''' Run statements in a transaction that locks the database for writing
+
+        :returns: Context manager providing the connection
+        '''
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @_synchronized
+    def close(self):
+        ''' Close the database '''
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @_synchronized
+    def load(self, name):
+        ''' Get the recorded values of a container or project
+
+        :param name: Name of the container or project
+        :returns: Dictionary of the values by key
+        :raises: sqlite3.Error
+        '''
+        rows = self._connect().execute('SELECT key, value FROM records WHERE name = ?', (name,))
+        return dict((key, json.loads(value)) for key, value in rows)
+
+    @_synchronized
+    def names(self):
+        ''' Get the names of all containers and projects with recorded values
+
+        :returns: Set of names
+        :raises: sqlite3.Error
+        '''
+        return set(name for (name,) in self._connect().execute('SELECT DISTINCT name FROM records'))
+
+    @_synchronized
+    def values(self, key):
+        ''' Get the values of a key of all containers and projects
+
+        :param key: Key of the values, e.g., "ip"
+        :returns: Dictionary of the values by name
+        :raises: sqlite3.Error
+        '''
+        rows = self._connect().execute('SELECT name, value FROM records WHERE key = ?', (key,))
+        return dict((name, json.loads(value)) for name, value in rows)
+
+    @_synchronized
+    def update(self, name, items, replace=False):
+        ''' Record values of a container or project
+
+        :param name: Name of the container or project
+        :param items: Dictionary of the values by key, must be JSON
+                      serializable, None removes a value
+        :param replace: Remove all other values of the name
+        :raises: sqlite3.Error
+        '''
+        with self._transaction() as conn:
+            if replace:
+                conn.execute('DELETE FROM records WHERE name = ?', (name,))
+            for key, value in items.items():
+                if value is None:
+                    conn.execute('DELETE FROM records WHERE name = ? AND key = ?', (name, key))
+                else:
+                    conn.execute('INSERT OR REPLACE INTO records (name, key, value) VALUES (?, ?, ?)',
+                                 (name, key, json.dumps(value, sort_keys=True)))
+
+    def forget(self, name):
+        ''' Remove all values of a container or project
+
+        :param name: Name of the container or project
+        :raises: sqlite3.Error
+        '''
+        self.update(name, {}, replace=True)
+
+    @_synchronized
+    def allocate(self, name, key, candidates, reserved=()):
+        ''' Record the first free candidate as value, e.g., an IP address
+
+        A candidate is free if it is neither reserved nor recorded with the
+        same key for another name. The database is locked while searching so
+        that concurrent invocations of Locker cannot allocate the same value.
+
+        :param name: Name of the container or project
+        :param key: Key of the value, e.g., "ip"
+        :param candidates: Iterable of values in the order of preference
+        :param reserved: Values that must not be allocated
+        :returns: The allocated value
+        :raises: RuntimeError if all candidates are in use
+        :raises: sqlite3.Error
+        '''
+        with self._transaction() as conn:
+            used = set(reserved)
+            for other, value in conn.execute('SELECT name, value FROM records WHERE key = ?', (key,)):
+                if other != name:
+                    used.add(json.loads(value))
+            for candidate in candidates:
+                if candidate not in used:
+                    conn.execute('INSERT OR REPLACE INTO records (name, key, value) VALUES (?, ?, ?)',
+                                 (name, key, json.dumps(candidate)))
+                    return candidate
+        raise RuntimeError('No free value for %s' % key)
+
+class ContainerState(object):
+    ''' Recorded state of a container
+    '''
+
+    def __init__(self, store, name, logger=None):
+        ''' Initialize the state, the values are read on first access and
+        kept until invalidate() is called
+
+        :param store: StateStore of the container's lxcpath
+        :param name: Name of the container
+        :param logger: Logger for warnings
+        '''
+        self.store = store
+        self.name = name
+        self.logger = logger or logging.getLogger()
+        self._state = None
+
+    def _load(self):
+        ''' Read the recorded values if not done yet
+
+        The state file of older versions is imported if nothing was recorded.
+
+        :returns: State as dictionary, empty if the database is unavailable
+        '''
+        if self._state is not None:
+            return self._state
+        try:
+            state = self.store.load(self.name)
+            if not state:
+                state = self._import_legacy()
+        except sqlite3.Error as exception:
+            self.logger.warning('Cannot read state from %s: %s', self.store.filename, exception)
+            state = dict()
+        self._state = state
+        return state
+
+    def invalidate(self):
+        ''' Read the recorded values again on next access
+
+        Must be called before an instance is reused for another command, as
+        other processes may have changed the state meanwhile.
+        '''
+        self._state = None
+
+    def _import_legacy(self):
+        ''' Import and remove the JSON state file of older versions
+
+        :returns: Imported state as dictionary
+        '''
+        filename = os.path.join(self.store.lxcpath, self.name, LEGACY_STATE_FILE)
+        try:
+            with open(filename, 'r') as state_fd:
+                state = json.load(state_fd)
+            if not isinstance(state, dict):
+                raise ValueError('State is not a JSON object')
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as exception:
+            self.logger.warning('Ignoring invalid state file %s: %s', filename, exception)
+            return dict()
+        self.store.update(self.name, state)
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+        return state
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def get(self, key, default=None):
+        ''' Get a recorded value
+
+        :param key: Name of the value, e.g., "links"
+        :param default: Returned if the value was not recorded
+        :returns: The value
+        '''
+        return self._load().get(key, default)
+
+    def update(self, **items):
+        ''' Record values
+
+        The database is only written if a value changed.
+
+        :param items: Values to record, must be JSON serializable, None
+                      removes a value
+        :returns: True if the state was written, else False
+        '''
+        state = self._load()
+        changed = dict((key, value) for key, value in items.items()
+                       if key not in state or state[key] != value)
+        if not changed:
+            return False
+        try:
+            self.store.update(self.name, changed)
+        except sqlite3.Error as exception:
+            self.logger.warning('Could not record state in %s: %s', self.store.filename, exception)
+            return False
+        for key, value in changed.items():
+            if value is None:
+                state.pop(key, None)
+            else:
+                state[key] = value
+        return True
+
+    def replace(self, **items):
+        ''' Replace all recorded values, e.g., when rebuilding the state
+
+        :param items: Values to record, must be JSON serializable
+        :returns: True on success, else False
+        '''
+        try:
+            self.store.update(self.name, items, replace=True)
+        except sqlite3.Error as exception:
+            self.logger.warning('Could not record state in %s: %s', self.store.filename, exception)
+            return False
+        self._state = dict(items)
+        return True
+
+    def allocate(self, key, candidates, reserved=()):
+        ''' Record the first free candidate as value, see StateStore.allocate()
+
+        :raises: RuntimeError if all candidates are in use
+        :raises: sqlite3.Error
+        '''
+        value = self.store.allocate(self.name, key, candidates, reserved)
+        self._load()[key] = value
+        return value
+
+def links_from_hosts(filename, project_name):
+    ''' Get the links of a container from its /etc/hosts
+
+    Used if the links were not recorded.
+
+    :param filename: Path of the container's /etc/hosts
+    :param project_name: Name of the container's project
+    :returns: List of names of the linked containers
+    '''
+    links = list()
+    try:
+        with open(filename, 'r') as hosts_fd:
+            for line in hosts_fd:
+                match = _regex_link.match(line)
+                if match and match.group('project') == project_name:
+                    links.append(match.group('name'))
+    except FileNotFoundError:
+        pass
+    return links
@@ -0,0 +1,179 @@
+'''
+This module provides a cache of base containers created from templates.
+
+Running an lxc template (including, e.g., debootstrap) takes minutes. When
+several containers share the same "template" configuration, the template is
+run once to create a base container that is subsequently cloned, ideally as
+copy-on-write snapshot, for each container.
+
+The cache is shared by all processes that use the same lxcpath. Looking up
+and building the base containers of a template is serialized by a lock file
+so that a base container that another process is still building is never
+mistaken for the remains of a failed build.
+'''
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+import lxc
+
+# Prefix of the cached base containers, the dash ensures that the names never
+# collide with containers of Locker projects
+BASE_PREFIX = 'locker-template-'
+MARKER_FILE = 'locker_template'
+
+# Time in seconds that expired base containers are kept so that other
+# processes can finish cloning them
+GRACE_PERIOD = 3600
+
+
+class TemplateCache(object):
+    ''' Creates and manages cached base containers in a lxcpath
+    '''
+
+    def __init__(self, lxcpath, ttl, verbose=False):
+        ''' Initialize the cache
+
+        :param lxcpath: Root path of the containers
+        :param ttl: Time in seconds after which base containers are rebuilt
+        :param verbose: Show the output of the templates
+        '''
+        self.lxcpath = lxcpath
+        self.ttl = ttl
+        self.verbose = verbose
+
+    @staticmethod
+    def key(template):
+        ''' Get the normalized key of a template configuration
+
+        :param template: Tuple of sorted (key, value) pairs, see
+                         locker.config.ContainerConfig
+        :returns: Key as hex string
+        '''
+        normalized = json.dumps([[str(k), str(v)] for k, v in sorted(template)])
+        return hashlib.sha256(normalized.encode()).hexdigest()[:16]
+
+    def _lock(self, key):
+        ''' Open and lock the lock file of a template
+
+        Blocks while another process holds the lock, e.g., while it runs the
+        template.
+
+        :returns: File object of the lock file, closing it releases the lock
+        '''
+        lock_fo = open(os.path.join(self.lxcpath, '.%s%s.lock' % (BASE_PREFIX, key)), 'a')
+        try:
+            fcntl.flock(lock_fo.fileno(), fcntl.LOCK_EX)
+        except OSError:
+            lock_fo.close()
+            raise
+        return lock_fo
+
+    def _marker(self, name):
+        return os.path.join(self.lxcpath, name, MARKER_FILE)
+
+    def _created(self, name):
+        ''' Get the creation time of a base container
+
+        :returns: Timestamp or None if the container is not a complete base
+        '''
+        try:
+            with open(self._marker(name), 'r') as marker_fd:
+                return float(json.load(marker_fd)['created'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _bases(self, key):
+        ''' Get the existing base containers of a template
+
+        :returns: List of tuples (created, name), newest first
+        '''
+        prefix = '%s%s-' % (BASE_PREFIX, key)
+        bases = list()
+        for name in lxc.list_containers(config_path=self.lxcpath):
+            if not name.startswith(prefix):
+                continue
+            bases.append((self._created(name) or 0, name))
+        return sorted(bases, reverse=True)
+
+    def _destroy(self, name):
+        ''' Try to destroy a base container
+
+        Destroying fails as long as snapshot clones of the base exist. In this
+        case the base container will be removed by one of the next calls.
+        '''
+        base = lxc.Container(name, self.lxcpath)
+        if base.defined and base.destroy():
+            logging.info('Removed cached base container: %s', name)
+        else:
+            logging.debug('Cannot remove cached base container (yet): %s', name)
+
+    def _build(self, key, template):
+        ''' Create a new base container by running the template
+
+        :returns: Name of the base container or None on failure
+        '''
+        created = time.time()
+        name = '%s%s-%d' % (BASE_PREFIX, key, created)
+        args = dict(template)
+        logging.info('Creating cached base container from template: %s (%s)', args['name'], name)
+        flags = lxc.LXC_CREATE_QUIET if not self.verbose else 0
+        base = lxc.Container(name, self.lxcpath)
+        base.create(args['name'], flags, args=args)
+        if not base.defined:
+            logging.error('Creation of cached base container failed: %s', name)
+            return None
+        try:
+            with open(self._marker(name), 'w') as marker_fd:
+                json.dump({'created': created, 'template': args}, marker_fd)
+        except OSError as exception:
+            logging.error('Could not mark cached base container: %s', exception)
+            base.destroy()
+            return None
+        return name
+
+    def get(self, template):
+        ''' Get a fresh base container for a template, create it if necessary
+
+        Base containers that are older than the TTL are replaced by a new
+        base container and removed after the GRACE_PERIOD if possible.
+        Incomplete base containers, i.e., remains of failed builds, are
+        removed immediately. The lookup and the build run while holding the
+        lock file of the template.
+
+        :param template: Tuple of sorted (key, value) pairs
+        :returns: Name of the base container or None on failure
+        '''
+        key = TemplateCache.key(template)
+        try:
+            lock_fo = self._lock(key)
+        except OSError as exception:
+            logging.error('Could not lock the cached base containers: %s', exception)
+            return None
+        with lock_fo:
+            fresh = None
+            for created, name in self._bases(key):
+                age = time.time() - created
+                if not fresh and created and age < self.ttl:
+                    fresh = name
+                elif not created or age >= self.ttl + GRACE_PERIOD:
+                    self._destroy(name)
+            if fresh:
+                logging.debug('Using cached base container: %s', fresh)
+                return fresh
+            return self._build(key, template)
+
+    def has_fresh(self, template):
+        ''' Check if a fresh base container exists for a template
+
+        :param template: Tuple of sorted (key, value) pairs
+        :returns: True if a base container within the TTL exists, else False
+        '''
+        for created, _name in self._bases(TemplateCache.key(template)):
+            if created and time.time() - created < self.ttl:
+                return True
+        return False
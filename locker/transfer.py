@@ -0,0 +1,329 @@
+'''
+This module copies files between the host and the root file systems of
+containers ("locker cp").
+
+A file or directory tree of the host is pushed to the same path in several
+containers, or pulled from several containers into one directory per
+container on the host. The containers are handled in parallel. The content
+of a file is copied by the kernel if possible (reflink, copy_file_range(),
+or sendfile(), see locker.fastcopy) into a temporary file that replaces the
+destination atomically, so that services never read a partial file. Files
+whose size, modification time, and SHA-256 digest match are skipped.
+
+Paths in a container are resolved like in a chroot: absolute symbolic links
+in the container's root file system point into the container, not into the
+host's root file system.
+'''
+
+import errno
+import hashlib
+import logging
+import os
+import stat
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import prettytable
+from colorama import Fore
+from locker.fastcopy import copy_file, copy_metadata
+
+# bytes read at once when hashing a file
+HASH_CHUNK = 2**20
+
+# maximum number of symbolic links followed when resolving a path
+MAX_SYMLINKS = 40
+
+
+class TransferStats(namedtuple('TransferStats', ['copied', 'skipped', 'bytes', 'seconds'])):
+    ''' Statistics of a transfer to or from a container '''
+    __slots__ = ()
+
+    def __str__(self):
+        return '%d files copied, %d unchanged, %.1f MB in %.2fs' % (
+            self.copied, self.skipped, self.bytes / 10**6, self.seconds)
+
+def container_root(container):
+    ''' Get the host path of a container's root file system
+
+    Directories are used directly, even if the container is stopped. Other
+    backing stores, e.g., overlayfs or block devices, are only accessible via
+    /proc/<pid>/root while the container is running.
+
+    :param container: Container instance
+    :returns: Path
+    :raises: ValueError if the root file system is not accessible
+    '''
+    if not container.defined:
+        raise ValueError('Container is not defined')
+    if container.backing_store == 'dir':
+        rootfs = container.rootfs
+        return rootfs.split(':', 1)[1] if rootfs.startswith('dir:') else rootfs
+    if container.running:
+        return '/proc/%d/root' % container.init_pid
+    raise ValueError('Root file system (%s) is only accessible while the container is running' %
+                     container.backing_store)
+
+def resolve(root, path):
+    ''' Resolve a path inside a root directory like in a chroot
+
+    Symbolic links are followed, absolute targets and ".." are resolved
+    relative to the root so that the result never leaves the root. Missing
+    components are appended as they are.
+
+    :param root: Root directory on the host
+    :param path: Path relative to the root
+    :returns: Path on the host
+    :raises: OSError (ELOOP) if there are too many symbolic links
+    '''
+    parts = [part for part in path.split('/') if part not in ('', '.')]
+    resolved = list()
+    links = 0
+    missing = False
+    while parts:
+        part = parts.pop(0)
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+        if not missing:
+            candidate = os.path.join(root, *(resolved + [part]))
+            try:
+                mode = os.lstat(candidate).st_mode
+            except FileNotFoundError:
+                missing = True
+            else:
+                if stat.S_ISLNK(mode):
+                    links += 1
+                    if links > MAX_SYMLINKS:
+                        raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+                    target = os.readlink(candidate)
+                    if target.startswith('/'):
+                        resolved = list()
+                    parts = [part for part in target.split('/') if part not in ('', '.')] + parts
+                    continue
+        resolved.append(part)
+    return os.path.join(root, *resolved) if resolved else root
+
+class _Digests(object):
+    ''' Thread-safe cache of the SHA-256 digests of files
+
+    The source of a push is hashed once for all containers.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.digests = dict()
+
+    def get(self, path, file_stat):
+        key = (path, file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        with self.lock:
+            if key in self.digests:
+                return self.digests[key]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file_fo:
+            for chunk in iter(lambda: file_fo.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.digests[key] = digest.digest()
+        return self.digests[key]
+
+class _Transfer(object):
+    ''' Copies a file or directory tree, skipping unchanged files
+
+    :param dst_root: Root directory the destination paths are resolved in,
+                     or None if the destination is on the host
+    '''
+
+    def __init__(self, dst_root, digests, logger):
+        self.dst_root = dst_root
+        self.digests = digests
+        self.logger = logger
+        self.copied = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    def _target(self, path):
+        if self.dst_root is None:
+            return path
+        return resolve(self.dst_root, path)
+
+    def _unchanged(self, src, src_stat, dst):
+        try:
+            dst_stat = os.stat(dst)
+        except FileNotFoundError:
+            return False
+        return (stat.S_ISREG(dst_stat.st_mode) and
+                dst_stat.st_size == src_stat.st_size and
+                dst_stat.st_mtime_ns == src_stat.st_mtime_ns and
+                self.digests.get(dst, dst_stat) == self.digests.get(src, src_stat))
+
+    def _copy_file(self, src, src_stat, dst):
+        if self._unchanged(src, src_stat, dst):
+            self.logger.debug('Unchanged, skipping: %s', dst)
+            self.skipped += 1
+            return
+        tmp = os.path.join(os.path.dirname(dst), '.%s.locker' % os.path.basename(dst))
+        try:
+            copy_file(src, tmp, src_stat)
+            copy_metadata(src, tmp, src_stat)
+            os.rename(tmp, dst)
+        except:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            raise
+        self.logger.debug('Copied: %s -> %s', src, dst)
+        self.copied += 1
+        self.bytes += src_stat.st_size
+
+    def _copy_entry(self, src, src_stat, dst_path):
+        ''' Copy a file or symbolic link, other file types are skipped '''
+        if stat.S_ISREG(src_stat.st_mode):
+            self._copy_file(src, src_stat, self._target(dst_path))
+        elif stat.S_ISLNK(src_stat.st_mode):
+            # the link itself is replaced, its target is not resolved
+            dst = os.path.join(self._target(os.path.dirname(dst_path)), os.path.basename(dst_path))
+            target = os.readlink(src)
+            if os.path.islink(dst) and os.readlink(dst) == target:
+                self.skipped += 1
+                return
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            os.symlink(target, dst)
+            copy_metadata(src, dst, src_stat)
+            self.copied += 1
+        else:
+            self.logger.warning('Not a regular file, skipping: %s', src)
+
+    def copy(self, src, dst_path):
+        ''' Copy with the metadata like "cp -a"
+
+        A file is copied into the destination if it is an existing directory.
+        The content of a directory is merged into the destination directory
+        so that copying the same tree again only copies the changed files.
+        Directories are created as needed, the metadata of existing
+        directories is not changed.
+
+        :param src: Source path on the host
+        :param dst_path: Destination path, resolved in dst_root
+        '''
+        src_stat = os.lstat(src)
+        if not stat.S_ISDIR(src_stat.st_mode):
+            if os.path.isdir(self._target(dst_path)):
+                dst_path = os.path.join(dst_path, os.path.basename(src))
+            self._copy_entry(src, src_stat, dst_path)
+            return
+        created = list()
+        for root, dirnames, filenames in os.walk(src):
+            rel = os.path.relpath(root, src)
+            dst_root = dst_path if rel == '.' else os.path.join(dst_path, rel)
+            target = self._target(dst_root)
+            if not os.path.isdir(target):
+                os.mkdir(target)
+                created.append((root, target))
+            # os.walk() lists symbolic links to directories as directories
+            for name in list(dirnames):
+                if os.path.islink(os.path.join(root, name)):
+                    dirnames.remove(name)
+                    filenames.append(name)
+            for name in filenames:
+                src_file = os.path.join(root, name)
+                self._copy_entry(src_file, os.lstat(src_file), os.path.join(dst_root, name))
+        # deepest first as creating entries changes the timestamps
+        for src_dir, dst_dir in reversed(created):
+            copy_metadata(src_dir, dst_dir)
+
+def _run(containers, transfer, parallel):
+    ''' Run a transfer function for each container in parallel
+
+    :returns: Ordered dictionary of container name -> TransferStats or None
+              if the transfer failed
+    '''
+    def _transfer(container):
+        begin = time.time()
+        try:
+            stats = transfer(container)
+        except (OSError, ValueError) as exception:
+            container.logger.error('Copying failed: %s', exception)
+            return None
+        result = TransferStats(stats.copied, stats.skipped, stats.bytes, time.time() - begin)
+        container.logger.info('%s', result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        results = list(executor.map(_transfer, containers))
+    return OrderedDict((con.name, result) for con, result in zip(containers, results))
+
+def push(containers, src, dst, parallel=8):
+    ''' Copy a file or directory tree from the host into containers
+
+    :param containers: List of containers
+    :param src: Source path on the host
+    :param dst: Destination path in the containers
+    :param parallel: Maximum number of containers copied to at the same time
+    :returns: Ordered dictionary of container name -> TransferStats or None
+              if the transfer failed
+    '''
+    digests = _Digests()
+
+    def _push(container):
+        transfer = _Transfer(container_root(container), digests, container.logger)
+        transfer.copy(src, dst)
+        return transfer
+
+    return _run(containers, _push, parallel)
+
+def pull(containers, src, dst, parallel=8):
+    ''' Copy a file or directory tree from containers to the host
+
+    The files of each container are copied into the subdirectory of "dst"
+    that is named like the container (without the project name).
+
+    :param containers: List of containers
+    :param src: Source path in the containers
+    :param dst: Destination directory on the host
+    :param parallel: Maximum number of containers copied from at the same time
+    :returns: Ordered dictionary of container name -> TransferStats or None
+              if the transfer failed
+    '''
+    digests = _Digests()
+
+    def _pull(container):
+        source = resolve(container_root(container), src)
+        target = os.path.join(dst, container.name.split('_', 1)[1])
+        os.makedirs(target, exist_ok=True)
+        transfer = _Transfer(None, digests, container.logger)
+        transfer.copy(source, os.path.join(target, os.path.basename(src.rstrip('/')) or 'rootfs'))
+        return transfer
+
+    return _run(containers, _pull, parallel)
+
+def summary(results, containers):
+    ''' Print the statistics of the transfers
+
+    :param results: Result of push() or pull()
+    :param containers: List of containers
+    :returns: 0 if the transfers to or from all containers succeeded, else 1
+    '''
+    table = prettytable.PrettyTable(['Name', 'Copied', 'Unchanged', 'MB', 'Seconds'])
+    table.align = 'r'
+    table.align['Name'] = 'l'
+    table.hrules = prettytable.HEADER
+    table.vrules = prettytable.NONE
+    failed = 0
+    for container in containers:
+        stats = results[container.name]
+        if stats is None:
+            failed += 1
+            values = ['failed', '-', '-', '-']
+        else:
+            values = [stats.copied, stats.skipped, '%.1f' % (stats.bytes / 10**6), '%.2f' % stats.seconds]
+        reset_color = Fore.RESET if container.color else ''
+        values = [container.name.split('_', 1)[1]] + values
+        table.add_row(['%s%s%s' % (container.color, value, reset_color) for value in values])
+    sys.stdout.write(table.get_string() + '\n')
+    if failed:
+        logging.error('Copying failed for %d of %d containers', failed, len(containers))
+    return 1 if failed else 0
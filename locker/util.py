@@ -23,8 +23,8 @@ def expand_vars(text, container):
     '''
     text = text.replace('$name', container.name.split('_')[1])
     text = text.replace('$project', container.project.name)
-    if 'fqdn' in container.yml and container.yml['fqdn']:
-        text = text.replace('$fqdn', container.yml['fqdn'])
+    if container.config.fqdn:
+        text = text.replace('$fqdn', container.config.fqdn)
     elif '$fqdn' in text:
         container.logger.warn('Cannot replace undefined $fqdn in: %s', text)
     return text
@@ -0,0 +1,259 @@
+'''
+This module applies changes of the configuration file while it is edited.
+
+"locker watch" keeps the compiled configuration in memory and waits for
+changes of the YAML file via inotify. On each change, the old and the new
+configuration of each running container are compared and only the affected
+settings are applied: the cgroup values are set live, the port forwarding
+rules and the links are replaced. Containers are only restarted if settings
+changed that are applied when a container starts, i.e., the volumes, the
+FQDN, or the DNS servers. Containers that were added to or removed from the
+configuration are not created or removed, use "locker up" or "locker rm".
+'''
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+from collections import namedtuple
+
+import locker.config
+import locker.schema
+import yaml
+from locker.reconcile import ACTIONS, Step, execute
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the name
+_EVENT = struct.Struct('iIII')
+
+_REASONS = {
+    'restart': 'fqdn, volumes, dns, or console log changed',
+    'cgroup': 'cgroup settings changed',
+    'ports': 'port forwarding rules changed',
+    'links': 'links changed',
+}
+
+_libc = None
+
+
+class InotifyEvent(namedtuple('InotifyEvent', ['wd', 'mask', 'cookie', 'name'])):
+    ''' Event read from an inotify instance '''
+    __slots__ = ()
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+def _check(result):
+    ''' Raise OSError if a libc call failed '''
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+class Inotify(object):
+    ''' Minimal inotify binding via ctypes
+    '''
+
+    def __init__(self):
+        ''' Create the inotify instance
+
+        :raises: OSError
+        '''
+        self.fd = _check(_get_libc().inotify_init1(IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        ''' Watch a file or directory
+
+        :param path: Path of the file or directory
+        :param mask: Events to watch, e.g., IN_CLOSE_WRITE
+        :returns: Watch descriptor
+        :raises: OSError
+        '''
+        return _check(_get_libc().inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def read(self, timeout=None):
+        ''' Wait for events
+
+        :param timeout: Maximum time to wait in seconds, None waits forever
+        :returns: List of InotifyEvent, empty if the timeout expired
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = list()
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        ''' Close the inotify instance '''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def diff(old, new):
+    ''' Get the actions that apply a changed container configuration
+
+    :param old: ContainerConfig of the running container
+    :param new: Changed ContainerConfig
+    :returns: List of actions, ["restart"] or any of "cgroup", "ports", and
+              "links"
+    '''
+    if old == new:
+        return []
+    if old.start_digest() != new.start_digest():
+        return ['restart']
+    actions = list()
+    if old.cgroup != new.cgroup:
+        actions.append('cgroup')
+    if old.ports != new.ports:
+        actions.append('ports')
+    if old.links != new.links:
+        actions.append('links')
+    return actions
+
+def changes(project, old_config):
+    ''' Compute the steps to apply the changed configuration of a project
+
+    Only running containers are changed, the other containers use the new
+    configuration when they are started.
+
+    :param project: Project instance with the new configuration
+    :param old_config: Previous ProjectConfig
+    :returns: List of steps, see locker.reconcile
+    '''
+    steps = list()
+    restarted = set()
+    fqdn_changed = False
+    for container in project.containers:
+        new = container.config
+        old = old_config.get_container(new.name)
+        if old is None:
+            logging.info('Container added to the configuration, run \"locker up\" to create it: %s',
+                         container.name)
+            continue
+        if not container.running:
+            logging.debug('Container not running, not applying changes: %s', container.name)
+            continue
+        if (old.template, old.clone, old.download) != (new.template, new.clone, new.download):
+            logging.warning('Template or clone of a container changed, it must be recreated: %s',
+                            container.name)
+        for action in diff(old, new):
+            if action == 'ports' and project.args.get('no_ports', False):
+                continue
+            if action == 'links' and project.args.get('no_links', False):
+                continue
+            steps.append(Step(action, container.name, _REASONS[action]))
+            if action == 'restart':
+                restarted.add(new.name)
+                fqdn_changed = fqdn_changed or old.fqdn != new.fqdn
+    for old in old_config.containers:
+        if project.config.get_container(old.name) is None:
+            logging.warning('Container removed from the configuration, it is not removed: %s_%s',
+                            project.name, old.name)
+
+    if restarted and not project.args.get('no_links', False):
+        linked = set(step.container for step in steps if step.action == 'links')
+        for container in project.all_containers:
+            if container.name in linked or not container.running:
+                continue
+            names = set(link.name for link in container.config.links)
+            if container.config.name in restarted or names & restarted:
+                steps.append(Step('links', container.name, 'container (re)started'))
+    if fqdn_changed and project.args.get('add_hosts', False):
+        steps.append(Step('hosts', None, 'fqdn changed'))
+    return sorted(steps, key=lambda step: ACTIONS.index(step.action))
+
+def reload(project):
+    ''' Load the configuration file again and apply the changes
+
+    The project is kept if the file cannot be loaded or is invalid.
+
+    :param project: Project instance with the previous configuration
+    :returns: Project instance with the current configuration
+    '''
+    filename = project.args['file']
+    try:
+        yml, config = locker.config.load(filename, project.args.get('cache_dir', None) or None)
+    except (OSError, TypeError, yaml.YAMLError) as exception:
+        logging.error('Could not load configuration file \"%s\": %s', filename, exception)
+        return project
+    if config == project.config:
+        logging.debug('Configuration unchanged')
+        return project
+    if not project.args.get('no_validate', False):
+        try:
+            locker.schema.validate(yml)
+        except locker.schema.ValidationError as exception:
+            logging.error('Ignoring changed configuration, it does not comply to schema:')
+            for path, message in exception.errors:
+                logging.error('  %s: %s', path, message)
+            return project
+        except (OSError, locker.schema.SchemaError) as exception:
+            logging.error('Cannot validate YAML configuration: %s', exception)
+            return project
+    changed = type(project)(yml, project.args, config)
+    steps = changes(changed, project.config)
+    if steps:
+        execute(changed, steps)
+    else:
+        logging.info('No changes to apply to the running containers')
+    return changed
+
+def watch(project):
+    ''' Apply the changes of the configuration file until interrupted
+
+    Editors often write a file several times or replace it, so the
+    configuration is loaded after no further changes occurred for "delay"
+    seconds.
+
+    :param project: Project instance
+    :returns: Project instance with the current configuration
+    '''
+    filename = os.path.abspath(project.args['file'])
+    dirname, basename = os.path.split(filename)
+    delay = project.args.get('delay', 0.5)
+    with Inotify() as inotify:
+        inotify.add_watch(dirname, IN_CLOSE_WRITE | IN_MOVED_TO)
+        logging.info('Watching %s, press Ctrl-C to stop', filename)
+        try:
+            while True:
+                events = inotify.read()
+                if any(event.mask & IN_IGNORED for event in events):
+                    logging.error('Directory of the configuration file was removed: %s', dirname)
+                    break
+                if not any(event.name == basename or event.mask & IN_Q_OVERFLOW for event in events):
+                    continue
+                while any(event.name == basename for event in inotify.read(delay)):
+                    pass
+                logging.info('Configuration file changed: %s', filename)
+                project = reload(project)
+        except KeyboardInterrupt:
+            logging.info('Stopped watching %s', filename)
+    return project
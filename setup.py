@@ -23,11 +23,13 @@ setup(
     author='BB',
     author_email='run2fail@users.noreply.github.com',
     packages=['locker'],
-    scripts=['bin/locker'],
+    package_data={'locker': ['schema.yaml']},
+    scripts=['bin/locker', 'bin/lockerd'],
     url='https://github.com/run2fail/locker',
     license='LICENSE',
     description='LXC container management',
     long_description=open('README.rst').read(),
+    python_requires='>=3.5.2',
     install_requires=[
         'python-iptables',
         'colorama',
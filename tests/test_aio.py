@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the asynchronous API
+'''
+
+import asyncio
+import logging
+import threading
+import time
+import unittest
+
+from locker.aio import AsyncProject, gather
+from locker.cli import default_args
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+class FakeContainer(object):
+    def __init__(self, name):
+        self.name = name
+        self.state = 'STOPPED'
+
+class FakeProject(object):
+    ''' Sleeps in start() and stop() and records concurrent commands '''
+
+    DELAY = 0.2
+
+    def __init__(self, name, containers):
+        self.name = name
+        self.args = default_args(project=name)
+        self.all_containers = [FakeContainer('%s_%s' % (name, con)) for con in containers]
+        self.containers = self.all_containers
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def select(self, args):
+        self.args = args
+        self.containers = [con for con in self.all_containers
+                           if not args['containers'] or con.name.split('_', 1)[1] in args['containers']]
+
+    def _set_state(self, state):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+        time.sleep(self.DELAY)
+        for con in self.containers:
+            con.state = state
+        with self.lock:
+            self.active -= 1
+
+    def start(self):
+        self._set_state('RUNNING')
+
+    def stop(self):
+        if self.args['timeout'] == 0:
+            raise RuntimeError('timeout')
+        self._set_state('STOPPED')
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+class TestAsyncProject(unittest.TestCase):
+    ''' Test AsyncProject with fake projects '''
+
+    def setUp(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        self.fakes = [FakeProject('pro%d' % num, ['web', 'db']) for num in range(4)]
+        self.projects = [AsyncProject(fake) for fake in self.fakes]
+
+    def test_concurrent_projects(self):
+        start = time.time()
+        run(gather(*[project.start() for project in self.projects]))
+        seconds = time.time() - start
+        self.assertLess(seconds, FakeProject.DELAY * len(self.projects))
+        for fake in self.fakes:
+            self.assertEqual([con.state for con in fake.all_containers], ['RUNNING', 'RUNNING'])
+
+    def test_serialized_commands(self):
+        project, fake = self.projects[0], self.fakes[0]
+        run(gather(project.start(['web']), project.start(['db']), project.stop(['web'])))
+        self.assertEqual(fake.max_active, 1)
+        self.assertEqual([con.state for con in fake.all_containers], ['STOPPED', 'RUNNING'])
+
+    def test_invalid(self):
+        project = self.projects[0]
+        with self.assertRaises(ValueError):
+            run(project.start(['unknown']))
+        with self.assertRaises(KeyError):
+            run(project.start(unknown_option=True))
+        with self.assertRaises(RuntimeError):
+            run(project.stop(timeout=0))
+
+    def test_events(self):
+        project = self.projects[0]
+        stream = project.events()
+
+        async def commands():
+            await project.start(['db'])
+            try:
+                await project.stop(timeout=0)
+            except RuntimeError:
+                pass
+            project.close()
+
+        async def collect():
+            events = list()
+            async for event in stream:
+                events.append((event.kind, event.name, event.status))
+            return events
+
+        events = run(gather(collect(), commands()))[0]
+        self.assertEqual(events, [('command', 'start', 'started'),
+                                  ('container', 'pro0_db', 'RUNNING'),
+                                  ('command', 'start', 'done'),
+                                  ('command', 'stop', 'started'),
+                                  ('command', 'stop', 'failed')])
+
+if __name__ == "__main__":
+    unittest.main()
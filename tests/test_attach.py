@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test running commands in containers in parallel
+'''
+
+import io
+import logging
+import subprocess
+import time
+import unittest
+
+from locker.attach import MAX_LINE, run
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+class FakeContainer(object):
+    ''' Runs the command on the host instead of attaching to a container '''
+
+    def __init__(self, name, running=True):
+        self.name = 'test_%s' % name
+        self.color = ''
+        self.running = running
+        self.logger = logging.getLogger(self.name)
+        self.processes = list()
+
+    def attach(self, run, command, stdin=None, stdout=None, stderr=None):
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=stderr)
+        self.processes.append(process)
+        return process.pid
+
+class TestRun(unittest.TestCase):
+    ''' Run shell commands with fake containers '''
+
+    def run_command(self, containers, command, parallel=8):
+        output = io.StringIO()
+        begin = time.time()
+        results = run(containers, ['sh', '-c', command], parallel, output)
+        return results, output.getvalue().splitlines(), time.time() - begin
+
+    def test_output(self):
+        containers = [FakeContainer('web'), FakeContainer('db'), FakeContainer('cache', running=False)]
+        results, lines, _seconds = self.run_command(containers, 'echo one; echo two >&2; printf three; exit 3')
+        # the names are padded to the longest name of the selected containers
+        self.assertEqual(sorted(lines), sorted(['web   | one', 'web   | two', 'web   | three',
+                                                'db    | one', 'db    | two', 'db    | three']))
+        self.assertEqual([(name, code) for name, (code, _seconds) in results.items()],
+                         [('test_web', 3), ('test_db', 3), ('test_cache', None)])
+
+    def test_parallel(self):
+        containers = [FakeContainer('c%d' % num) for num in range(4)]
+        results, _lines, seconds = self.run_command(containers, 'sleep 0.3', parallel=2)
+        self.assertGreaterEqual(seconds, 0.6)
+        self.assertLess(seconds, 1.1)
+        self.assertEqual(set(code for code, _seconds in results.values()), set([0]))
+
+    def test_long_lines(self):
+        containers = [FakeContainer('web')]
+        command = 'head -c %d /dev/zero | tr "\\0" x' % (MAX_LINE * 2 + 10)
+        results, lines, _seconds = self.run_command(containers, command)
+        self.assertEqual([len(line) for line in lines], [MAX_LINE + 6, MAX_LINE + 6, 16])
+        self.assertEqual(results['test_web'][0], 0)
+
+if __name__ == "__main__":
+    unittest.main()
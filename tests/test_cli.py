@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the command line interface
+'''
+
+import io
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+from locker.cli import batch, parse_args
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+class TestBatch(unittest.TestCase):
+    ''' Run batch scripts with the "validate" command that requires neither
+    root privileges nor containers
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.valid = self.write('valid.yaml', 'containers:\n  web:\n    clone: ubuntu\n')
+        self.invalid = self.write('invalid.yaml', 'containers:\n  web:\n    prots: ["80:80"]\n')
+
+    def write(self, name, content):
+        filename = os.path.join(self.tmpdir.name, name)
+        with open(filename, 'w') as script_fd:
+            script_fd.write(content)
+        return filename
+
+    def batch(self, script, *options):
+        ''' Run a batch script and capture the summary '''
+        args = parse_args(['--file', self.valid, '--cache-dir', '', 'batch'] + list(options) +
+                          [self.write('script', script)])
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            code = batch(args)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return code, output
+
+    def test_success(self):
+        code, output = self.batch('# validate both files\n'
+                                  'validate\n'
+                                  '\n'
+                                  'locker --file "%s" validate\n' % self.valid)
+        self.assertEqual(code, 0)
+        self.assertIn('2 of 2 commands executed, 0 failed', output)
+
+    def test_failure(self):
+        script = '-f %s validate\nvalidate\n' % self.invalid
+        code, output = self.batch(script)
+        self.assertEqual(code, 1)
+        self.assertIn('1 of 2 commands executed, 1 failed', output)
+        code, output = self.batch(script, '--keep-going')
+        self.assertEqual(code, 1)
+        self.assertIn('2 of 2 commands executed, 1 failed', output)
+
+    def test_invalid_steps(self):
+        code, output = self.batch('unknown\nbatch\nrm web\n', '-k')
+        self.assertEqual(code, 1)
+        self.assertIn('3 of 3 commands executed, 3 failed', output)
+
+if __name__ == "__main__":
+    unittest.main()
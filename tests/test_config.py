@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the compiled configuration model
+'''
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+from locker.config import (CONSOLE_LOG_SIZE, CgroupItem, CloneSpec, ContainerConfig, Healthcheck,
+                           Link, PortRule, ProjectConfig, Volume, load)
+
+YAML = '''
+defaults:
+    dns:
+        - "8.8.8.8"
+    cgroup:
+        - "memory.limit_in_bytes=200000000"
+        - "cpu.shares=256"
+containers:
+    db:
+        template:
+            name: "ubuntu"
+            release: "precise"
+        ports:
+            - "8000:8000"
+            - "8001:8001/udp"
+            - "192.168.2.123:8002:8002/tcp"
+            - "invalid"
+        volumes:
+            - "/opt/data/$name/var_log:/var/log/"
+        fqdn: "db.example.net"
+        cgroup:
+            - "cpu.shares=512"
+    web:
+        clone: "ubuntu"
+        links:
+            - "db:database"
+            - "foo"
+            - "in valid"
+        dns:
+            - "8.8.4.4"
+            - "$bridge"
+            - "8.8.8.8"
+            - "no_ip"
+    app:
+        clone:
+            from: "ubuntu"
+            snapshot: true
+            backingstore: "overlayfs"
+'''
+
+class TestCompile(unittest.TestCase):
+    ''' Test compilation of the YAML configuration
+
+    Does not have any side effects
+    '''
+
+    def setUp(self):
+        self.yml = yaml.safe_load(YAML)
+        self.config = ProjectConfig.compile(self.yml)
+
+    def test_containers(self):
+        self.assertEqual([c.name for c in self.config.containers], ['app', 'db', 'web'])
+        self.assertIsInstance(self.config.get_container('db'), ContainerConfig)
+        self.assertIsNone(self.config.get_container('invalid'))
+
+    def test_immutable(self):
+        db = self.config.get_container('db')
+        with self.assertRaises(AttributeError):
+            db.fqdn = 'foo'
+        with self.assertRaises(AttributeError):
+            db.foo = 'bar'
+
+    def test_ports(self):
+        db = self.config.get_container('db')
+        self.assertEqual(db.ports, (
+            PortRule(None, '8000', '8000', 'tcp'),
+            PortRule(None, '8001', '8001', 'udp'),
+            PortRule('192.168.2.123', '8002', '8002', 'tcp'),
+        ))
+        self.assertEqual(db.get_invalid('ports'), ['invalid'])
+
+    def test_volumes(self):
+        db = self.config.get_container('db')
+        self.assertEqual(db.volumes, (Volume('/opt/data/$name/var_log', 'var/log/'),))
+
+    def test_links(self):
+        web = self.config.get_container('web')
+        self.assertEqual(web.links, (Link('db', 'database'), Link('foo', None)))
+        self.assertEqual(web.get_invalid('links'), ['in valid'])
+
+    def test_cgroup(self):
+        self.assertEqual(self.config.get_container('db').cgroup, (
+            CgroupItem('memory.limit_in_bytes', '200000000'),
+            CgroupItem('cpu.shares', '512'),
+        ))
+        self.assertEqual(self.config.get_container('web').cgroup, (
+            CgroupItem('memory.limit_in_bytes', '200000000'),
+            CgroupItem('cpu.shares', '256'),
+        ))
+
+    def test_dns(self):
+        self.assertEqual(self.config.get_container('db').dns, ('8.8.8.8',))
+        web = self.config.get_container('web')
+        self.assertEqual(web.dns, ('8.8.4.4', '$bridge', '8.8.8.8'))
+        self.assertEqual(web.get_invalid('dns'), ['no_ip'])
+
+    def test_console_log(self):
+        self.assertIsNone(self.config.get_container('db').console_log)
+        self.assertEqual(ContainerConfig.compile('db', {'console_log': True}).console_log, CONSOLE_LOG_SIZE)
+        self.assertEqual(ContainerConfig.compile('db', {'console_log': 4096}).console_log, 4096)
+        self.assertIsNone(ContainerConfig.compile('db', {'console_log': False}).console_log)
+        # the start digest only changes if the console log is enabled
+        self.assertEqual(ContainerConfig.compile('db', {'console_log': False}).start_digest(),
+                         ContainerConfig.compile('db', {}).start_digest())
+        self.assertNotEqual(ContainerConfig.compile('db', {'console_log': True}).start_digest(),
+                            ContainerConfig.compile('db', {}).start_digest())
+        for invalid in ['1M', -1]:
+            config = ContainerConfig.compile('db', {'console_log': invalid})
+            self.assertIsNone(config.console_log)
+            self.assertEqual(config.get_invalid('console_log'), [invalid])
+
+    def test_healthcheck(self):
+        self.assertIsNone(self.config.get_container('db').healthcheck)
+        check = ContainerConfig.compile('db', {'healthcheck': {'tcp': 5432, 'exec': 'pg_isready', 'timeout': 10}})
+        self.assertEqual(check.healthcheck, Healthcheck(5432, 'pg_isready', None, 10.0, 0.5))
+        for invalid in [{'tcp': 0}, {'file': 'relative'}, {'tcp': 'http'}, 'tcp']:
+            config = ContainerConfig.compile('db', {'healthcheck': invalid})
+            self.assertIsNone(config.healthcheck)
+            self.assertEqual(config.get_invalid('healthcheck'), [invalid])
+
+    def test_creation(self):
+        db = self.config.get_container('db')
+        web = self.config.get_container('web')
+        self.assertEqual(db.template, (('name', 'ubuntu'), ('release', 'precise')))
+        self.assertIsNone(db.clone)
+        self.assertEqual(web.clone, CloneSpec('ubuntu', False, None))
+        self.assertIsNone(web.template)
+        app = self.config.get_container('app')
+        self.assertEqual(app.clone, CloneSpec('ubuntu', True, 'overlayfs'))
+
+    def test_invalid_type(self):
+        for invalid_yml in [None, [], '']:
+            with self.assertRaises(TypeError):
+                ProjectConfig.compile(invalid_yml)
+
+class TestLoad(unittest.TestCase):
+    ''' Test loading and caching of configuration files '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'locker.yaml')
+        self.cache_dir = os.path.join(self.tmpdir.name, 'cache')
+        with open(self.filename, 'w') as yaml_fd:
+            yaml_fd.write(YAML)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_load_uncached(self):
+        yml, config = load(self.filename)
+        self.assertEqual(yml, yaml.safe_load(YAML))
+        self.assertEqual(config, ProjectConfig.compile(yml))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_load_cached(self):
+        yml, config = load(self.filename, self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        cached_yml, cached_config = load(self.filename, self.cache_dir)
+        self.assertEqual(cached_yml, yml)
+        self.assertEqual(cached_config, config)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_load_modified(self):
+        load(self.filename, self.cache_dir)
+        with open(self.filename, 'a') as yaml_fd:
+            yaml_fd.write('    foo:\n        clone: "bar"\n')
+        yml, config = load(self.filename, self.cache_dir)
+        # the cache file of the previous version is replaced
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertEqual(config.get_container('foo').clone.origin, 'bar')
+        self.assertEqual(load(self.filename, self.cache_dir)[1], config)
+
+    def test_load_untrusted_cache(self):
+        load(self.filename, self.cache_dir)
+        cache_file = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        for path, mode in [(self.cache_dir, 0o777), (cache_file, 0o666)]:
+            os.chmod(path, mode)
+            with mock.patch('locker.config.pickle.load') as pickle_load:
+                yml, config = load(self.filename, self.cache_dir)
+            self.assertFalse(pickle_load.called)
+            self.assertEqual(config, ProjectConfig.compile(yml))
+            os.chmod(path, 0o700)
+
+    def test_load_corrupted_cache(self):
+        load(self.filename, self.cache_dir)
+        for cache_file in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, cache_file), 'wb') as cache_fd:
+                cache_fd.write(b'garbage')
+        yml, config = load(self.filename, self.cache_dir)
+        self.assertEqual(config, ProjectConfig.compile(yml))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,11 +9,13 @@ import logging
 import os
 import tempfile
 import time
+import unittest
 
 import yaml
 from colorama import Fore
 from locker import Container, Project
-from locker.container import CommandFailed
+from locker.config import ContainerConfig
+from locker.container import CommandFailed, stop_containers
 from tests.locker_test import LockerTest
 
 def setUpModule():
@@ -208,6 +210,121 @@ class TestCreateClone(LockerTest):
         self.project.start()
         self.project.stop()
 
+class TestCreateSnapshotClone(LockerTest):
+    ''' Create and start a snapshot clone whose root file system is layered
+
+    Has side effects:
+    - Creates containers
+    - Creates bridge
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.yml['containers']['sshd'] = {
+            'clone': {'from': 'test_ubuntu', 'snapshot': True, 'backingstore': 'overlayfs'},
+            'fqdn': 'sshd.example.net',
+            'volumes': [self.tmpdir.name + '/sshd/log:/var/log'],
+        }
+        self.project = Project(self.yml, self.args)
+
+    def test_create_start(self):
+        ubuntu = self.project.all_containers[1]
+        ubuntu.create()
+        sshd = self.project.all_containers[0]
+        sshd.create()
+        self.project = Project(self.yml, self.args)
+        sshd = self.project.all_containers[0]
+        self.assertEqual(sshd.backing_store, 'overlayfs')
+        self.assertTrue(os.path.isdir(self.tmpdir.name + '/sshd/log'))
+        self.project.start()
+        self.assertEqual(sshd.state, 'RUNNING')
+        with open(sshd.rootfs_path('/etc/hostname')) as hostname_fd:
+            self.assertEqual(hostname_fd.read(), 'sshd\n')
+        self.project.stop()
+        # the origin is not modified
+        self.assertTrue(os.listdir(ubuntu.rootfs_path('/var/log')))
+
+class TestSnapshotRootfs(unittest.TestCase):
+    ''' Access the layered root file system of a stopped snapshot clone
+
+    Does not require lxc, the layers are created in a temporary directory
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tmp = self.tmpdir.name
+        self.lower = os.path.join(tmp, 'test_base', 'rootfs')
+        self.upper = os.path.join(tmp, 'test_web', 'delta0')
+        os.makedirs(os.path.join(self.lower, 'etc'))
+        os.makedirs(os.path.join(self.lower, 'var', 'www'))
+        os.makedirs(self.upper)
+        for name, content in [('etc/hosts', '127.0.0.1 localhost\n127.0.1.1 base\n'), ('etc/hostname', 'base\n'),
+                              ('etc/resolv.conf', 'nameserver 8.8.8.8\n'), ('var/www/index.html', 'hello\n')]:
+            with open(os.path.join(self.lower, name), 'w') as file_fd:
+                file_fd.write(content)
+        project = Project.__new__(Project)
+        project.name = 'test'
+        project.args = {'copy_workers': 2}
+        yml = {'fqdn': 'web.example.net',
+               'volumes': [tmp + '/host/www:/var/www', tmp + '/host/data:/data']}
+        self.container = Container('test_web', yml, project, config_path=tmp,
+                                   config=ContainerConfig.compile('web', yml, {}))
+        self.container.defined = True
+        self.container.running = False
+        self.container.get_config_item = lambda key: 'overlayfs:%s:%s' % (self.lower, self.upper)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, path):
+        with open(path) as file_fd:
+            return file_fd.read()
+
+    def test_rootfs_path(self):
+        container = self.container
+        self.assertEqual(container.rootfs_path('/etc/hosts'), self.lower + '/etc/hosts')
+        self.assertEqual(container.rootfs_path('/etc/hosts', write=True), self.upper + '/etc/hosts')
+        self.assertEqual(self.read(self.upper + '/etc/hosts'), '127.0.0.1 localhost\n127.0.1.1 base\n')
+        self.assertEqual(container.rootfs_path('/etc/hosts'), self.upper + '/etc/hosts')
+        self.assertEqual(container.rootfs_path('/var/www/new', write=True), self.upper + '/var/www/new')
+        self.assertTrue(os.path.isdir(self.upper + '/var/www'))
+        # directories are only created if they exist in the lower directory
+        with self.assertRaises(FileNotFoundError):
+            container.rootfs_path('/new/file', write=True)
+        self.assertFalse(os.path.exists(self.upper + '/new'))
+        container.running = True
+        container.init_pid = 1234
+        self.assertEqual(container.rootfs_path('/etc/hosts'), '/proc/1234/root/etc/hosts')
+
+    def test_create_start(self):
+        container = self.container
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        self.addCleanup(os.chdir, cwd)
+        container._move_dirs()
+        container._set_hostname()
+        container._enable_dns(dns=['10.1.1.1'])
+        self.assertEqual(self.read(self.tmpdir.name + '/host/www/index.html'), 'hello\n')
+        self.assertTrue(os.path.isdir(self.tmpdir.name + '/host/data'))
+        self.assertTrue(os.path.isdir(self.upper + '/var/www'))
+        self.assertTrue(os.path.isdir(self.upper + '/data'))
+        self.assertEqual(self.read(self.upper + '/etc/hostname'), 'web\n')
+        self.assertIn('web.example.net', self.read(self.upper + '/etc/hosts'))
+        self.assertEqual(self.read(self.upper + '/etc/resolv.conf'), 'nameserver 10.1.1.1\n\n')
+        # the origin is not modified and nothing is created relative to the cwd
+        self.assertEqual(self.read(self.lower + '/var/www/index.html'), 'hello\n')
+        self.assertEqual(self.read(self.lower + '/etc/hostname'), 'base\n')
+        self.assertEqual(self.read(self.lower + '/etc/hosts'), '127.0.0.1 localhost\n127.0.1.1 base\n')
+        self.assertEqual([name for name in os.listdir(self.tmpdir.name) if ':' in name], [])
+
+    def test_missing_resolvconf(self):
+        ''' Missing directories in a plain directory rootfs are not created '''
+        container = self.container
+        container.get_config_item = lambda key: 'dir:%s' % self.lower
+        container._enable_dns(dns=['10.1.1.1'])
+        self.assertEqual(self.read(self.lower + '/etc/resolv.conf'), 'nameserver 10.1.1.1\n\n')
+        self.assertFalse(os.path.exists(self.lower + '/etc/resolvconf'))
+
 class TestCreateCloneError(LockerTest):
     def setUp(self):
         super().setUp()
@@ -228,5 +345,57 @@ class TestCreateCloneError(LockerTest):
                 container.create()
             self.assertEqual(container.defined, False)
 
+class FakeContainer(object):
+    ''' Shuts down after "delay" seconds, never if "delay" is None '''
+
+    def __init__(self, name, delay, running=True):
+        self.name = name
+        self.delay = delay
+        self.logger = logging.getLogger(name)
+        self.requested = None
+        self.killed = False
+        self._running = running
+
+    @property
+    def running(self):
+        if not self._running or self.killed:
+            return False
+        return self.delay is None or time.time() - self.requested < self.delay
+
+    def request_stop(self):
+        if not self._running:
+            return None
+        self.requested = time.time()
+        return True
+
+    def finish_stop(self):
+        if self.running:
+            self.killed = True
+
+class TestStopContainers(unittest.TestCase):
+    ''' Test the parallel stop with fake containers '''
+
+    def test_deadline(self):
+        containers = [FakeContainer('fast', 0.05), FakeContainer('slow', 0.2),
+                      FakeContainer('hung', None), FakeContainer('stopped', 0, running=False)]
+        begin = time.time()
+        stopped = stop_containers(containers, 0.5, interval=0.01)
+        seconds = time.time() - begin
+        # the deadline is shared, not per container
+        self.assertLess(seconds, 0.9)
+        self.assertEqual([(con.name, killed) for con, _latency, killed in stopped],
+                         [('fast', False), ('slow', False), ('hung', True)])
+        latencies = dict((con.name, latency) for con, latency, _killed in stopped)
+        self.assertLess(latencies['fast'], latencies['slow'])
+        self.assertGreaterEqual(latencies['hung'], 0.5)
+
+    def test_all_stopped(self):
+        containers = [FakeContainer('c%d' % num, 0.05) for num in range(10)]
+        begin = time.time()
+        stopped = stop_containers(containers, 30, interval=0.01)
+        self.assertLess(time.time() - begin, 1)
+        self.assertEqual(len(stopped), 10)
+        self.assertFalse(any(killed for _con, _latency, killed in stopped))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the Locker daemon and its client
+'''
+
+import io
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from locker.daemon import (Daemon, DaemonUnavailable, ProjectCache,
+                           install_relays, request)
+
+# timings are only asserted if set, they depend on the load of the machine
+BENCHMARK = 'LOCKER_BENCHMARK' in os.environ
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+class FakeProject(object):
+    def __init__(self):
+        self.args = None
+
+    def select(self, args):
+        self.args = args
+
+def fake_run(args, projects):
+    ''' Echo the command and log if the project was reused '''
+    reused = projects.get(args) is not None
+    if not reused:
+        projects.add(args, FakeProject())
+    sys.stdout.write('%s %s\n' % (args['command'], ' '.join(args['containers'])))
+    logging.getLogger('daemon_test').warning('reused: %s', reused)
+    if args['command'] == 'fail':
+        raise RuntimeError('failed')
+    return 3 if args['command'] == 'exit' else 0
+
+class TestDaemon(unittest.TestCase):
+    ''' Run the daemon with a fake command runner '''
+
+    REQUESTS = 500
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.socket = os.path.join(self.tmpdir.name, 'run', 'lockerd.sock')
+        self.file = os.path.join(self.tmpdir.name, 'locker.yaml')
+        with open(self.file, 'w') as yml_fd:
+            yml_fd.write('containers: {}\n')
+
+        streams = install_relays()
+        def restore():
+            sys.stdout, sys.stderr = streams
+        self.addCleanup(restore)
+        logger = logging.getLogger('daemon_test')
+        logger.propagate = False
+        handler = logging.StreamHandler()
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        daemon = Daemon(self.socket, runner=fake_run)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        def stop():
+            daemon.shutdown()
+            thread.join()
+            daemon.server_close()
+        self.addCleanup(stop)
+
+    def args(self, command, containers=()):
+        return {'command': command, 'containers': list(containers), 'file': self.file,
+                'project': 'test', 'lxcpath': '/var/lib/lxc', 'cache_dir': None}
+
+    def request(self, args):
+        ''' Send a request and capture the relayed output '''
+        stdout, stderr = io.StringIO(), io.StringIO()
+        code = request(args, self.socket, stdout, stderr)
+        return code, stdout.getvalue(), stderr.getvalue()
+
+    def test_request(self):
+        self.assertEqual(self.request(self.args('start', ['db', 'web'])),
+                         (0, 'start db web\n', 'reused: False\n'))
+        self.assertEqual(self.request(self.args('exit')), (3, 'exit \n', 'reused: True\n'))
+        self.assertEqual(self.request(self.args('fail'))[0], 1)
+        # the daemon survives failed commands
+        self.assertEqual(self.request(self.args('stop')), (0, 'stop \n', 'reused: False\n'))
+
+    def test_unavailable(self):
+        with self.assertRaises(DaemonUnavailable):
+            request(self.args('start'), os.path.join(self.tmpdir.name, 'missing.sock'))
+        with self.assertRaises(RuntimeError):
+            Daemon(self.socket)
+
+    def test_latency(self):
+        args = self.args('status')
+        start = time.time()
+        for _num in range(self.REQUESTS):
+            self.assertEqual(self.request(args)[0], 0)
+        seconds = time.time() - start
+        logging.info('%d requests in %.3fs: %.0f requests/s', self.REQUESTS, seconds, self.REQUESTS / seconds)
+        if BENCHMARK:
+            self.assertGreater(self.REQUESTS / seconds, 50)
+
+class TestProjectCache(unittest.TestCase):
+    ''' Test the reuse of projects '''
+
+    def test_outdated(self):
+        with tempfile.NamedTemporaryFile('w') as yml_fd:
+            args = {'file': yml_fd.name, 'project': 'test'}
+            cache = ProjectCache()
+            self.assertIsNone(cache.get(args))
+            project = FakeProject()
+            cache.add(args, project)
+            other_args = dict(args, containers=['db'])
+            self.assertIs(cache.get(other_args), project)
+            self.assertIs(project.args, other_args)
+            yml_fd.write('containers: {}\n')
+            yml_fd.flush()
+            self.assertIsNone(cache.get(args))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the DNS responder
+'''
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from locker.config import ContainerConfig
+from locker.dns import (RCODE_NOERROR, RCODE_NXDOMAIN, Registry, Responder,
+                        _lock_pid_file, build_response, notify, parse_query, pid_file)
+
+# timings are only asserted if set, they depend on the load of the machine
+BENCHMARK = 'LOCKER_BENCHMARK' in os.environ
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+def make_query(name, qid=1, qtype=1):
+    ''' Build a DNS query packet '''
+    labels = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.'))
+    return struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) + labels + b'\x00' + struct.pack('!HH', qtype, 1)
+
+def parse_response(data):
+    ''' Get ID, response code, and the IP addresses of the A records '''
+    qid, flags, _qdcount, ancount, _nscount, _arcount = struct.unpack_from('!HHHHHH', data)
+    ips = [socket.inet_ntoa(data[-4 - 16 * num:len(data) - 16 * num]) for num in range(ancount)]
+    return qid, flags & 0xF, list(reversed(ips))
+
+class FakeContainer(object):
+    def __init__(self, name, yml, ips):
+        self.name = name
+        self.config = ContainerConfig.compile(name, yml, {})
+        self.running = bool(ips)
+        self.ips = ips
+
+    def get_ips(self, retries=10):
+        return self.ips
+
+class FakeProject(object):
+    def __init__(self, containers):
+        self.name = 'test'
+        self.all_containers = containers
+
+    def get_container(self, name):
+        for container in self.all_containers:
+            if container.name == 'test_%s' % name:
+                return container
+        return None
+
+def make_registry():
+    return Registry.from_project(FakeProject([
+        FakeContainer('test_db', {'fqdn': 'db.example.net'}, ['10.1.1.2']),
+        FakeContainer('test_web', {'links': ['db:database', 'cache']}, ['10.1.1.3']),
+        FakeContainer('test_cache', {}, []),
+    ]))
+
+class TestRegistry(unittest.TestCase):
+    ''' Test the name registry '''
+
+    def test_names(self):
+        registry = make_registry()
+        for name in ['test_db', 'db', 'DB.example.net.', 'db.example.net']:
+            self.assertEqual(registry.resolve(name), ['10.1.1.2'])
+        self.assertEqual(registry.resolve('web'), ['10.1.1.3'])
+        # stopped containers are not resolved
+        self.assertIsNone(registry.resolve('cache'))
+
+    def test_aliases(self):
+        registry = make_registry()
+        self.assertEqual(registry.resolve('database', '10.1.1.3'), ['10.1.1.2'])
+        self.assertIsNone(registry.resolve('database', '10.1.1.2'))
+        self.assertIsNone(registry.resolve('database'))
+
+class TestPackets(unittest.TestCase):
+    ''' Test parsing of queries and building of responses '''
+
+    def test_parse(self):
+        qid, flags, name, qtype, qclass, question = parse_query(make_query('db.example.net', 42))
+        self.assertEqual((qid, flags, name, qtype, qclass), (42, 0x0100, 'db.example.net', 1, 1))
+        response = build_response(qid, flags, question, RCODE_NOERROR, ['10.1.1.2', '10.1.1.4'])
+        self.assertEqual(parse_response(response), (42, RCODE_NOERROR, ['10.1.1.2', '10.1.1.4']))
+
+    def test_invalid(self):
+        for packet in [b'', b'\x00' * 11, make_query('db')[:-3], build_response(1, 0, b'', 0)]:
+            with self.assertRaises(ValueError):
+                parse_query(packet)
+
+    def test_answer(self):
+        responder = Responder(make_registry())
+        self.assertEqual(parse_response(responder.answer(make_query('database'), '10.1.1.3')),
+                         (1, RCODE_NOERROR, ['10.1.1.2']))
+        self.assertEqual(parse_response(responder.answer(make_query('database'), '10.1.1.2')),
+                         (1, RCODE_NXDOMAIN, []))
+        # known names without AAAA records
+        self.assertEqual(parse_response(responder.answer(make_query('db', qtype=28))),
+                         (1, RCODE_NOERROR, []))
+        # unknown names are forwarded if upstream servers are available
+        self.assertIsNone(Responder(make_registry(), ['127.0.0.1']).answer(make_query('example.org')))
+
+class TestNotify(unittest.TestCase):
+    ''' Signal this process as DNS responder '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.signals = list()
+        self.handler = signal.signal(signal.SIGHUP, lambda signum, _frame: self.signals.append(signum))
+
+    def tearDown(self):
+        signal.signal(signal.SIGHUP, self.handler)
+        self.tmpdir.cleanup()
+
+    def test_notify(self):
+        pid_fd = _lock_pid_file(pid_file('test', self.tmpdir.name))
+        try:
+            self.assertTrue(notify('test', self.tmpdir.name))
+            self.assertEqual(self.signals, [signal.SIGHUP])
+            # a second responder is refused
+            with self.assertRaises(BlockingIOError):
+                _lock_pid_file(pid_file('test', self.tmpdir.name))
+        finally:
+            os.close(pid_fd)
+
+    def test_stale(self):
+        with open(pid_file('test', self.tmpdir.name), 'w') as pid_fd:
+            pid_fd.write('%d\n' % os.getpid())
+        self.assertFalse(notify('test', self.tmpdir.name))
+        self.assertFalse(notify('missing', self.tmpdir.name))
+        self.assertEqual(self.signals, [])
+
+class TestServer(unittest.TestCase):
+    ''' Run the responder on the loopback device '''
+
+    QUERIES = 20000
+    WINDOW = 64
+
+    def start(self, responder):
+        loop = asyncio.new_event_loop()
+        transport, _protocol = loop.run_until_complete(
+            loop.create_datagram_endpoint(lambda: responder, local_addr=('127.0.0.1', 0)))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            transport.close()
+            loop.close()
+        self.addCleanup(stop)
+        return transport.get_extra_info('sockname')
+
+    def client(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        sock.connect(addr)
+        self.addCleanup(sock.close)
+        return sock
+
+    def test_forward(self):
+        upstream = self.start(Responder(make_registry()))
+        addr = self.start(Responder(Registry(), ['127.0.0.1'], upstream_port=upstream[1]))
+        sock = self.client(addr)
+        sock.send(make_query('db', 7))
+        self.assertEqual(parse_response(sock.recv(512)), (7, RCODE_NOERROR, ['10.1.1.2']))
+
+    def test_qps(self):
+        addr = self.start(Responder(make_registry()))
+        sock = self.client(addr)
+        queries = [make_query(name, num) for num, name in
+                   enumerate(['db', 'web', 'db.example.net', 'test_web'] * (self.WINDOW // 4))]
+        start = time.time()
+        answered = 0
+        while answered < self.QUERIES:
+            # keep a window of outstanding queries
+            for query in queries:
+                sock.send(query)
+            for _num in range(len(queries)):
+                qid, rcode, ips = parse_response(sock.recv(512))
+                self.assertEqual(rcode, RCODE_NOERROR)
+                self.assertEqual(len(ips), 1)
+            answered += len(queries)
+        seconds = time.time() - start
+        logging.info('%d queries in %.3fs: %.0f queries/s', answered, seconds, answered / seconds)
+        if BENCHMARK:
+            self.assertGreater(answered / seconds, 1000)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the /etc/hosts parser and manager
+'''
+
+import logging
+import os
+import tempfile
+import time
+import unittest
+
+from locker.etchosts import DuplicateIP, Hosts, IPNotFound, merge_block
+
+# timings are only asserted if set, they depend on the load of the machine
+BENCHMARK = 'LOCKER_BENCHMARK' in os.environ
+
+HOSTS = '''127.0.0.1\tlocalhost
+127.0.1.1\tubuntu
+
+# The following lines are desirable for IPv6 capable hosts
+::1     ip6-localhost ip6-loopback
+ff02::1 ip6-allnodes
+10.1.1.2   db.example.net db database # test_db
+10.1.1.3   web # test_web
+10.1.1.4   other # other_web
+'''
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+class HostsTest(unittest.TestCase):
+    ''' Writes a hosts file to a temporary directory '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.hosts_file = os.path.join(self.tmpdir.name, 'hosts')
+        self.write(HOSTS)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, content):
+        with open(self.hosts_file, 'w') as hosts_fd:
+            hosts_fd.write(content)
+
+    def read(self):
+        with open(self.hosts_file, 'r') as hosts_fd:
+            return hosts_fd.read()
+
+class TestHosts(HostsTest):
+    ''' Test parsing, lookups, and modifications '''
+
+    def test_parse(self):
+        hosts = Hosts(self.hosts_file)
+        self.assertEqual(len(hosts), 9)
+        self.assertEqual(hosts.get_row('10.1.1.2').names, ['db.example.net', 'db', 'database'])
+        self.assertEqual(hosts.get_row('10.1.1.2').comment, 'test_db')
+        self.assertEqual(hosts.get_row('::1').names, ['ip6-localhost', 'ip6-loopback'])
+        self.assertIsNone(hosts.get_row('10.1.1.5'))
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            Hosts(os.path.join(self.tmpdir.name, 'missing'))
+
+    def test_missing_ok(self):
+        fragment = os.path.join(self.tmpdir.name, 'test.hosts')
+        hosts = Hosts(fragment, missing_ok=True)
+        self.assertEqual(len(hosts), 0)
+        hosts.add('10.1.1.2', ['db'], 'test_db')
+        self.assertTrue(hosts.save())
+        with open(fragment, 'r') as hosts_fd:
+            self.assertEqual(hosts_fd.read(), '10.1.1.2 db # test_db\n')
+
+    def test_lookup(self):
+        hosts = Hosts(self.hosts_file)
+        self.assertEqual([str(r.ip) for r in hosts.get_rows_by_name('web')], ['10.1.1.3'])
+        self.assertEqual([str(r.ip) for r in hosts.get_rows_by_comment_prefix('test')], ['10.1.1.2', '10.1.1.3'])
+        self.assertEqual(hosts.get_rows_by_name('missing'), [])
+
+    def test_add(self):
+        hosts = Hosts(self.hosts_file)
+        hosts.add('10.1.1.5', ['new'], 'test_new')
+        self.assertEqual(hosts.get_row('10.1.1.5').names, ['new'])
+        self.assertEqual(hosts.rows[-1].comment, 'test_new')
+        with self.assertRaises(DuplicateIP):
+            hosts.add('10.1.1.5', ['new'])
+
+    def test_remove_ip(self):
+        hosts = Hosts(self.hosts_file)
+        hosts.remove_ip('10.1.1.3')
+        self.assertIsNone(hosts.get_row('10.1.1.3'))
+        self.assertEqual(hosts.get_rows_by_name('web'), [])
+        with self.assertRaises(IPNotFound):
+            hosts.remove_ip('10.1.1.3')
+
+    def test_update_ip(self):
+        hosts = Hosts(self.hosts_file)
+        hosts.update_ip('127.0.1.1', ['test.example.net', 'test'])
+        self.assertEqual([str(r.ip) for r in hosts.get_rows_by_name('test')], ['127.0.1.1'])
+        self.assertEqual(hosts.get_rows_by_name('ubuntu'), [])
+        with self.assertRaises(IPNotFound):
+            hosts.update_ip('10.1.1.5', ['foo'])
+
+    def test_remove_by_comment(self):
+        hosts = Hosts(self.hosts_file)
+        self.assertEqual(hosts.remove_by_comment_prefix('test'), 2)
+        self.assertEqual(hosts.remove_by_comment_prefix('test'), 0)
+        self.assertIsNotNone(hosts.get_row('10.1.1.4'))
+        self.assertEqual(hosts.remove_by_comment('^other_.*$'), 1)
+        self.assertEqual(len(hosts), 6)
+
+    def test_save(self):
+        hosts = Hosts(self.hosts_file)
+        hosts.remove_by_comment_prefix('test')
+        hosts.add('10.1.1.5', ['new'], 'test_new')
+        hosts.save()
+        hosts = Hosts(self.hosts_file)
+        self.assertEqual(len(hosts), 8)
+        self.assertEqual(hosts.get_row('10.1.1.5').comment, 'test_new')
+        self.assertEqual(hosts.rows[0].names, ['localhost'])
+
+    def test_save_unchanged(self):
+        hosts = Hosts(self.hosts_file)
+        inode = os.stat(self.hosts_file).st_ino
+        self.assertFalse(hosts.save())
+        hosts.remove_by_comment_prefix('test')
+        hosts.add('10.1.1.2', ['db'], 'test_db')
+        hosts.add('10.1.1.3', ['web'], 'test_web')
+        self.assertTrue(hosts.save())
+        self.assertFalse(hosts.save())
+        self.assertNotEqual(os.stat(self.hosts_file).st_ino, inode)
+
+    def test_save_atomic(self):
+        os.chmod(self.hosts_file, 0o640)
+        hosts = Hosts(self.hosts_file)
+        hosts.add('10.1.1.5', ['new'], 'test_new')
+        self.assertTrue(hosts.save())
+        self.assertEqual(os.stat(self.hosts_file).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.tmpdir.name), ['hosts'])
+
+    def test_format(self):
+        hosts = Hosts(self.hosts_file)
+        hosts.remove_by_comment_prefix('test')
+        hosts.add('10.1.1.12', ['db.example.net', 'db'], 'test_db')
+        hosts.add('10.1.1.3', ['web'], 'test_web')
+        hosts.add('10.1.1.6', ['nocomment'])
+        lines = hosts.dumps().split('\n')
+        # unmodified rows are kept, modified rows are aligned
+        self.assertEqual(lines[0], '127.0.0.1\tlocalhost')
+        self.assertEqual(lines[-4:-1], ['10.1.1.12 db.example.net db # test_db',
+                                        '10.1.1.3  web               # test_web',
+                                        '10.1.1.6  nocomment'])
+        self.assertIn('::1       ip6-localhost ip6-loopback', str(hosts))
+
+    def test_round_trip(self):
+        content = ('127.0.0.1   localhost\t# with  spaces \r\n'
+                   '#10.1.1.9 disabled.example.net\n'
+                   '# dead beef cafe\n'
+                   'not an entry\n'
+                   '\t\n'
+                   '2001:0db8::0001 v6 # test_v6')
+        self.write(content)
+        hosts = Hosts(self.hosts_file)
+        self.assertTrue(hosts.rows[1].is_deactivated)
+        self.assertTrue(hosts.rows[2].is_comment)
+        self.assertTrue(hosts.rows[3].is_invalid)
+        self.assertEqual(hosts.get_row('2001:db8::1').names, ['v6'])
+        hosts.save()
+        with open(self.hosts_file, 'r', newline='') as hosts_fd:
+            self.assertEqual(hosts_fd.read(), content)
+        # only the modified rows are formatted
+        hosts.remove_by_comment_prefix('test')
+        hosts.add('10.1.1.5', ['new'], 'test_new')
+        self.assertEqual(hosts.dumps(), content.rsplit('\n', 1)[0] + '\n10.1.1.5 new # test_new')
+
+class TestMergeBlock(HostsTest):
+    ''' Test merging of project blocks into a hosts file '''
+
+    def test_merge(self):
+        self.assertTrue(merge_block(self.hosts_file, 'test', '10.1.1.5 new # test_new\n'))
+        self.assertFalse(merge_block(self.hosts_file, 'test', '10.1.1.5 new # test_new\n'))
+        self.assertTrue(merge_block(self.hosts_file, 'other', '10.1.1.7 other # other_web'))
+        self.assertEqual(self.read(), HOSTS +
+                         '# BEGIN locker test\n10.1.1.5 new # test_new\n# END locker test\n'
+                         '# BEGIN locker other\n10.1.1.7 other # other_web\n# END locker other\n')
+        self.assertTrue(merge_block(self.hosts_file, 'test', '10.1.1.6 new # test_new\n'))
+        hosts = Hosts(self.hosts_file)
+        self.assertEqual(hosts.get_row('10.1.1.6').names, ['new'])
+        self.assertIsNone(hosts.get_row('10.1.1.5'))
+        # the block is removed if empty
+        self.assertTrue(merge_block(self.hosts_file, 'test', ''))
+        self.assertTrue(merge_block(self.hosts_file, 'other', ''))
+        self.assertEqual(self.read(), HOSTS)
+
+class TestBenchmark(HostsTest):
+    ''' Micro-benchmark with a large hosts file '''
+
+    LINES = 100000
+
+    def setUp(self):
+        super().setUp()
+        lines = ['10.%d.%d.%d host%d.example.net host%d # proj%d_host%d' %
+                 (num >> 16 & 255, num >> 8 & 255, num & 255, num, num, num % 100, num)
+                 for num in range(TestBenchmark.LINES)]
+        self.write(HOSTS + '\n'.join(lines) + '\n')
+
+    def test_operations(self):
+        start = time.time()
+        hosts = Hosts(self.hosts_file)
+        loaded = time.time()
+        # the first lookup analyzes all lines and builds the indexes
+        self.assertIsNotNone(hosts.get_row('127.0.0.1'))
+        parsed = time.time()
+        for num in range(1000):
+            hosts.add('172.16.%d.%d' % (num >> 8, num & 255), ['link%d' % num], 'locker_link%d' % num)
+        for num in range(0, TestBenchmark.LINES, 100):
+            self.assertIsNotNone(hosts.get_row('10.%d.%d.%d' % (num >> 16 & 255, num >> 8 & 255, num & 255)))
+            self.assertEqual(len(hosts.get_rows_by_name('host%d' % num)), 1)
+        self.assertEqual(hosts.remove_by_comment_prefix('locker'), 1000)
+        self.assertEqual(hosts.remove_by_comment_prefix('proj1'), TestBenchmark.LINES // 100)
+        modified = time.time()
+        hosts.save()
+        saved = time.time()
+        logging.info('%d lines: load %.3fs, index %.3fs, 3000 lookups/1000 adds/2000 removals %.3fs, save %.3fs',
+                     len(hosts), loaded - start, parsed - loaded, modified - parsed, saved - modified)
+        if BENCHMARK:
+            # operations on the indexes must not depend on the file size
+            self.assertLess(modified - parsed, 1.0)
+
+    def test_round_trip(self):
+        with open(self.hosts_file, 'r') as hosts_fd:
+            content = hosts_fd.read()
+        start = time.time()
+        hosts = Hosts(self.hosts_file)
+        parsed = time.time()
+        self.assertEqual(hosts.dumps(), content)
+        dumped = time.time()
+        logging.info('%d lines: load %.3fs, dump %.3fs', len(hosts), parsed - start, dumped - parsed)
+        if BENCHMARK:
+            # lines are analyzed lazily
+            self.assertLess(parsed - start, 1.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test copying and moving of directory trees
+'''
+
+import errno
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from locker.fastcopy import copy_file, copy_tree, move_tree
+
+class TestCopyTree(unittest.TestCase):
+    ''' Test copy_tree() and move_tree()
+
+    Creates files in a temporary directory only
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'src')
+        self.dst = os.path.join(self.tmpdir.name, 'dst')
+        os.makedirs(os.path.join(self.src, 'sub', 'deep'))
+        with open(os.path.join(self.src, 'file'), 'wb') as file_fd:
+            file_fd.write(os.urandom(3 * 2**20 + 17))
+        with open(os.path.join(self.src, 'sub', 'deep', 'small'), 'w') as file_fd:
+            file_fd.write('content')
+        open(os.path.join(self.src, 'empty'), 'w').close()
+        os.chmod(os.path.join(self.src, 'sub', 'deep', 'small'), 0o4750)
+        os.chmod(os.path.join(self.src, 'sub'), 0o700)
+        os.chown(os.path.join(self.src, 'file'), 1234, 4321)
+        os.symlink('sub/deep/small', os.path.join(self.src, 'link'))
+        os.symlink('sub', os.path.join(self.src, 'dirlink'))
+        os.link(os.path.join(self.src, 'file'), os.path.join(self.src, 'sub', 'hardlink'))
+        os.mkfifo(os.path.join(self.src, 'fifo'))
+        os.utime(os.path.join(self.src, 'sub'), (1000000000, 1000000000))
+        self.xattrs = True
+        try:
+            os.setxattr(os.path.join(self.src, 'empty'), 'user.locker', b'value')
+        except OSError:
+            self.xattrs = False
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _assert_equal_trees(self, src_stats=None):
+        for root, dirnames, filenames in os.walk(self.src):
+            for name in dirnames + filenames:
+                src_path = os.path.join(root, name)
+                dst_path = os.path.join(self.dst, os.path.relpath(src_path, self.src))
+                src_stat = os.lstat(src_path)
+                dst_stat = os.lstat(dst_path)
+                self.assertEqual(src_stat.st_mode, dst_stat.st_mode, dst_path)
+                self.assertEqual(src_stat.st_uid, dst_stat.st_uid, dst_path)
+                self.assertEqual(src_stat.st_gid, dst_stat.st_gid, dst_path)
+                self.assertEqual(src_stat.st_mtime_ns, dst_stat.st_mtime_ns, dst_path)
+                if stat.S_ISREG(src_stat.st_mode):
+                    with open(src_path, 'rb') as src_fd, open(dst_path, 'rb') as dst_fd:
+                        self.assertEqual(src_fd.read(), dst_fd.read())
+                if stat.S_ISLNK(src_stat.st_mode):
+                    self.assertEqual(os.readlink(src_path), os.readlink(dst_path))
+
+    def test_copy_tree(self):
+        stats = copy_tree(self.src, self.dst, workers=3, budget=2**20)
+        self._assert_equal_trees()
+        self.assertEqual(stats.dirs, 3)
+        self.assertEqual(stats.bytes, 3 * 2**20 + 17 + len('content'))
+        self.assertEqual(os.lstat(os.path.join(self.dst, 'file')).st_ino,
+                         os.lstat(os.path.join(self.dst, 'sub', 'hardlink')).st_ino)
+        if self.xattrs:
+            self.assertEqual(os.getxattr(os.path.join(self.dst, 'empty'), 'user.locker'), b'value')
+
+    def test_copy_tree_exists(self):
+        os.mkdir(self.dst)
+        with self.assertRaises(OSError):
+            copy_tree(self.src, self.dst)
+
+    def test_move_tree(self):
+        src_inode = os.lstat(self.src).st_ino
+        stats = move_tree(self.src, self.dst)
+        self.assertEqual(stats.method, 'rename')
+        self.assertFalse(os.path.exists(self.src))
+        self.assertEqual(os.lstat(self.dst).st_ino, src_inode)
+
+    def test_copy_file(self):
+        dst = os.path.join(self.tmpdir.name, 'copy')
+        self.assertEqual(copy_file(os.path.join(self.src, 'file'), dst), 3 * 2**20 + 17)
+        with open(os.path.join(self.src, 'file'), 'rb') as src_fd, open(dst, 'rb') as dst_fd:
+            self.assertEqual(src_fd.read(), dst_fd.read())
+
+    def test_copy_file_eof(self):
+        ''' Fall back if the kernel copies nothing, fail on short copies '''
+        src = os.path.join(self.src, 'file')
+        dst = os.path.join(self.tmpdir.name, 'copy')
+        with mock.patch('locker.fastcopy._reflink', return_value=False), \
+             mock.patch('os.copy_file_range', return_value=0, create=True), \
+             mock.patch('os.sendfile', return_value=0):
+            copy_file(src, dst)
+        with open(src, 'rb') as src_fd, open(dst, 'rb') as dst_fd:
+            self.assertEqual(src_fd.read(), dst_fd.read())
+        with mock.patch('locker.fastcopy._reflink', return_value=False), \
+             mock.patch('os.copy_file_range', side_effect=[4096, 0], create=True):
+            with self.assertRaises(OSError) as context:
+                copy_file(src, dst)
+        self.assertEqual(context.exception.errno, errno.EIO)
+
+if __name__ == "__main__":
+    unittest.main()
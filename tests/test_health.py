@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the readiness checks of containers
+'''
+
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from locker.config import ContainerConfig
+from locker.health import check, dependency_waves, wait_ready
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+class FakeContainer(object):
+    ''' The container's mount namespace is the one of the test '''
+
+    def __init__(self, name, yml, running=True):
+        self.name = 'test_%s' % name
+        self.config = ContainerConfig.compile(name, yml)
+        self.running = running
+        self.init_pid = os.getpid()
+        self.logger = logging.getLogger(self.name)
+
+    def get_ips(self, retries=10):
+        return ['127.0.0.1']
+
+class TestDependencyWaves(unittest.TestCase):
+    ''' Test the order of the start '''
+
+    def test_waves(self):
+        containers = [FakeContainer('web', {'links': ['app', 'cache']}),
+                      FakeContainer('app', {'links': ['db', 'other']}),
+                      FakeContainer('db', {}),
+                      FakeContainer('cache', {'links': ['cache']})]
+        waves = dependency_waves(containers)
+        self.assertEqual([[con.config.name for con in wave] for wave in waves],
+                         [['db', 'cache'], ['app'], ['web']])
+
+    def test_cycle(self):
+        containers = [FakeContainer('a', {'links': ['b']}), FakeContainer('b', {'links': ['a']}),
+                      FakeContainer('c', {})]
+        waves = dependency_waves(containers)
+        self.assertEqual([[con.config.name for con in wave] for wave in waves], [['c'], ['a', 'b']])
+
+class TestProbes(unittest.TestCase):
+    ''' Run the probes against the test's own network and file system '''
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.addCleanup(self.server.close)
+        self.port = self.server.getsockname()[1]
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.ready_file = os.path.join(self.tmpdir.name, 'ready')
+
+    def test_check(self):
+        containers = [FakeContainer('tcp', {'healthcheck': {'tcp': self.port}}),
+                      FakeContainer('file', {'healthcheck': {'file': self.ready_file}}),
+                      FakeContainer('none', {}),
+                      FakeContainer('stopped', {'healthcheck': {'tcp': self.port}}, running=False)]
+        self.assertEqual(check(containers), {'test_tcp': 'healthy', 'test_file': 'unhealthy',
+                                             'test_none': None, 'test_stopped': None})
+
+    def test_wait_ready(self):
+        healthcheck = {'file': self.ready_file, 'timeout': 5, 'interval': 0.05}
+        containers = [FakeContainer('file%d' % num, {'healthcheck': healthcheck}) for num in range(10)]
+        containers.append(FakeContainer('slow', {'healthcheck': {'file': '/nonexistent', 'timeout': 0.3}}))
+        containers.append(FakeContainer('stopped', {}, running=False))
+        def create():
+            time.sleep(0.2)
+            open(self.ready_file, 'w').close()
+        thread = threading.Thread(target=create)
+        thread.start()
+        begin = time.time()
+        ready = wait_ready(containers)
+        thread.join()
+        # the containers are probed concurrently
+        self.assertLess(time.time() - begin, 2)
+        self.assertEqual(ready, dict([(con.name, con.name.startswith('test_file')) for con in containers]))
+
+if __name__ == "__main__":
+    unittest.main()
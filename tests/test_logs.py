@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test showing and following the logs of containers
+'''
+
+import io
+import logging
+import os
+import tempfile
+import time
+import unittest
+
+from locker.attach import MAX_LINE
+from locker.config import ContainerConfig
+from locker.logs import Follower, sources, timestamp
+
+class FakeContainer(object):
+    ''' Container with a console log in a temporary directory '''
+
+    def __init__(self, name, lxcpath):
+        self.name = 'test_%s' % name
+        self.color = ''
+        self.defined = True
+        self.logger = logging.getLogger(self.name)
+        self.config = ContainerConfig.compile(name, {'console_log': True})
+        self.console_log = os.path.join(lxcpath, self.name, 'console.log')
+        os.makedirs(os.path.dirname(self.console_log))
+
+    def write(self, text, mode='a'):
+        with open(self.console_log, mode) as log_fo:
+            log_fo.write(text)
+
+class TestTimestamp(unittest.TestCase):
+    ''' Parse the timestamps of log lines '''
+
+    def test_timestamp(self):
+        local = time.mktime((2015, 3, 1, 12, 0, 0, 0, 0, -1))
+        self.assertEqual(timestamp(b'2015-03-01 12:00:00 started'), local)
+        self.assertAlmostEqual(timestamp(b'[2015-03-01T12:00:00.250] started'), local + 0.25)
+        self.assertEqual(timestamp(b'Oct  1 08:30:00 host cron[1]: run'),
+                         time.mktime((time.localtime().tm_year, 10, 1, 8, 30, 0, 0, 0, -1)))
+        self.assertIsNone(timestamp(b'Foo  1 08:30:00 host'))
+        self.assertIsNone(timestamp(b'no timestamp'))
+
+class TestFollower(unittest.TestCase):
+    ''' Show and follow console logs in temporary directories '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.web = FakeContainer('web', self.tmpdir.name)
+        self.db = FakeContainer('db', self.tmpdir.name)
+        self.output = io.StringIO()
+        self.follower = Follower(sources([self.web, self.db]), self.output)
+
+    def tearDown(self):
+        self.follower.close()
+        self.tmpdir.cleanup()
+
+    def lines(self):
+        lines = self.output.getvalue().splitlines()
+        self.output.seek(0)
+        self.output.truncate()
+        return lines
+
+    def poll(self):
+        while self.follower.poll(0.2):
+            pass
+
+    def test_tail(self):
+        self.web.write('2015-03-01 12:00:01 web 1\n  continued\n2015-03-01 12:00:03 web 2\n')
+        self.db.write('2015-03-01 12:00:00 db 1\n2015-03-01 12:00:02 db 2\npartial')
+        self.follower.tail(10)
+        self.assertEqual(self.lines(), ['db  | 2015-03-01 12:00:00 db 1',
+                                        'web | 2015-03-01 12:00:01 web 1',
+                                        'web |   continued',
+                                        'db  | 2015-03-01 12:00:02 db 2',
+                                        'web | 2015-03-01 12:00:03 web 2'])
+        # the incomplete line is completed by the next write
+        self.db.write(' line\n')
+        self.poll()
+        self.assertEqual(self.lines(), ['db  | partial line'])
+
+    def test_last_lines(self):
+        self.web.write(''.join('line %d\n' % num for num in range(100)))
+        self.follower.tail(2)
+        self.assertEqual(self.lines(), ['web | line 98', 'web | line 99'])
+
+    def test_follow(self):
+        self.web.write('old\n')
+        self.follower.tail(0)
+        self.assertEqual(self.lines(), [])
+
+        # the console log of "db" is created after following started
+        self.db.write('created\n')
+        self.web.write('new\n')
+        self.poll()
+        self.assertEqual(sorted(self.lines()), ['db  | created', 'web | new'])
+
+        # truncated like by "logrotate" with "copytruncate"
+        self.web.write('', mode='w')
+        self.poll()
+        self.web.write('truncated\n')
+        self.poll()
+        self.assertEqual(self.lines(), ['web | truncated'])
+
+        # rotated
+        os.rename(self.web.console_log, self.web.console_log + '.1')
+        self.web.write('rotated\n')
+        self.poll()
+        self.assertEqual(self.lines(), ['web | rotated'])
+        self.web.write('again\n')
+        self.poll()
+        self.assertEqual(self.lines(), ['web | again'])
+
+    def test_long_lines(self):
+        self.follower.tail(0)
+        self.web.write('x' * (MAX_LINE * 2 + 10) + '\n')
+        self.poll()
+        self.assertEqual([len(line) for line in self.lines()], [MAX_LINE + 6, MAX_LINE + 6, 16])
+        self.assertLessEqual(len(self.follower.sources[0].buffer), MAX_LINE)
+
+if __name__ == "__main__":
+    unittest.main()
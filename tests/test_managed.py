@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the files managed by Locker
+'''
+
+import os
+import tempfile
+import unittest
+
+from locker.managed import ManagedFiles
+from locker.state import ContainerState, StateStore
+
+class TestManagedFiles(unittest.TestCase):
+    ''' Test that files are only written if their content changed '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'fstab')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def managed(self):
+        store = StateStore(self.tmpdir.name)
+        self.addCleanup(store.close)
+        return ManagedFiles(ContainerState(store, 'test_web'))
+
+    def read(self, filename=None):
+        with open(filename or self.filename, 'r') as managed_fd:
+            return managed_fd.read()
+
+    def test_write(self):
+        managed = self.managed()
+        self.assertTrue(managed.write(self.filename, 'a b none bind 0 0\n'))
+        inode = os.stat(self.filename).st_ino
+        self.assertFalse(managed.write(self.filename, 'a b none bind 0 0\n'))
+        self.assertTrue(managed.commit())
+        self.assertFalse(managed.commit())
+        # the records survive
+        managed = self.managed()
+        self.assertFalse(managed.write(self.filename, 'a b none bind 0 0\n'))
+        self.assertEqual(os.stat(self.filename).st_ino, inode)
+        self.assertTrue(managed.write(self.filename, 'c d none bind 0 0\n'))
+        self.assertEqual(self.read(), 'c d none bind 0 0\n')
+
+    def test_modified(self):
+        managed = self.managed()
+        managed.write(self.filename, 'nameserver 10.1.1.1\n')
+        managed.commit()
+        with open(self.filename, 'w') as managed_fd:
+            managed_fd.write('nameserver 8.8.8.8\n')
+        # the file is restored although the rendered content did not change
+        self.assertTrue(self.managed().write(self.filename, 'nameserver 10.1.1.1\n'))
+        self.assertEqual(self.read(), 'nameserver 10.1.1.1\n')
+
+    def test_unrecorded(self):
+        with open(self.filename, 'w') as managed_fd:
+            managed_fd.write('web\n')
+        managed = self.managed()
+        self.assertFalse(managed.write(self.filename, 'web\n'))
+        self.assertTrue(managed.commit())
+
+    def test_symlink(self):
+        target = os.path.join(self.tmpdir.name, 'resolv.conf.real')
+        link = os.path.join(self.tmpdir.name, 'resolv.conf')
+        open(target, 'w').close()
+        os.symlink('resolv.conf.real', link)
+        self.assertTrue(self.managed().write(link, 'nameserver 10.1.1.1\n'))
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(self.read(target), 'nameserver 10.1.1.1\n')
+
+if __name__ == "__main__":
+    unittest.main()
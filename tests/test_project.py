@@ -79,3 +79,21 @@ class TestLifeCycle(LockerTest):
         self.project.reboot()
         self.project.stop()
         self.project.remove()
+
+    def test_reboot_in_place(self):
+        container = self.project.get_container('ubuntu')
+        self.project.create(containers=[container])
+        self.project.start(containers=[container])
+        rules = sorted(container.get_port_rules(live=True))
+        ips = container.get_ips()
+        init_pid = container.init_pid
+        self.project.reboot(containers=[container])
+        self.assertTrue(container.running)
+        self.assertNotEqual(container.init_pid, init_pid)
+        self.assertEqual(container.get_ips(), ips)
+        self.assertEqual(sorted(container.get_port_rules(live=True)), rules)
+        self.project.args['full'] = True
+        self.project.reboot(containers=[container])
+        self.assertTrue(container.running)
+        self.project.stop()
+        self.project.remove()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the computation of reconcile plans
+'''
+
+import unittest
+
+from locker.config import ContainerConfig
+from locker.reconcile import Snapshot, Step, desired_ports, execute, plan
+
+class FakeContainer(object):
+    def __init__(self, name, yml, state=None):
+        self.name = name
+        self.config = ContainerConfig.compile(name, yml, {})
+        self.recorded = dict(state or {})
+        self.calls = list()
+
+    def __getattr__(self, name):
+        if name not in ['stop', 'rmports', 'ports', 'cgroup', 'links']:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.calls.append((name, kwargs))
+
+class FakeProject(object):
+    def __init__(self, containers, args=None):
+        self.name = 'test'
+        self.args = args or {}
+        self.all_containers = containers
+        self.containers = containers
+        self.waves = list()
+        self.unhealthy = set()
+
+    def start_waves(self, containers):
+        self.waves.append([con.name for con in containers])
+        return self.unhealthy
+
+    def get_container(self, name):
+        for container in self.all_containers:
+            if container.name == 'test_%s' % name:
+                return container
+        return None
+
+def converged(container, links=()):
+    ''' State recorded after the container was started with its configuration '''
+    return {
+        'started': container.config.start_digest(),
+        'cgroup': [list(item) for item in container.config.cgroup],
+        'links': list(links),
+    }
+
+class TestPlan(unittest.TestCase):
+    ''' Test plan() with fake projects and snapshots '''
+
+    def setUp(self):
+        self.db = FakeContainer('test_db', {'ports': ['5432:5432'], 'cgroup': ['cpu.shares=512']})
+        self.web = FakeContainer('test_web', {'links': ['db'], 'volumes': ['/srv/www:/var/www']})
+        self.db.recorded = converged(self.db)
+        self.web.recorded = converged(self.web, ['db'])
+        self.project = FakeProject([self.db, self.web])
+        names = set(['test_db', 'test_web'])
+        ips = {'test_db': ('10.1.1.2',), 'test_web': ('10.1.1.3',)}
+        ports = {'test_db': desired_ports(self.db, ips['test_db'])}
+        self.snapshot = Snapshot(True, names, names, ips, ports)
+
+    def actions(self, snapshot=None):
+        return [(step.action, step.container) for step in plan(self.project, snapshot or self.snapshot)]
+
+    def test_converged(self):
+        self.assertEqual(self.actions(), [])
+
+    def test_missing(self):
+        snapshot = Snapshot(False, set(), set(), {}, {})
+        self.assertEqual(self.actions(snapshot), [
+            ('network', None),
+            ('create', 'test_db'), ('create', 'test_web'),
+            ('start', 'test_db'), ('start', 'test_web'),
+            ('links', 'test_db'), ('links', 'test_web'),
+        ])
+
+    def test_restart(self):
+        self.web.config = ContainerConfig.compile('test_web', {'links': ['db'], 'volumes': ['/srv/new:/var/www']}, {})
+        self.assertEqual(self.actions(), [('restart', 'test_web'), ('links', 'test_web')])
+        # linking containers are updated if the linked container restarts
+        self.db.config = ContainerConfig.compile('test_db', {'ports': ['5432:5432'], 'fqdn': 'db.example.net', 'cgroup': ['cpu.shares=512']}, {})
+        self.assertIn(('links', 'test_web'), self.actions())
+
+    def test_ports_and_cgroup(self):
+        self.db.config = ContainerConfig.compile('test_db', {'ports': ['5433:5432'], 'cgroup': ['cpu.shares=256']}, {})
+        self.assertEqual(self.actions(), [('cgroup', 'test_db'), ('ports', 'test_db')])
+        self.project.args['no_ports'] = True
+        self.assertEqual(self.actions(), [('cgroup', 'test_db')])
+
+    def test_links(self):
+        self.web.recorded['links'] = []
+        self.assertEqual(self.actions(), [('links', 'test_web')])
+        self.project.args['no_links'] = True
+        self.assertEqual(self.actions(), [])
+
+class TestExecute(unittest.TestCase):
+    ''' Test execute() with a fake project '''
+
+    def setUp(self):
+        self.db = FakeContainer('test_db', {'ports': ['5432:5432']})
+        self.web = FakeContainer('test_web', {'links': ['db']})
+        self.project = FakeProject([self.db, self.web])
+
+    def test_start_waves(self):
+        self.project.unhealthy = set(['db'])
+        execute(self.project, [Step('start', 'test_db', ''), Step('restart', 'test_web', ''),
+                               Step('links', 'test_web', '')])
+        # started together in dependency waves, not one by one
+        self.assertEqual(self.project.waves, [['test_db', 'test_web']])
+        self.assertEqual(self.web.calls, [('stop', {}), ('rmports', {}),
+                                          ('links', {'auto_update': True, 'exclude': set(['db'])})])
+
+    def test_no_ports(self):
+        self.project.args['no_ports'] = True
+        execute(self.project, [Step('restart', 'test_db', ''), Step('ports', 'test_db', '')])
+        self.assertEqual(self.db.calls, [('stop', {})])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the rolling restart of containers
+'''
+
+import logging
+import socket
+import unittest
+
+from locker.config import ContainerConfig
+from locker.rollout import batches, is_ready, rollout
+
+def setUpModule():
+    logging.basicConfig(format='%(asctime)s, %(levelname)8s: %(message)s', level=logging.INFO)
+
+class FakeContainer(object):
+    def __init__(self, name, running=True, ips=('127.0.0.1',), ports=()):
+        self.name = name
+        self.running = running
+        self.ips = list(ips)
+        self.logger = logging.getLogger(name)
+        self.config = ContainerConfig.compile(name, {'ports': list(ports)})
+        self.restarts = 0
+
+    def get_ips(self, retries=10):
+        return self.ips
+
+class FakeProject(object):
+    def __init__(self, containers, **args):
+        self.containers = containers
+        self.args = dict({'max_unavailable': 1, 'ready_timeout': 0.2}, **args)
+
+class TestRollout(unittest.TestCase):
+    ''' Test rollout() with fake containers and restarts '''
+
+    def setUp(self):
+        self.containers = [FakeContainer('test_web%d' % num) for num in range(5)]
+        self.containers[3].running = False
+        self.unavailable = list()
+
+    def restart(self, containers):
+        self.unavailable.append([con.name for con in containers])
+        for container in containers:
+            container.restarts += 1
+
+    def test_batches(self):
+        self.assertEqual(batches(list(range(5)), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual(batches(list(range(2)), 0), [[0], [1]])
+
+    def test_rollout(self):
+        project = FakeProject(self.containers, max_unavailable=2)
+        self.assertTrue(rollout(project, self.restart, check=lambda con: True))
+        self.assertEqual(self.unavailable, [['test_web0', 'test_web1'], ['test_web2', 'test_web4']])
+
+    def test_abort(self):
+        project = FakeProject(self.containers)
+        check = lambda con: con.name != 'test_web1'
+        self.assertFalse(rollout(project, self.restart, check=check))
+        self.assertEqual([con.restarts for con in self.containers], [1, 1, 0, 0, 0])
+
+    def test_is_ready(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+        self.assertTrue(is_ready(FakeContainer('open', ports=['%d:%d' % (port, port)])))
+        self.assertTrue(is_ready(FakeContainer('udp', ports=['1:1/udp'])))
+        self.assertFalse(is_ready(FakeContainer('noip', ips=())))
+        self.assertFalse(is_ready(FakeContainer('stopped', running=False)))
+        server.close()
+        self.assertFalse(is_ready(FakeContainer('closed', ports=['%d:%d' % (port, port)])))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the built-in schema validation
+'''
+
+import glob
+import logging
+import os
+import tempfile
+import time
+import unittest
+
+import yaml
+from locker.schema import (SchemaError, ValidationError, get_validator,
+                           validate)
+
+# timings are only asserted if set, they depend on the load of the machine
+BENCHMARK = 'LOCKER_BENCHMARK' in os.environ
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs', 'examples')
+
+class TestValidate(unittest.TestCase):
+    ''' Test validation against the built-in schema
+
+    Does not have any side effects
+    '''
+
+    def test_examples(self):
+        for example in glob.glob(os.path.join(EXAMPLES, '*.yaml')):
+            with open(example, 'r') as example_fd:
+                validate(yaml.safe_load(example_fd))
+
+    def test_errors(self):
+        yml = {
+            'containers': {
+                'web': {
+                    'clone': 'ubuntu',
+                    'ports': ['80:80', '80:8o', 8080],
+                    'links': ['db:database', 'in valid'],
+                    'prots': ['80:80'],
+                },
+                'db': {
+                    'template': {'release': 'trusty'},
+                    'dns': ['$bridge', '$invalid'],
+                },
+                'app': {'clone': {'from': 'ubuntu', 'snapshot': True, 'backingstore': 'overlayfs'}},
+                'app2': {'clone': {'snapshot': True, 'backingstore': 'nfs'}},
+                'app3': {'clone': ['ubuntu']},
+                '1invalid': {},
+            }
+        }
+        with self.assertRaises(ValidationError) as context:
+            validate(yml)
+        errors = dict(context.exception.errors)
+        self.assertIn('/containers/web/ports/1', errors)
+        self.assertIn('/containers/web/ports/2', errors)
+        self.assertIn('/containers/web/links/1', errors)
+        self.assertIn('/containers/web/prots', errors)
+        self.assertIn('/containers/db/template', errors)
+        self.assertIn('/containers/db/dns/1', errors)
+        self.assertIn('/containers/1invalid', errors)
+        self.assertIn('/containers/app2/clone', errors)
+        self.assertIn('/containers/app2/clone/backingstore', errors)
+        self.assertIn('/containers/app3/clone', errors)
+        self.assertNotIn('/containers/web/ports/0', errors)
+        self.assertNotIn('/containers/app/clone', errors)
+        self.assertEqual(len(context.exception.errors), 10)
+
+    def test_invalid_root(self):
+        for invalid_yml in [[], 'foo', 42]:
+            with self.assertRaises(ValidationError):
+                validate(invalid_yml)
+
+    def test_cached(self):
+        self.assertIs(get_validator(), get_validator())
+
+    def test_large(self):
+        yml = {'containers': dict(
+            ('container%d' % num, {
+                'clone': 'ubuntu',
+                'ports': ['%d:80' % (10000 + num), '192.168.2.1:%d:53/udp' % (20000 + num)],
+                'links': ['container%d:alias' % ((num + 1) % 1000)],
+                'volumes': ['/opt/data/$name/var/log:/var/log'],
+                'cgroup': ['cpu.shares=512', 'memory.limit_in_bytes=200000000'],
+                'dns': ['$bridge', '8.8.8.8'],
+            }) for num in range(1000))}
+        get_validator()
+        start = time.time()
+        validate(yml)
+        seconds = time.time() - start
+        logging.info('Validated %d containers in %.3fs', len(yml['containers']), seconds)
+        if BENCHMARK:
+            self.assertLess(seconds, 1.0)
+
+class TestSchema(unittest.TestCase):
+    ''' Test compilation of custom schema files '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.schema_file = os.path.join(self.tmpdir.name, 'schema.yaml')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, schema):
+        with open(self.schema_file, 'w') as schema_fd:
+            yaml.safe_dump(schema, schema_fd)
+
+    def test_custom(self):
+        self._write({'type': 'map', 'mapping': {
+            'mode': {'type': 'str', 'enum': ['a', 'b'], 'required': True},
+            'count': {'type': 'int'},
+        }})
+        validate({'mode': 'a', 'count': 3}, self.schema_file)
+        with self.assertRaises(ValidationError) as context:
+            validate({'mode': 'c', 'count': True}, self.schema_file)
+        self.assertEqual([p for p, m in context.exception.errors], ['/mode', '/count'])
+        with self.assertRaises(ValidationError):
+            validate({'count': 3}, self.schema_file)
+
+    def test_invalid_schema(self):
+        for schema in [{'type': 'unknown'}, {'type': 'seq', 'sequence': []},
+                       {'type': 'map', 'mapping': {'re;(': {}}}, [],
+                       {'type': 'int', 'range': {'min': 0}},
+                       {'type': 'str', 'mapping': {}},
+                       {'any-of': [{'type': 'str'}], 'type': 'str'}]:
+            self._write(schema)
+            with self.assertRaises(SchemaError):
+                get_validator(self.schema_file)
+
+if __name__ == "__main__":
+    unittest.main()
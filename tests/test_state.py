@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the recorded container state
+'''
+
+import json
+import os
+import tempfile
+import unittest
+
+from locker.state import (LEGACY_STATE_FILE, STATE_DB, ContainerState,
+                          StateStore, links_from_hosts)
+
+class TestContainerState(unittest.TestCase):
+    ''' Test recording and reading of the state '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, STATE_DB)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def state(self, name='test_web', lxcpath=None):
+        store = StateStore(lxcpath or self.tmpdir.name)
+        self.addCleanup(store.close)
+        return ContainerState(store, name)
+
+    def test_missing(self):
+        state = self.state()
+        self.assertNotIn('links', state)
+        self.assertIsNone(state.get('links'))
+        self.assertEqual(state.get('links', []), [])
+
+    def test_update(self):
+        state = self.state()
+        self.assertTrue(state.update(links=['db', 'cache'], ip='10.1.1.3'))
+        # unchanged values are not written
+        self.assertFalse(state.update(links=['db', 'cache']))
+        self.assertTrue(state.update(links=[]))
+        state = self.state()
+        self.assertIn('links', state)
+        self.assertEqual(state.get('links'), [])
+        self.assertEqual(state.get('ip'), '10.1.1.3')
+        self.assertTrue(state.update(ip=None))
+        self.assertNotIn('ip', self.state())
+        # the values of other containers are separate
+        self.assertNotIn('links', self.state('test_db'))
+
+    def test_invalidate(self):
+        state = self.state()
+        state.update(links=['db'])
+        # changed by another process
+        self.state().update(links=[])
+        self.assertEqual(state.get('links'), ['db'])
+        state.invalidate()
+        self.assertEqual(state.get('links'), [])
+
+    def test_replace(self):
+        state = self.state()
+        state.update(links=['db'], files={})
+        self.assertTrue(state.replace(status='RUNNING'))
+        self.assertEqual(self.state().store.load('test_web'), {'status': 'RUNNING'})
+
+    def test_corrupt(self):
+        with open(self.filename, 'w') as state_fd:
+            state_fd.write('[' * 4096)
+        state = self.state()
+        self.assertIsNone(state.get('links'))
+        self.assertTrue(state.update(links=['db']))
+        self.assertEqual(self.state().get('links'), ['db'])
+        self.assertTrue(os.path.exists(self.filename + '.corrupt'))
+
+    def test_unwritable(self):
+        state = self.state(lxcpath=os.path.join(self.tmpdir.name, 'missing'))
+        self.assertIsNone(state.get('links'))
+        self.assertFalse(state.update(links=['db']))
+
+    def test_legacy(self):
+        legacy = os.path.join(self.tmpdir.name, 'test_web', LEGACY_STATE_FILE)
+        os.mkdir(os.path.dirname(legacy))
+        with open(legacy, 'w') as state_fd:
+            json.dump({'links': ['db']}, state_fd)
+        self.assertEqual(self.state().get('links'), ['db'])
+        self.assertFalse(os.path.exists(legacy))
+        self.assertEqual(self.state().get('links'), ['db'])
+
+class TestStateStore(unittest.TestCase):
+    ''' Test the allocation of values '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = StateStore(self.tmpdir.name)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def test_allocate(self):
+        candidates = ['10.1.1.%d' % num for num in range(2, 6)]
+        self.assertEqual(self.store.allocate('test_db', 'ip', candidates, ['10.1.1.2']), '10.1.1.3')
+        self.assertEqual(self.store.allocate('test_web', 'ip', candidates), '10.1.1.2')
+        # the recorded value is kept if preferred
+        self.assertEqual(self.store.allocate('test_db', 'ip', ['10.1.1.3'] + candidates), '10.1.1.3')
+        self.assertEqual(self.store.allocate('test_cache', 'ip', candidates), '10.1.1.4')
+        self.assertEqual(self.store.values('ip'), {'test_db': '10.1.1.3', 'test_web': '10.1.1.2',
+                                                   'test_cache': '10.1.1.4'})
+        with self.assertRaises(RuntimeError):
+            self.store.allocate('test_other', 'ip', candidates, ['10.1.1.5'])
+        self.store.forget('test_cache')
+        self.assertEqual(self.store.names(), set(['test_db', 'test_web']))
+
+class TestLinksFromHosts(unittest.TestCase):
+    ''' Test the fallback to parsing the container's /etc/hosts '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.hosts_file = os.path.join(self.tmpdir.name, 'hosts')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, content):
+        with open(self.hosts_file, 'w') as hosts_fd:
+            hosts_fd.write(content)
+
+    def test_links(self):
+        self.write('127.0.0.1 localhost\n'
+                   '10.1.1.2  db.example.net db database # test_db\n'
+                   '10.1.1.3  cache # test_cache\n'
+                   '10.1.1.4  other # other_web\n')
+        self.assertEqual(links_from_hosts(self.hosts_file, 'test'), ['db', 'cache'])
+        self.assertEqual(links_from_hosts(self.hosts_file, 'other'), ['web'])
+        self.write('10.1.1.2 db # test_db\n')
+        self.assertEqual(links_from_hosts(self.hosts_file, 'test'), ['db'])
+        os.unlink(self.hosts_file)
+        self.assertEqual(links_from_hosts(self.hosts_file, 'test'), [])
+
+if __name__ == "__main__":
+    unittest.main()
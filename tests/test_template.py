@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the cache of base containers created from templates
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from locker.template import BASE_PREFIX, GRACE_PERIOD, MARKER_FILE, TemplateCache
+
+TEMPLATE = (('name', 'ubuntu'), ('release', 'trusty'))
+TTL = 3600
+
+class FakeLxc(object):
+    ''' Containers in a temporary lxcpath '''
+
+    LXC_CREATE_QUIET = 1
+
+    def __init__(self, lxcpath):
+        self.lxcpath = lxcpath
+        self.destroyed = list()
+        lxc = self
+
+        class Container(object):
+            def __init__(self, name, config_path):
+                self.name = name
+                self.path = os.path.join(config_path, name)
+
+            @property
+            def defined(self):
+                return os.path.isdir(self.path)
+
+            def create(self, template, flags, args):
+                os.makedirs(self.path)
+
+            def destroy(self):
+                lxc.destroyed.append(self.name)
+                shutil.rmtree(self.path)
+                return True
+
+        self.Container = Container
+
+    def list_containers(self, config_path):
+        return sorted(name for name in os.listdir(config_path)
+                      if os.path.isdir(os.path.join(config_path, name)))
+
+class TestTemplateCache(unittest.TestCase):
+    ''' Get, build, and remove base containers in a temporary lxcpath '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.lxc = FakeLxc(self.tmpdir.name)
+        self.patcher = mock.patch('locker.template.lxc', self.lxc)
+        self.patcher.start()
+        self.cache = TemplateCache(self.tmpdir.name, TTL)
+        self.key = TemplateCache.key(TEMPLATE)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmpdir.cleanup()
+
+    def mark(self, name, created):
+        with open(os.path.join(self.tmpdir.name, name, MARKER_FILE), 'w') as marker_fd:
+            json.dump({'created': created}, marker_fd)
+
+    def base(self, age, marked=True):
+        created = int(time.time() - age)
+        name = '%s%s-%d' % (BASE_PREFIX, self.key, created)
+        os.makedirs(os.path.join(self.tmpdir.name, name))
+        if marked:
+            self.mark(name, created)
+        return name
+
+    def test_build(self):
+        name = self.cache.get(TEMPLATE)
+        self.assertTrue(name.startswith(BASE_PREFIX + self.key))
+        self.assertTrue(self.cache.has_fresh(TEMPLATE))
+        self.assertEqual(self.cache.get(TEMPLATE), name)
+
+    def test_expired(self):
+        expired = self.base(TTL + 10)
+        removable = self.base(TTL + GRACE_PERIOD + 10)
+        incomplete = self.base(20, marked=False)
+        self.assertFalse(self.cache.has_fresh(TEMPLATE))
+        name = self.cache.get(TEMPLATE)
+        self.assertNotIn(name, [expired, removable, incomplete])
+        # expired bases are kept during the grace period
+        self.assertEqual(sorted(self.lxc.destroyed), sorted([removable, incomplete]))
+        self.assertIn(expired, self.lxc.list_containers(self.tmpdir.name))
+
+    def test_locked(self):
+        ''' A base that is still being built is waited for, not removed '''
+        building = self.base(0, marked=False)
+        lock_fo = self.cache._lock(self.key)
+        result = list()
+        thread = threading.Thread(target=lambda: result.append(self.cache.get(TEMPLATE)))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.mark(building, time.time())
+        lock_fo.close()
+        thread.join()
+        self.assertEqual(result, [building])
+        self.assertEqual(self.lxc.destroyed, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test copying files between the host and the root file systems of containers
+'''
+
+import errno
+import logging
+import os
+import tempfile
+import unittest
+
+from locker.transfer import pull, push, resolve
+
+class FakeContainer(object):
+    ''' Stopped container with a directory as root file system '''
+
+    def __init__(self, name, rootfs):
+        self.name = 'test_%s' % name
+        self.color = ''
+        self.defined = True
+        self.running = False
+        self.backing_store = 'dir'
+        self.rootfs = rootfs
+        self.logger = logging.getLogger(self.name)
+        os.makedirs(os.path.join(rootfs, 'srv'))
+
+class TestResolve(unittest.TestCase):
+    ''' Resolve paths in a root directory '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        os.makedirs(os.path.join(self.root, 'var', 'www'))
+        os.symlink('/var/www', os.path.join(self.root, 'www'))
+        os.symlink('../../..', os.path.join(self.root, 'var', 'up'))
+        os.symlink('loop', os.path.join(self.root, 'loop'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resolve(self):
+        www = os.path.join(self.root, 'var', 'www')
+        self.assertEqual(resolve(self.root, '/www/index.html'), os.path.join(www, 'index.html'))
+        self.assertEqual(resolve(self.root, '/var/up/etc/passwd'), os.path.join(self.root, 'etc', 'passwd'))
+        self.assertEqual(resolve(self.root, '/../../etc'), os.path.join(self.root, 'etc'))
+        self.assertEqual(resolve(self.root, '/'), self.root)
+        with self.assertRaises(OSError) as context:
+            resolve(self.root, '/loop/file')
+        self.assertEqual(context.exception.errno, errno.ELOOP)
+
+class TestTransfer(unittest.TestCase):
+    ''' Push to and pull from containers in temporary directories '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'app')
+        os.makedirs(os.path.join(self.src, 'lib'))
+        with open(os.path.join(self.src, 'app.bin'), 'wb') as file_fo:
+            file_fo.write(os.urandom(2**20 + 3))
+        with open(os.path.join(self.src, 'lib', 'config'), 'w') as file_fo:
+            file_fo.write('key: value\n')
+        os.symlink('lib/config', os.path.join(self.src, 'config'))
+        self.containers = [FakeContainer(name, os.path.join(self.tmpdir.name, name, 'rootfs'))
+                           for name in ['web', 'db']]
+        # /srv/app of "db" points to a directory outside the root file system
+        os.symlink('/opt', os.path.join(self.containers[1].rootfs, 'srv', 'app'))
+        os.makedirs(os.path.join(self.containers[1].rootfs, 'opt'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_push(self):
+        results = push(self.containers, self.src, '/srv/app', parallel=2)
+        self.assertEqual([(stats.copied, stats.skipped) for stats in results.values()], [(3, 0), (3, 0)])
+        web = os.path.join(self.containers[0].rootfs, 'srv', 'app')
+        db = os.path.join(self.containers[1].rootfs, 'opt')
+        for root in [web, db]:
+            with open(os.path.join(self.src, 'app.bin'), 'rb') as src_fo, \
+                 open(os.path.join(root, 'app.bin'), 'rb') as dst_fo:
+                self.assertEqual(src_fo.read(), dst_fo.read())
+            self.assertEqual(os.readlink(os.path.join(root, 'config')), 'lib/config')
+        self.assertEqual(os.stat(os.path.join(web, 'app.bin')).st_mtime_ns,
+                         os.stat(os.path.join(self.src, 'app.bin')).st_mtime_ns)
+
+        # only changed files are copied again
+        with open(os.path.join(self.src, 'lib', 'config'), 'w') as file_fo:
+            file_fo.write('key: other\n')
+        results = push(self.containers, self.src, '/srv/app')
+        self.assertEqual([(stats.copied, stats.skipped) for stats in results.values()], [(1, 2), (1, 2)])
+        with open(os.path.join(web, 'lib', 'config')) as file_fo:
+            self.assertEqual(file_fo.read(), 'key: other\n')
+
+        # a file is copied into an existing directory
+        results = push(self.containers[:1], os.path.join(self.src, 'lib', 'config'), '/srv')
+        self.assertEqual(results['test_web'].copied, 1)
+        self.assertTrue(os.path.isfile(os.path.join(self.containers[0].rootfs, 'srv', 'config')))
+
+    def test_pull(self):
+        push(self.containers, self.src, '/srv/app')
+        dst = os.path.join(self.tmpdir.name, 'pulled')
+        results = pull(self.containers, '/srv/app/lib', dst)
+        self.assertEqual([stats.copied for stats in results.values()], [1, 1])
+        for name in ['web', 'db']:
+            self.assertTrue(os.path.isfile(os.path.join(dst, name, 'lib', 'config')))
+        results = pull(self.containers, '/srv/app/lib', dst)
+        self.assertEqual([(stats.copied, stats.skipped) for stats in results.values()], [(0, 1), (0, 1)])
+
+    def test_failure(self):
+        self.containers[1].backing_store = 'overlayfs'
+        results = push(self.containers, self.src, '/srv/app')
+        self.assertEqual(results['test_web'].copied, 3)
+        self.assertIsNone(results['test_db'])
+
+if __name__ == "__main__":
+    unittest.main()
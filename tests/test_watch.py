@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Test the computation of the changes applied by "locker watch"
+'''
+
+import os
+import tempfile
+import unittest
+
+from locker.config import ContainerConfig, ProjectConfig
+from locker.watch import IN_CLOSE_WRITE, IN_MOVED_TO, Inotify, changes, diff
+
+class FakeContainer(object):
+    def __init__(self, name, config, running=True):
+        self.name = 'test_%s' % name
+        self.config = config
+        self.running = running
+
+class FakeProject(object):
+    def __init__(self, yml, args=None, running=None):
+        self.name = 'test'
+        self.args = args or {}
+        self.config = ProjectConfig.compile(yml)
+        self.all_containers = [FakeContainer(con.name, con, running is None or con.name in running)
+                               for con in self.config.containers]
+        self.containers = self.all_containers
+
+class TestDiff(unittest.TestCase):
+    ''' Test diff() of container configurations '''
+
+    def diff(self, old, new):
+        return diff(ContainerConfig.compile('web', old), ContainerConfig.compile('web', new))
+
+    def test_live(self):
+        old = {'ports': ['80:80'], 'cgroup': ['cpu.shares=512'], 'links': ['db']}
+        self.assertEqual(self.diff(old, old), [])
+        self.assertEqual(self.diff(old, dict(old, cgroup=['cpu.shares=256'])), ['cgroup'])
+        self.assertEqual(self.diff(old, dict(old, ports=['8080:80'], links=[])), ['ports', 'links'])
+
+    def test_restart(self):
+        old = {'volumes': ['/srv/www:/var/www'], 'cgroup': ['cpu.shares=512']}
+        self.assertEqual(self.diff(old, dict(old, volumes=[])), ['restart'])
+        self.assertEqual(self.diff(old, dict(old, fqdn='web.example.net', cgroup=[])), ['restart'])
+        self.assertEqual(self.diff(old, dict(old, dns=['8.8.8.8'])), ['restart'])
+        self.assertEqual(self.diff(old, dict(old, console_log=True)), ['restart'])
+        self.assertEqual(self.diff(dict(old, console_log=True), dict(old, console_log=4096)), ['restart'])
+
+class TestChanges(unittest.TestCase):
+    ''' Test changes() with fake projects '''
+
+    def setUp(self):
+        self.yml = {'containers': {
+            'db': {'ports': ['5432:5432'], 'cgroup': ['cpu.shares=512']},
+            'web': {'links': ['db'], 'volumes': ['/srv/www:/var/www']},
+            'cache': {},
+        }}
+        self.old_config = ProjectConfig.compile(self.yml)
+
+    def changes(self, containers, args=None, running=None):
+        yml = {'containers': dict(self.yml['containers'], **containers)}
+        project = FakeProject(yml, args, running)
+        return [(step.action, step.container) for step in changes(project, self.old_config)]
+
+    def test_unchanged(self):
+        self.assertEqual(self.changes({}), [])
+
+    def test_live(self):
+        db = {'ports': ['5433:5432'], 'cgroup': ['cpu.shares=256']}
+        self.assertEqual(self.changes({'db': db}), [('cgroup', 'test_db'), ('ports', 'test_db')])
+        self.assertEqual(self.changes({'db': db}, {'no_ports': True}), [('cgroup', 'test_db')])
+        self.assertEqual(self.changes({'db': db}, running=['web']), [])
+
+    def test_restart(self):
+        self.assertEqual(self.changes({'db': {'ports': ['5432:5432'], 'cgroup': ['cpu.shares=512'],
+                                              'volumes': ['/srv/db:/var/lib/db']}}),
+                         [('restart', 'test_db'), ('links', 'test_db'), ('links', 'test_web')])
+
+    def test_added_removed(self):
+        yml = {'containers': {'db': self.yml['containers']['db'], 'new': {}}}
+        project = FakeProject(yml)
+        self.assertEqual(changes(project, self.old_config), [])
+
+class TestInotify(unittest.TestCase):
+    ''' Test the inotify binding with a temporary directory '''
+
+    def test_events(self):
+        with tempfile.TemporaryDirectory() as tmpdir, Inotify() as inotify:
+            inotify.add_watch(tmpdir, IN_CLOSE_WRITE | IN_MOVED_TO)
+            self.assertEqual(inotify.read(0), [])
+            with open(os.path.join(tmpdir, 'locker.yaml'), 'w') as yml_fd:
+                yml_fd.write('containers: {}\n')
+            with open(os.path.join(tmpdir, 'new.yaml'), 'w') as yml_fd:
+                yml_fd.write('containers: {}\n')
+            os.replace(os.path.join(tmpdir, 'new.yaml'), os.path.join(tmpdir, 'locker.yaml'))
+            events = list()
+            while len(events) < 3:
+                new_events = inotify.read(1)
+                self.assertTrue(new_events)
+                events.extend(new_events)
+            self.assertEqual([(event.name, event.mask) for event in events],
+                             [('locker.yaml', IN_CLOSE_WRITE), ('new.yaml', IN_CLOSE_WRITE),
+                              ('locker.yaml', IN_MOVED_TO)])
+
+if __name__ == "__main__":
+    unittest.main()